@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init, task_prerun, task_postrun
 
 # Set default Django settings module
 # remove this
@@ -14,7 +15,63 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Auto-discover tasks from all registered Django apps
 app.autodiscover_tasks()
 
-# Optional: Configure task routing if you want different queues later
-#app.conf.task_routes = {
-#    'pfd_bench.tasks.*': {'queue': 'pfd_processing'},
-#}
\ No newline at end of file
+# Task routing: two queues, each served by its own worker (see docker-compose.yml)
+# - CPU_QUEUE: DXF parsing of step 1, a prefork worker with one process per core
+# - IO_QUEUE: everything that waits on the LLM providers, a thread pool worker at high concurrency
+CPU_QUEUE = 'pfd_cpu'
+IO_QUEUE = 'pfd_io'
+
+app.conf.task_routes = {
+    'pfd_bench.tasks.parse_pfd_extraction_step_1': {'queue': CPU_QUEUE},
+    'pfd_bench.tasks.*': {'queue': IO_QUEUE},
+}
+app.conf.task_default_queue = IO_QUEUE
+
+
+# Worker bootstrap (see pfd_bench/core/PFD_warmup.py): the pipeline modules are imported before the
+# pool forks; the singletons (connections, event loop thread, agents, graphs) are created after it,
+# in each child process, or in the worker itself with a pool that does not fork. The agents and graphs
+# are only warmed up in a worker of the I/O queue: the CPU worker parses drawings, it calls no model
+_serves_llm_calls = True
+
+
+def _forks(pool_cls):
+    name = pool_cls if isinstance(pool_cls, str) else f"{pool_cls.__module__}.{pool_cls.__name__}"
+    return 'prefork' in name or 'processes' in name
+
+
+@worker_init.connect
+def preload_worker(sender=None, **kwargs):
+    from django.conf import settings
+    if not settings.PFD_BENCH_WARMUP['enabled']:
+        return
+
+    global _serves_llm_calls
+    _serves_llm_calls = IO_QUEUE in sender.app.amqp.queues.consume_from  # inherited by the forked children
+
+    from pfd_bench.core.PFD_warmup import preload_modules, warm_up_process
+    preload_modules()
+    if not _forks(sender.pool_cls):
+        warm_up_process(llm_calls=_serves_llm_calls)
+
+
+@worker_process_init.connect
+def warm_up_worker_process(**kwargs):
+    from django.conf import settings
+    if not settings.PFD_BENCH_WARMUP['enabled']:
+        return
+
+    from pfd_bench.core.PFD_warmup import warm_up_process
+    warm_up_process(llm_calls=_serves_llm_calls)
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    from pfd_bench.core.PFD_warmup import task_latency
+    task_latency.start(task_id)
+
+
+@task_postrun.connect
+def stop_task_timer(task_id=None, task=None, **kwargs):
+    from pfd_bench.core.PFD_warmup import task_latency
+    task_latency.finish(task_id, task.name)
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 import datetime 
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 import dj_database_url
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -209,4 +210,257 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
-CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
\ No newline at end of file
+CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes; the threads pool (I/O queue) does not enforce it, see PFD_BENCH_HTTP_POOL['call_deadline_s']
+
+# Priority lanes on the Redis broker (0 is served first): interactive runs go ahead of the speculative
+# step 2, which goes ahead of the batches of "run all files". Workers reserve one task per slot only,
+# so a task queued later at a higher priority is not stuck behind reserved batch work
+PFD_BENCH_PRIORITIES = {'interactive': 0, 'speculative': 3, 'batch': 6}
+CELERY_TASK_DEFAULT_PRIORITY = PFD_BENCH_PRIORITIES['interactive']
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+
+# PFD Bench pipeline
+# What changes the output or the cost of a run (ensemble, model routing, hedging, speculative,
+# incremental and map-reduce step 2, the compact generator table, coalescing, admission control) is
+# off unless enabled below; the rest (rate limits, streaming, warm-up, reaper, circuit breaker) is on
+# Number of parallel worker calls in step 1; above 1 the samples are reconciled by majority vote
+# and only the disputed rows are sent to the auditor
+PFD_BENCH_WORKER_ENSEMBLE_SIZE = int(os.environ.get('PFD_BENCH_WORKER_ENSEMBLE_SIZE', '1'))
+
+# Chat model provider: 'live', 'offline' (local stand-in for load tests and CI, no network or keys)
+# or the dotted path of a factory(model, temperature=...) returning a chat model
+PFD_BENCH_LLM_PROVIDER = os.environ.get('PFD_BENCH_LLM_PROVIDER', 'live')
+
+# Offline stand-in: log-normal latency per call and fraction of calls failing with a simulated 429/503
+PFD_BENCH_OFFLINE_PROVIDER = {
+    'latency_median_s': float(os.environ.get('PFD_BENCH_OFFLINE_LATENCY_MEDIAN_S', '2.0')),
+    'latency_sigma': float(os.environ.get('PFD_BENCH_OFFLINE_LATENCY_SIGMA', '0.5')),
+    'error_rate': float(os.environ.get('PFD_BENCH_OFFLINE_ERROR_RATE', '0.0')),
+}
+
+# Record/replay of the LLM calls: 'off', 'record' or 'replay' (one cassette file per run)
+# Replay timing: 'original' (honour recorded latencies) or 'fast'
+PFD_BENCH_CASSETTE_MODE = os.environ.get('PFD_BENCH_CASSETTE_MODE', 'off')
+PFD_BENCH_CASSETTE_REPLAY_TIMING = os.environ.get('PFD_BENCH_CASSETTE_REPLAY_TIMING', 'fast')
+PFD_BENCH_CASSETTE_DIR = os.environ.get('PFD_BENCH_CASSETTE_DIR', os.path.join(BASE_DIR, 'cassettes'))
+
+# LangGraph checkpoints, so a retried run resumes from its last completed node: 'sqlite', 'postgres' or 'none'
+PFD_BENCH_CHECKPOINTER = os.environ.get('PFD_BENCH_CHECKPOINTER', 'sqlite')
+PFD_BENCH_CHECKPOINT_SQLITE_PATH = os.environ.get('PFD_BENCH_CHECKPOINT_SQLITE_PATH', os.path.join(BASE_DIR, 'checkpoints.sqlite3'))
+PFD_BENCH_CHECKPOINT_DB_URL = os.environ.get('PFD_BENCH_CHECKPOINT_DB_URL', os.environ.get('DATABASE_URL', ''))
+PFD_BENCH_CHECKPOINT_POOL_SIZE = int(os.environ.get('PFD_BENCH_CHECKPOINT_POOL_SIZE', '4'))
+
+# Redis used for the coordination state shared by the workers (defaults to the Celery broker)
+PFD_BENCH_REDIS_URL = os.environ.get('PFD_BENCH_REDIS_URL', CELERY_BROKER_URL)
+# Connect and read timeout of its clients: a hung Redis stalls a save or a model call this long at most
+PFD_BENCH_REDIS_TIMEOUT_S = float(os.environ.get('PFD_BENCH_REDIS_TIMEOUT_S', '2'))
+
+# Cross-worker rate limits per provider:model: requests/min, tokens/min and the ceiling of the
+# adaptive concurrency (halved on 429/503, ramped up on success); 0 disables a limit
+PFD_BENCH_RATE_LIMIT_ENABLED = os.environ.get('PFD_BENCH_RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+PFD_BENCH_RATE_LIMITS = {
+    'google_genai:gemini-2.5-pro': {
+        'rpm': int(os.environ.get('PFD_BENCH_GEMINI_PRO_RPM', '150')),
+        'tpm': int(os.environ.get('PFD_BENCH_GEMINI_PRO_TPM', '2000000')),
+        'max_concurrency': int(os.environ.get('PFD_BENCH_GEMINI_PRO_MAX_CONCURRENCY', '8')),
+    },
+    'openai:gpt-4o': {
+        'rpm': int(os.environ.get('PFD_BENCH_GPT_4O_RPM', '500')),
+        'tpm': int(os.environ.get('PFD_BENCH_GPT_4O_TPM', '800000')),
+        'max_concurrency': int(os.environ.get('PFD_BENCH_GPT_4O_MAX_CONCURRENCY', '8')),
+    },
+    'google_genai:gemini-2.5-flash': {
+        'rpm': int(os.environ.get('PFD_BENCH_GEMINI_FLASH_RPM', '1000')),
+        'tpm': int(os.environ.get('PFD_BENCH_GEMINI_FLASH_TPM', '1000000')),
+        'max_concurrency': int(os.environ.get('PFD_BENCH_GEMINI_FLASH_MAX_CONCURRENCY', '16')),
+    },
+    'openai:gpt-4o-mini': {
+        'rpm': int(os.environ.get('PFD_BENCH_GPT_4O_MINI_RPM', '500')),
+        'tpm': int(os.environ.get('PFD_BENCH_GPT_4O_MINI_TPM', '2000000')),
+        'max_concurrency': int(os.environ.get('PFD_BENCH_GPT_4O_MINI_MAX_CONCURRENCY', '16')),
+    },
+    'default': {'rpm': 60, 'tpm': 200000, 'max_concurrency': 4},
+}
+
+# Hedged requests: past the observed p90 latency of a node, a second request is sent (to the same
+# model, or the equivalent one below) and the first answer wins; hedges are capped to a fraction
+# of the tokens each node sends per day
+PFD_BENCH_HEDGING = {
+    'enabled': os.environ.get('PFD_BENCH_HEDGING_ENABLED', 'false').lower() == 'true',
+    'nodes': os.environ.get('PFD_BENCH_HEDGING_NODES', 'worker_node,worker_sample_node').split(','),
+    'quantile': float(os.environ.get('PFD_BENCH_HEDGING_QUANTILE', '0.9')),
+    'min_samples': int(os.environ.get('PFD_BENCH_HEDGING_MIN_SAMPLES', '20')),
+    'max_hedge_fraction': float(os.environ.get('PFD_BENCH_HEDGING_MAX_FRACTION', '0.1')),
+}
+PFD_BENCH_HEDGE_MODELS = {
+    'google_genai:gemini-2.5-pro': os.environ.get('PFD_BENCH_GEMINI_PRO_HEDGE_MODEL', 'google_genai:gemini-2.5-pro'),
+}
+
+# Model routing (off unless PFD_BENCH_MODEL_ROUTING_ENABLED): per role, the first route whose limits
+# (max_entities, max_equipment, max_tokens) hold for the input is used; inputs matching no route, and
+# every input while routing is off, go to the default model of the role (gemini-2.5-pro for worker
+# and auditor, gpt-4o for the generator)
+PFD_BENCH_MODEL_ROUTING_ENABLED = os.environ.get('PFD_BENCH_MODEL_ROUTING_ENABLED', 'false').lower() == 'true'
+PFD_BENCH_SMALL_PFD_MAX_EQUIPMENT = int(os.environ.get('PFD_BENCH_SMALL_PFD_MAX_EQUIPMENT', '15'))
+PFD_BENCH_SMALL_PFD_MAX_TOKENS = int(os.environ.get('PFD_BENCH_SMALL_PFD_MAX_TOKENS', '30000'))
+PFD_BENCH_MODEL_ROUTES = {
+    'worker': [
+        {'name': 'small', 'model': os.environ.get('PFD_BENCH_SMALL_WORKER_MODEL', 'google_genai:gemini-2.5-flash'),
+         'max_equipment': PFD_BENCH_SMALL_PFD_MAX_EQUIPMENT, 'max_tokens': PFD_BENCH_SMALL_PFD_MAX_TOKENS},
+    ],
+    'auditor': [],
+    'generator': [
+        {'name': 'small', 'model': os.environ.get('PFD_BENCH_SMALL_GENERATOR_MODEL', 'openai:gpt-4o-mini'),
+         'max_equipment': PFD_BENCH_SMALL_PFD_MAX_EQUIPMENT},
+    ],
+}
+
+# Pre-flight token check: context window and output limit per model; estimates (tiktoken) are
+# inflated by the margin since providers tokenize differently
+PFD_BENCH_MODEL_LIMITS = {
+    'google_genai:gemini-2.5-pro': {'context_window': 1048576, 'max_output': 65536},
+    'google_genai:gemini-2.5-flash': {'context_window': 1048576, 'max_output': 65536},
+    'openai:gpt-4o': {'context_window': 128000, 'max_output': 16384},
+    'openai:gpt-4o-mini': {'context_window': 128000, 'max_output': 16384},
+}
+PFD_BENCH_PREFLIGHT_MARGIN = float(os.environ.get('PFD_BENCH_PREFLIGHT_MARGIN', '1.2'))
+
+# Connection pool shared by all chat models of a process (HTTP/2 needs the h2 package)
+PFD_BENCH_HTTP_POOL = {
+    'max_connections': int(os.environ.get('PFD_BENCH_HTTP_MAX_CONNECTIONS', '20')),
+    'max_keepalive_connections': int(os.environ.get('PFD_BENCH_HTTP_MAX_KEEPALIVE', '10')),
+    'keepalive_expiry_s': float(os.environ.get('PFD_BENCH_HTTP_KEEPALIVE_EXPIRY_S', '120')),
+    'timeout_s': float(os.environ.get('PFD_BENCH_HTTP_TIMEOUT_S', '600')),
+    'connect_timeout_s': float(os.environ.get('PFD_BENCH_HTTP_CONNECT_TIMEOUT_S', '10')),
+    # whole model call, SDK retries included: the I/O worker (threads pool) ignores CELERY_TASK_TIME_LIMIT
+    'call_deadline_s': float(os.environ.get('PFD_BENCH_HTTP_CALL_DEADLINE_S', '900')),
+    'http2': os.environ.get('PFD_BENCH_HTTP2', 'true').lower() == 'true',
+}
+
+# Live streaming of the process description to run_completed (Redis pub/sub + Server-Sent Events)
+PFD_BENCH_STREAMING = {
+    'enabled': os.environ.get('PFD_BENCH_STREAM_DESCRIPTION', 'true').lower() == 'true',
+    'ttl_s': int(os.environ.get('PFD_BENCH_STREAM_TTL_S', '3600')),  # the text so far, for late subscribers
+    'heartbeat_s': float(os.environ.get('PFD_BENCH_STREAM_HEARTBEAT_S', '15')),
+}
+
+# Speculative step 2: generate the description in the background once this fraction of the rows is
+# reviewed; finalize reuses it if the table did not change since (off while cassettes record or replay)
+PFD_BENCH_SPECULATIVE = {
+    'enabled': os.environ.get('PFD_BENCH_SPECULATIVE_ENABLED', 'false').lower() == 'true',
+    'fraction': float(os.environ.get('PFD_BENCH_SPECULATIVE_FRACTION', '0.8')),
+    'timeout_s': int(os.environ.get('PFD_BENCH_SPECULATIVE_TIMEOUT_S', '600')),  # lease of a speculation in flight
+    'wait_s': float(os.environ.get('PFD_BENCH_SPECULATIVE_WAIT_S', '120')),  # finalize waits this long for it
+}
+
+# Incremental step 2 for reopened runs: only the sections of the edited rows and their neighbours are
+# rewritten, unless more than max_fraction of the sections would be
+PFD_BENCH_INCREMENTAL = {
+    'enabled': os.environ.get('PFD_BENCH_INCREMENTAL_ENABLED', 'false').lower() == 'true',
+    'max_fraction': float(os.environ.get('PFD_BENCH_INCREMENTAL_MAX_FRACTION', '0.5')),
+}
+
+# Map-reduce step 2 for large tables: from min_rows rows on, the description is generated per process
+# section (connected equipment, at most section_rows rows each) in parallel, then stitched together
+PFD_BENCH_MAP_REDUCE = {
+    'enabled': os.environ.get('PFD_BENCH_MAP_REDUCE_ENABLED', 'false').lower() == 'true',
+    'min_rows': int(os.environ.get('PFD_BENCH_MAP_REDUCE_MIN_ROWS', '60')),
+    'section_rows': int(os.environ.get('PFD_BENCH_MAP_REDUCE_SECTION_ROWS', '20')),
+}
+
+# Encoding of the equipment table in the prompt of each node: 'markdown', 'compact' (delimiter-separated)
+# or 'keyed' (one JSON object per row); compact and keyed leave out the stream counts and 'Modified'
+PFD_BENCH_TABLE_FORMATS = {
+    'auditor_node': os.environ.get('PFD_BENCH_AUDITOR_TABLE_FORMAT', 'markdown'),
+    'disputed_auditor_node': os.environ.get('PFD_BENCH_AUDITOR_TABLE_FORMAT', 'markdown'),
+    'generator_node': os.environ.get('PFD_BENCH_GENERATOR_TABLE_FORMAT', 'markdown'),
+    'regenerator_node': os.environ.get('PFD_BENCH_GENERATOR_TABLE_FORMAT', 'markdown'),
+    'section_generator_node': os.environ.get('PFD_BENCH_GENERATOR_TABLE_FORMAT', 'markdown'),
+}
+
+# Warm start of the Celery workers: modules preloaded before the fork, singletons and graphs created in
+# each worker process before its first task; offline_call adds one call to the offline stand-in
+PFD_BENCH_WARMUP = {
+    'enabled': os.environ.get('PFD_BENCH_WARMUP_ENABLED', 'true').lower() == 'true',
+    'offline_call': os.environ.get('PFD_BENCH_WARMUP_OFFLINE_CALL', 'false').lower() == 'true',
+}
+
+# Coalescing of step 1: a run on a drawing already in step 1 with the same pipeline configuration waits
+# for that run and copies its table. The leader renews a lease of lease_s every heartbeat_s; a follower
+# computes its own table if the lease expires (leader crashed) or after wait_s (off with cassettes). A follower
+# does not hold a worker while it waits: its task is queued again every poll_s until the leader is done
+PFD_BENCH_COALESCING = {
+    'enabled': os.environ.get('PFD_BENCH_COALESCING_ENABLED', 'false').lower() == 'true',
+    'lease_s': int(os.environ.get('PFD_BENCH_COALESCING_LEASE_S', '60')),
+    'heartbeat_s': float(os.environ.get('PFD_BENCH_COALESCING_HEARTBEAT_S', '15')),
+    'wait_s': float(os.environ.get('PFD_BENCH_COALESCING_WAIT_S', '1200')),
+    'poll_s': float(os.environ.get('PFD_BENCH_COALESCING_POLL_S', '5')),
+}
+
+# "Run all files" of a project: step 1 of the runs of a batch goes through at most max_parallel lanes
+# (each lane runs its share of the files one after the other), so a large project cannot fill the queues
+PFD_BENCH_BATCH = {
+    'max_parallel': int(os.environ.get('PFD_BENCH_BATCH_MAX_PARALLEL', '4')),
+    # fair share between users: the lanes of all the running batches of a user (each batch gets at least one)
+    'max_parallel_per_user': int(os.environ.get('PFD_BENCH_BATCH_MAX_PARALLEL_PER_USER', '8')),
+}
+
+# Stuck-run reaper (Celery beat, every every_s): a run whose task stopped writing its heartbeat for
+# stale_s (worker killed, time limit) is requeued, step 1 resuming from its checkpoints, at most
+# max_requeues times; then it fails with the reason. stale_s must exceed the longest node call (the
+# deadline of a model call, PFD_BENCH_HTTP_POOL['call_deadline_s']). A run queued (or pending) for queued_stale_s
+# is requeued too: its message was lost with a worker that took it; longer than any wait in the broker
+PFD_BENCH_REAPER = {
+    'enabled': os.environ.get('PFD_BENCH_REAPER_ENABLED', 'true').lower() == 'true',
+    'every_s': float(os.environ.get('PFD_BENCH_REAPER_EVERY_S', '60')),
+    'stale_s': float(os.environ.get('PFD_BENCH_REAPER_STALE_S', '1200')),
+    'queued_stale_s': float(os.environ.get('PFD_BENCH_REAPER_QUEUED_STALE_S', '14400')),
+    'max_requeues': int(os.environ.get('PFD_BENCH_REAPER_MAX_REQUEUES', '1')),
+}
+if PFD_BENCH_REAPER['stale_s'] <= PFD_BENCH_HTTP_POOL['call_deadline_s']:
+    raise ImproperlyConfigured("PFD_BENCH_REAPER_STALE_S must exceed PFD_BENCH_HTTP_CALL_DEADLINE_S: "
+                               "the reaper would requeue runs still waiting on a model call")
+
+# Circuit breaker per provider:model: opens when at least min_calls were made over window_s and error_rate
+# of them failed (timeouts, 5xx); calls then fail fast and the runs wait for the provider. After open_s one
+# call probes it. resume_every_s: how often the runs waiting for a provider are resumed (Celery beat)
+PFD_BENCH_CIRCUIT_BREAKER = {
+    'enabled': os.environ.get('PFD_BENCH_CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true',
+    'window_s': float(os.environ.get('PFD_BENCH_CIRCUIT_BREAKER_WINDOW_S', '60')),
+    'min_calls': int(os.environ.get('PFD_BENCH_CIRCUIT_BREAKER_MIN_CALLS', '5')),
+    'error_rate': float(os.environ.get('PFD_BENCH_CIRCUIT_BREAKER_ERROR_RATE', '0.5')),
+    'open_s': float(os.environ.get('PFD_BENCH_CIRCUIT_BREAKER_OPEN_S', '30')),
+    'resume_every_s': float(os.environ.get('PFD_BENCH_CIRCUIT_BREAKER_RESUME_EVERY_S', '30')),
+}
+
+# Admission control of the new runs: the wait before the step-1 table is estimated from the queue depths
+# and the recent latency of each stage over the worker slots. Over eta_notice_s the processing page shows
+# the ETA; over max_wait_s the run is deferred to the next off-peak window (HH:MM-HH:MM, none: as soon as
+# the load allows). Runs in step 1 at once per user (user_limits: name:limit,...) and per project (or
+# Project.max_active_runs); 0: no limit. every_s: how often the deferred runs are admitted (Celery beat)
+PFD_BENCH_ADMISSION = {
+    'enabled': os.environ.get('PFD_BENCH_ADMISSION_ENABLED', 'false').lower() == 'true',
+    'eta_notice_s': float(os.environ.get('PFD_BENCH_ADMISSION_ETA_NOTICE_S', '300')),
+    'max_wait_s': float(os.environ.get('PFD_BENCH_ADMISSION_MAX_WAIT_S', '1800')),
+    'window': os.environ.get('PFD_BENCH_ADMISSION_WINDOW', ''),
+    'cpu_slots': int(os.environ.get('PFD_BENCH_CPU_CONCURRENCY', '2')),
+    'io_slots': int(os.environ.get('PFD_BENCH_IO_CONCURRENCY', '32')),
+    'max_active_per_user': int(os.environ.get('PFD_BENCH_ADMISSION_MAX_ACTIVE_PER_USER', '10')),
+    'max_active_per_project': int(os.environ.get('PFD_BENCH_ADMISSION_MAX_ACTIVE_PER_PROJECT', '20')),
+    'user_limits': {name.strip(): int(limit) for name, limit in
+                    (item.rsplit(':', 1) for item in os.environ.get('PFD_BENCH_ADMISSION_USER_LIMITS', '').split(',')
+                     if item.strip())},
+    'every_s': float(os.environ.get('PFD_BENCH_ADMISSION_EVERY_S', '60')),
+}
+
+CELERY_BEAT_SCHEDULE = {}
+if PFD_BENCH_REAPER['enabled']:
+    CELERY_BEAT_SCHEDULE['reap-stuck-runs'] = {'task': 'pfd_bench.tasks.reap_stuck_runs',
+                                               'schedule': PFD_BENCH_REAPER['every_s']}
+if PFD_BENCH_CIRCUIT_BREAKER['enabled']:
+    CELERY_BEAT_SCHEDULE['resume-parked-runs'] = {'task': 'pfd_bench.tasks.resume_parked_runs',
+                                                  'schedule': PFD_BENCH_CIRCUIT_BREAKER['resume_every_s']}
+if PFD_BENCH_ADMISSION['enabled']:
+    CELERY_BEAT_SCHEDULE['admit-scheduled-runs'] = {'task': 'pfd_bench.tasks.admit_scheduled_runs',
+                                                    'schedule': PFD_BENCH_ADMISSION['every_s']}
@@ -22,6 +22,10 @@ ALLOWED_HOSTS = [
 ]
 
 
+# LangGraph checkpoints in the production Postgres
+PFD_BENCH_CHECKPOINTER = os.environ.get('PFD_BENCH_CHECKPOINTER', 'postgres')
+
+
 # Browser reload (development)
 if DEBUG:
     INTERNAL_IPS = [
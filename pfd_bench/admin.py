@@ -2,11 +2,11 @@
 # pfd_bench/admin.py
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Project, ProjectFile, Run, EquipmentReview, ProjectFileLink
+from .models import Project, ProjectFile, Run, RunBatch, RunArtifact, EquipmentReview, ProjectFileLink
 
 @admin.register(Project)
 class ProjectAdmin(admin.ModelAdmin):
-    list_display = ['name', 'created_by', 'created_at', 'file_count', 'run_count']
+    list_display = ['name', 'created_by', 'created_at', 'max_active_runs', 'file_count', 'run_count']
     list_filter = ['created_at', 'created_by']
     search_fields = ['name', 'description']
     readonly_fields = ['created_at']
@@ -38,6 +38,17 @@ class ProjectFileLinkAdmin(admin.ModelAdmin):
     list_filter = ['added_at', 'project']
     readonly_fields = ['added_at']
 
+@admin.register(RunBatch)
+class RunBatchAdmin(admin.ModelAdmin):
+    list_display = ['name', 'project', 'created_by', 'created_at', 'completed_at', 'run_count', 'lanes']
+    list_filter = ['created_at', 'project']
+    search_fields = ['name', 'project__name']
+    readonly_fields = ['created_at', 'completed_at', 'lanes', 'summary']
+
+    def run_count(self, obj):
+        return obj.runs.count()
+    run_count.short_description = 'Runs'
+
 @admin.register(Run)
 class RunAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'project', 'status', 'created_by', 'created_at', 'status_display']
@@ -47,7 +58,11 @@ class RunAdmin(admin.ModelAdmin):
     
     fieldsets = (
         ('Basic Info', {
-            'fields': ('project', 'file', 'name', 'status')
+            'fields': ('project', 'batch', 'file', 'name', 'status', 'task_id', 'coalesced_from')
+        }),
+        ('Admission', {
+            'fields': ('admission', 'scheduled_for'),
+            'classes': ('collapse',)
         }),
         ('Review State', {
             'fields': ('review_state', 'generated_table', 'review_progress'),
@@ -55,7 +70,11 @@ class RunAdmin(admin.ModelAdmin):
             'description': 'Review state is automatically managed by the system'
         }),
         ('Generated Content', {
-            'fields': ('generated_text',),
+            'fields': ('generated_text', 'generated_sections'),
+            'classes': ('collapse',)
+        }),
+        ('Model Routing', {
+            'fields': ('model_route', 'token_estimate', 'token_usage', 'speculation'),
             'classes': ('collapse',)
         }),
         ('Metadata', {
@@ -97,3 +116,12 @@ class EquipmentReviewAdmin(admin.ModelAdmin):
     list_display = ['run', 'equipment_index', 'has_changes', 'reviewed_by', 'reviewed_at']
     list_filter = ['has_changes', 'reviewed_at', 'run__project']
     readonly_fields = ['reviewed_at']
+
+
+@admin.register(RunArtifact)
+class RunArtifactAdmin(admin.ModelAdmin):
+    list_display = ['run', 'step', 'version', 'node', 'model_id', 'prompt_version',
+                    'input_tokens', 'output_tokens', 'wall_time_s', 'speculative', 'created_at']
+    list_filter = ['step', 'node', 'model_id', 'prompt_version', 'speculative']
+    search_fields = ['run__name', 'node']
+    readonly_fields = ['created_at']
@@ -0,0 +1,195 @@
+"""
+Admission control of the new runs
+
+Under load, create_run queued every run right away: a run could wait an hour in the broker while
+its page said it was processing. Before a run is queued, the wait before its table is ready is
+estimated from:
+- the depth of the two queues at the interactive priority (the messages ahead of it in the broker)
+- the mean latency of the recent runs of each stage (the parse task on the CPU queue, the LLM task
+  on the I/O queue, see PFD_warmup), spread over the slots of its worker (PFD_BENCH_CPU_CONCURRENCY
+  and PFD_BENCH_IO_CONCURRENCY)
+
+and the run is:
+- accepted: queued now
+- accepted with an ETA: queued now, and the processing page shows when it should be ready (the
+  wait is over PFD_BENCH_ADMISSION['eta_notice_s'])
+- deferred: 'scheduled', not queued. That happens when the wait is over 'max_wait_s'; the run then
+  starts in the next off-peak 'window' (e.g. 22:00-06:00), or as soon as the load allows when
+  there is no window. It also happens when its user or its project already has its limit of runs
+  in step 1; the run then starts as soon as one of those ends. The limit per user is
+  'max_active_per_user', overridden by 'user_limits'. The limit per project is
+  'max_active_per_project', overridden by Project.max_active_runs
+
+Within the window the wait is shown but no run is deferred on it. The scheduled runs are admitted
+again, oldest first, by the admit_scheduled_runs task (Celery beat). Batches are left out: they run
+at their own priority, within their own limits (PFD_BENCH_BATCH). If Redis is unreachable the wait
+is unknown and only the limits apply.
+"""
+
+import time
+import logging
+from datetime import datetime, timedelta
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+
+from PFD_agent.celery import CPU_QUEUE, IO_QUEUE
+from .PFD_redis import get_redis, redis_timeouts
+from .PFD_warmup import recent_task_latency
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_admission')
+
+
+# runs that hold a slot of their user and project: queued or in step 1
+ACTIVE_STATUSES = ('pending', 'processing', 'waiting_for_provider')
+
+# stages of step 1: queue, task, worker slots (key of PFD_BENCH_ADMISSION), latency before any run (s)
+STAGES = [
+    (CPU_QUEUE, 'pfd_bench.tasks.parse_pfd_extraction_step_1', 'cpu_slots', 10),
+    (IO_QUEUE, 'pfd_bench.tasks.llm_pfd_extraction_step_1', 'io_slots', 120),
+]
+
+_broker_client = None
+
+
+
+###################################################################
+# Estimated wait
+###################################################################
+
+def _broker():
+    """Redis client of the Celery broker (the shared client when they are the same server)"""
+    global _broker_client
+    if settings.CELERY_BROKER_URL == settings.PFD_BENCH_REDIS_URL:
+        return get_redis()
+    if _broker_client is None:
+        _broker_client = redis.Redis.from_url(settings.CELERY_BROKER_URL, decode_responses=True, **redis_timeouts())
+    return _broker_client
+
+
+def queue_depths():
+    """{queue: messages waiting at the interactive priority}; the broker keeps those in the bare queue key"""
+    pipe = _broker().pipeline()
+    for queue, *_ in STAGES:
+        pipe.llen(queue)
+    return {queue: depth for (queue, *_), depth in zip(STAGES, pipe.execute())}
+
+
+def estimated_wait_s(depths):
+    """Seconds until a run queued now behind depths has its step-1 table"""
+    config = settings.PFD_BENCH_ADMISSION
+
+    wait = 0.0
+    for queue, task_name, slots, default_s in STAGES:
+        latency = recent_task_latency(task_name) or default_s
+        # the messages ahead are served config[slots] at a time, then the run's own task
+        wait += (depths[queue] // max(1, config[slots]) + 1) * latency
+    return wait
+
+
+
+###################################################################
+# Off-peak window
+###################################################################
+
+def _window():
+    """(start, end) of the off-peak window as times of the day, None if there is none"""
+    window = settings.PFD_BENCH_ADMISSION['window']
+    if not window:
+        return None
+    start, end = (datetime.strptime(bound.strip(), "%H:%M").time() for bound in window.split('-'))
+    return start, end
+
+
+def in_window(now):
+    window = _window()
+    if window is None:
+        return False
+    start, end = window
+    now = timezone.localtime(now).time()
+    return start <= now < end if start < end else now >= start or now < end
+
+
+def next_window_start(now):
+    """When the next off-peak window opens, None if there is none"""
+    window = _window()
+    if window is None:
+        return None
+    now = timezone.localtime(now)
+    start = now.replace(hour=window[0].hour, minute=window[0].minute, second=0, microsecond=0)
+    return start if start > now else start + timedelta(days=1)
+
+
+
+###################################################################
+# Admission
+###################################################################
+
+def user_limit(user):
+    config = settings.PFD_BENCH_ADMISSION
+    return config['user_limits'].get(user.username, config['max_active_per_user'])
+
+
+def project_limit(project):
+    if project.max_active_runs is not None:
+        return project.max_active_runs
+    return settings.PFD_BENCH_ADMISSION['max_active_per_project']
+
+
+def _over_limit(run):
+    """Why the user or the project of run cannot start one more run now, '' if they can (0: no limit)"""
+    from ..models import Run  # Import here to avoid circular imports
+
+    active = Run.objects.filter(status__in=ACTIVE_STATUSES, batch__isnull=True).exclude(pk=run.pk)
+
+    limit = user_limit(run.created_by)
+    if limit and active.filter(created_by=run.created_by).count() >= limit:
+        return f"You have reached your limit of {limit} runs in progress"
+
+    limit = project_limit(run.project)
+    if limit and active.filter(project=run.project).count() >= limit:
+        return f"This project has reached its limit of {limit} runs in progress"
+
+    return ""
+
+
+def admit(run, now=None):
+    """
+    Decide whether run, not queued yet, starts now: sets its admission, its status ('pending', or
+    'scheduled' if deferred) and scheduled_for, without saving it.
+    Returns the decision: 'accepted', 'accepted_eta' or 'deferred'
+    """
+    config = settings.PFD_BENCH_ADMISSION
+    now = now or timezone.now()
+    run.status, run.scheduled_for = 'pending', None
+
+    if not config['enabled']:
+        run.admission = {"decision": "accepted", "at": time.time()}
+        return "accepted"
+
+    try:
+        depths = queue_depths()
+        eta_s = estimated_wait_s(depths)
+    except redis.RedisError as e:
+        logger.warning(f"Wait of run {run.id} not estimated: {str(e)}")
+        depths, eta_s = {}, None
+
+    decision, reason = "accepted", _over_limit(run)
+    if reason:
+        decision = "deferred"
+    elif eta_s is not None and eta_s > config['max_wait_s'] and not in_window(now):
+        decision = "deferred"
+        reason = f"The workers are busy (about {eta_s / 60:.0f} min of work queued)"
+        run.scheduled_for = next_window_start(now)
+    elif eta_s is not None and eta_s > config['eta_notice_s']:
+        decision = "accepted_eta"
+
+    if decision == "deferred":
+        run.status = 'scheduled'
+    run.admission = {"decision": decision, "reason": reason, "eta_s": eta_s, "queues": depths, "at": time.time()}
+    logger.info(f"Run {run.id} {decision}: wait {eta_s if eta_s is None else round(eta_s)}s, queues {depths}"
+                + (f", {reason}" if reason else ""))
+    return decision
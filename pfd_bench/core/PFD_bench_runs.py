@@ -1,35 +1,100 @@
 import json
+import contextlib
 import tempfile
 import os
+import time
 
 import logging
+from django.conf import settings
 from django.utils import timezone
 
 ## logger instance for this module
 logger = logging.getLogger(__name__)
 
 
-def pfd_bench_run_step_1(run_id):
+def save_node_artifacts(run, step, node_artifacts, speculative=False, input_hash=""):
     """
-    Prepares the input for and runs the first graph in the PFD bench workflow:
+    Store the per-node artifacts collected in the graph state as a new version for this step of the run,
+    and their token usage on the run, next to the pre-flight estimate
+
+    Speculative artifacts (step 2 during the review) leave the run untouched until they are used
+    """
+
+    from ..models import RunArtifact  # Import here to avoid circular imports
+    from .PFD_preflight import usage_summary
+
+    version = RunArtifact.next_version(run, step)
+
+    RunArtifact.objects.bulk_create([
+        RunArtifact(run=run, step=step, version=version, speculative=speculative, input_hash=input_hash, **artifact)
+        for artifact in node_artifacts
+    ])
+
+    if not speculative:
+        run.token_usage = {**run.token_usage, f"step_{step}": usage_summary(node_artifacts)}
+        run.save(update_fields=['token_usage'])
+
+    total_tokens = sum((a["input_tokens"] or 0) + (a["output_tokens"] or 0) for a in node_artifacts)
+    logger.info(f"Saved {len(node_artifacts)} step {step} artifacts (v{version}, {total_tokens} tokens) for run {run.id}")
+
+
+def save_results(run, while_status, **fields):
+    """
+    Save the results fields of run, only if it is still in while_status: a run cancelled in the
+    meantime stays cancelled, and RunCancelled is raised instead
+    """
+
+    from ..models import Run  # Import here to avoid circular imports
+    from .PFD_cancellation import RunCancelled
+
+    if not Run.objects.filter(pk=run.pk, status=while_status).update(**fields):
+        raise RunCancelled(f"Run {run.pk} left {while_status} before its results were saved")
+    for name, value in fields.items():
+        setattr(run, name, value)
+
+
+def pfd_bench_run_step_1(run_id, cassette_mode=None, replay_timing=None):
+    """
+    Runs the first graph in the PFD bench workflow, in one go: the extraction, then the LLM calls.
+    The Celery tasks chain the two parts instead, on the CPU and the I/O queue
+
+    cassette_mode / replay_timing override PFD_BENCH_CASSETTE_MODE / PFD_BENCH_CASSETTE_REPLAY_TIMING
+    """
+    from .PFD_coalescing import LeaderComputing
+
+    dxf_extract = pfd_bench_extract_step_1(run_id)
+    while True:
+        try:
+            return pfd_bench_llm_step_1(run_id, dxf_extract, cassette_mode, replay_timing)
+        except LeaderComputing as e:
+            time.sleep(e.retry_in_s)  # no task to queue again: wait for the leader here
+
+
+def pfd_bench_extract_step_1(run_id):
+    """
+    CPU-bound part of step 1:
     1) extracts the schema we defined from the raw .dxf file
-    2) sends it to the graph as initial state and invoke
-    3) saves results in the database, including the status
+    2) routes the models and plans the prompts (pre-flight)
+
+    Returns the encoded extract for pfd_bench_llm_step_1, or None if the run failed its pre-flight
     """
 
     from ..models import Run  # Import here to avoid circular imports
     from .PFD_utils import extract_dxf_schema_v2
-    from .PFD_bench_setup import pfd_bench_st1_setup
+    from .PFD_bench_setup import extract_features, route_models
+    from .PFD_preflight import preflight_step_1, encode_extract, PreflightError
 
     # Load the run
     run = Run.objects.get(pk=run_id)
-    
+    if run.status == 'cancelled':
+        logger.info(f"Run {run_id} was cancelled before step 1")
+        return None
+
     # Update status
     run.status = 'processing'
     run.processing_started_at = timezone.now()
     run.save()
 
-
     # Extract DXF schema
     temp_file_path = None
 
@@ -48,87 +113,437 @@ def pfd_bench_run_step_1(run_id):
         logger.info(f"Processing file {run.file.name} for run {run_id}")
 
         dxf_extract_dict = extract_dxf_schema_v2(dxf_path)
-        dxf_extract = json.dumps(dxf_extract_dict, indent=2, default=str)
-        
-        # Initialize and run the graph
-        graph = pfd_bench_st1_setup()
-        initial_state = {"dxf_extract": dxf_extract, "messages": []}
-        
-        # Run the graph
-        result = graph.invoke(initial_state)
-        
-        # Extract the table data from the result
-        corrected_table = result.get('corrected_equipment_table')
-        
-        # Convert to list of dicts for JSON storage
-        table_data = []
-        for row in corrected_table.rows:
-            table_data.append({
-                "tag": row.tag,
-                "equipment_type": row.equipment_type,
-                "inlet_streams": row.inlet_streams,
-                "inlet_count": row.inlet_count,
-                "outlet_streams": row.outlet_streams,
-                "outlet_count": row.outlet_count,
-                "remarks": row.remarks
-            })
-        
-        # Update run with results
-        run.generated_table = table_data
-        run.status = 'ready_for_review'
-        run.processing_completed_at = timezone.now()
-        run.save()
 
-    except Exception as e:
-        logger.error(f"Error in step 1 of processing run {run_id}: {str(e)}")
+        # Route each role to a model sized for this drawing, then check that every node fits
+        # its model before calling any (compact encoding or larger model if needed)
+        features = extract_features(dxf_extract_dict, encode_extract(dxf_extract_dict))
+        model_route = route_models(features, "step_1")
+        try:
+            dxf_extract, model_route, token_estimate = preflight_step_1(
+                dxf_extract_dict, features["equipment_count"], model_route,
+                settings.PFD_BENCH_WORKER_ENSEMBLE_SIZE)
+        except PreflightError as e:
+            # retrying cannot help, fail the run now
+            logger.error(f"Pre-flight of step 1 failed for run {run_id}: {str(e)}")
+            run.status = 'failed'
+            run.processing_error = str(e)
+            run.processing_completed_at = timezone.now()
+            run.save()
+            return None
+
+        run.model_route = {**run.model_route, "step_1": {"features": features, "routes": model_route}}
+        run.token_estimate = {**run.token_estimate, "step_1": token_estimate}
+        run.save(update_fields=['model_route', 'token_estimate'])
+        logger.info(f"Run {run_id} step 1 routed to {model_route} ({features}), "
+                    f"estimated {token_estimate['total_input_tokens']} input tokens ({token_estimate['encoding']})")
 
     finally:
         # Clean up temp file if we created one
         if temp_file_path and os.path.exists(temp_file_path):
             os.unlink(temp_file_path)
 
-    return
+    return dxf_extract
+
+
+def pfd_bench_llm_step_1(run_id, dxf_extract, cassette_mode=None, replay_timing=None):
+    """
+    I/O-bound part of step 1, on the extract of pfd_bench_extract_step_1:
+    1) sends it to the graph as initial state and invoke (or resumes the graph from its checkpoint)
+    2) saves results in the database, including the status
+    unless the same drawing is already in step 1 on the same pipeline: then the run copies the table
+    of that one, and raises LeaderComputing until it is ready (see PFD_coalescing)
+
+    cassette_mode / replay_timing override PFD_BENCH_CASSETTE_MODE / PFD_BENCH_CASSETTE_REPLAY_TIMING
+    """
+
+    from ..models import Run  # Import here to avoid circular imports
+    from .PFD_checkpoints import prune_checkpoints
+    from .PFD_coalescing import coalescing_enabled, coalesce_key, pipeline_config_hash, lead_or_follow
+    from .PFD_preflight import usage_summary
+    from .PFD_cancellation import RunCancelled
+
+    if dxf_extract is None:
+        return  # the run failed its pre-flight, or was cancelled
+
+    # Load the run
+    run = Run.objects.get(pk=run_id)
+    if run.status == 'cancelled':
+        logger.info(f"Run {run_id} was cancelled before its LLM calls")
+        return
+    model_route = run.model_route.get("step_1", {}).get("routes", {})
+
+    # The same drawing on the same pipeline already in step 1: wait for its table instead of computing it again
+    lease = None
+    if coalescing_enabled(cassette_mode):
+        key = coalesce_key(run.file.file_hash,
+                           pipeline_config_hash(model_route, run.token_estimate.get("step_1", {}).get("encoding")))
+        lease, leader = lead_or_follow(key, run_id)  # raises LeaderComputing while the leader computes
+        if leader is not None:
+            logger.info(f"Step 1 of run {run_id} coalesced with run {leader.id}")
+            run.generated_table = leader.generated_table
+            run.coalesced_from = leader
+            run.token_usage = {**run.token_usage, "step_1": usage_summary([])}
+            run.status = 'ready_for_review'
+            run.processing_completed_at = timezone.now()
+            run.save()
+            prune_checkpoints(run_id, "step_1")  # of an earlier attempt as leader, if any
+            return
+
+    try:
+        with lease or contextlib.nullcontext():
+            _llm_step_1(run, dxf_extract, model_route, cassette_mode, replay_timing)
+
+    except RunCancelled:
+        logger.info(f"Step 1 of run {run_id} stopped: the run was cancelled")
+        prune_checkpoints(run_id, "step_1")
+        raise
+
+    except Exception as e:
+        logger.error(f"Error in step 1 of processing run {run_id}: {str(e)}")
+        # let the task retry; the checkpoints of the completed nodes are kept for the resume
+        raise
+
+
+def _llm_step_1(run, dxf_extract, model_route, cassette_mode=None, replay_timing=None):
+    """The graph of step 1 for run (resumed from its checkpoint if any), its results saved on the run"""
+
+    from .PFD_bench_setup import get_st1_graph
+    from .PFD_cassettes import get_cassette
+    from .PFD_checkpoints import get_checkpointer, checkpoint_thread_id, prune_checkpoints
+    from .PFD_cancellation import invoke_cancellable
+
+    run_id = run.id
+
+    graph = get_st1_graph(ensemble_size=settings.PFD_BENCH_WORKER_ENSEMBLE_SIZE, checkpointer=get_checkpointer())
+    cassette = get_cassette(run_id, "step_1", cassette_mode, replay_timing)
+    # the models the extraction routed the run to (kept by an interrupted attempt on resume)
+    config = {"configurable": {"thread_id": checkpoint_thread_id(run_id, "step_1"),
+                               "cassette": cassette,
+                               "model_route": model_route}}
+
+    # A previous attempt (e.g. a Celery retry) may have stopped mid-graph: resume from its last node
+    snapshot = graph.get_state(config) if graph.checkpointer else None
+
+    try:
+        if snapshot and snapshot.next:
+            logger.info(f"Resuming step 1 of run {run_id} at {', '.join(snapshot.next)}")
+            if cassette:
+                cassette.resume_recording()  # the calls before the interruption are not made again
+            result = invoke_cancellable(graph, None, config, run_id)
+
+        else:
+            if snapshot and snapshot.values:
+                # leftovers of a finished attempt that could not be pruned, start over
+                prune_checkpoints(run_id, "step_1")
+
+            initial_state = {"dxf_extract": dxf_extract, "messages": []}
+
+            # Run the graph, until its end or the cancellation of the run
+            result = invoke_cancellable(graph, initial_state, config, run_id)
+
+    finally:
+        # also after a failure: its calls are checkpointed, a resume will not make them again
+        if cassette:
+            cassette.save()
+
+    # Extract the table data from the result
+    corrected_table = result.get('corrected_equipment_table')
+
+    # Convert to list of dicts for JSON storage
+    table_data = []
+    for row in corrected_table.rows:
+        table_data.append({
+            "tag": row.tag,
+            "equipment_type": row.equipment_type,
+            "inlet_streams": row.inlet_streams,
+            "inlet_count": row.inlet_count,
+            "outlet_streams": row.outlet_streams,
+            "outlet_count": row.outlet_count,
+            "remarks": row.remarks
+        })
+
+    save_node_artifacts(run, 1, result.get('node_artifacts', []))
+
+    # Update run with results, unless it was cancelled since the end of the graph
+    save_results(run, 'processing', generated_table=table_data, status='ready_for_review',
+                 processing_completed_at=timezone.now())
+
+    prune_checkpoints(run_id, "step_1")
+
+
+def plan_step_2(table_rows, connectivity_table, node_name="generator_node", sections=None, parts=None):
+    """
+    Model route and pre-flight token estimate of step 2 for a connectivity table (of table_rows).
+    For the regenerator, sections is the number of sections to rewrite; for the map-reduce
+    generation, parts are the parts of the process (see map_reduce_plan).
+    Returns the features, the model route and the estimate; raises PreflightError
+    """
+
+    from .PFD_bench_setup import table_features, route_models
+    from .PFD_preflight import preflight_step_2
+
+    features = table_features(table_rows, connectivity_table)
+    model_route = route_models(features, "step_2")
+    model_route, token_estimate = preflight_step_2(connectivity_table,
+                                                   features["equipment_count"] if sections is None else sections,
+                                                   model_route, node_name, parts)
 
+    return features, model_route, token_estimate
 
-def pfd_bench_run_step_2(run_id):
+
+def map_reduce_plan(run):
+    """
+    For a large table (PFD_BENCH_MAP_REDUCE['min_rows'] rows or more): the parts of the process whose
+    sections are generated in parallel, each with the table of its equipment and their direct neighbours.
+    None if the description is generated in one call
+    """
+
+    from .PFD_bench_setup import partition_table, context_tags
+
+    current_table = run.final_equipment_table
+    map_reduce = settings.PFD_BENCH_MAP_REDUCE
+    if not map_reduce['enabled'] or len(current_table) < map_reduce['min_rows']:
+        return None
+
+    partition = partition_table(current_table, map_reduce['section_rows'])
+    if len(partition) < 2:
+        return None
+
+    return [{"index": index,
+             "tags": tags,
+             "connectivity_table": run.final_table_for_node("section_generator_node",
+                                                            title=f"Part {index + 1} of {len(partition)} and Neighbours",
+                                                            only_tags=context_tags(current_table, tags))}
+            for index, tags in enumerate(partition)]
+
+
+def incremental_plan(run, cassette_mode=None):
+    """
+    For a reopened run whose description was generated before: the sections to rewrite
+    (the edited equipment and its neighbours) and the rows the regenerator needs to see.
+    None if the description must be generated from scratch (first time, too many changes, or
+    cassettes on: a recorded or replayed step 2 makes all its calls)
+    """
+
+    from .PFD_bench_setup import description_changes, context_tags
+
+    previous = run.generated_sections
+    if not previous or not settings.PFD_BENCH_INCREMENTAL['enabled'] \
+            or (cassette_mode or settings.PFD_BENCH_CASSETTE_MODE) != 'off':
+        return None
+
+    current_table = run.final_equipment_table
+    regenerate_tags, removed_tags = description_changes(previous["table"], current_table)
+    if len(regenerate_tags) > settings.PFD_BENCH_INCREMENTAL['max_fraction'] * len(current_table):
+        logger.info(f"Run {run.id}: {len(regenerate_tags)} of {len(current_table)} sections changed, full regeneration")
+        return None
+
+    return {"regenerate_tags": regenerate_tags,
+            "removed_tags": removed_tags,
+            "context_tags": context_tags(current_table, regenerate_tags),
+            "table_tags": [row["tag"] for row in current_table]}
+
+
+def pfd_bench_run_step_2(run_id, cassette_mode=None, replay_timing=None):
     """
     Based on a (reviewed) connectivity table, prepares the process description
+
+    If a speculation ran on the same table during the review, its description is used instead.
+    For a reopened run, only the sections of the edited equipment and its neighbours are rewritten;
+    a large table is described part by part, in parallel (map-reduce)
+
+    cassette_mode / replay_timing override PFD_BENCH_CASSETTE_MODE / PFD_BENCH_CASSETTE_REPLAY_TIMING
     """
 
     from ..models import Run  # Import here to avoid circular imports
-    from .PFD_bench_setup import pfd_bench_st2_setup
+    from .PFD_bench_setup import get_st2_graph, GeneratorOutput, render_description, splice_sections
+    from .PFD_preflight import PreflightError, usage_summary
+    from .PFD_cassettes import get_cassette
+    from .PFD_streaming import DescriptionStream, streaming_enabled
+    from .PFD_speculation import table_hash, speculative_artifacts, speculation_enabled
+    from .PFD_table_serializer import table_format
+    from .PFD_cancellation import invoke_cancellable
+    from .PFD_circuit_breaker import CircuitOpen
 
     # Load the run
     run = Run.objects.get(pk=run_id)
     
-    # Update status
-    run.status = 'processing'
+    # Update status; the run stays in generating_description, where run_completed shows the live text
+    run.status = 'generating_description'
     run.processing_started_at = timezone.now()
     run.save()
 
+    stream = DescriptionStream(run_id) if streaming_enabled() else None
+
     try:
 
-        # Initialize and run the graph
-        graph = pfd_bench_st2_setup()
-
-        connectivity_table_md = run.final_table_to_markdown()
-        
-        initial_state = {"connectivity_table": connectivity_table_md, "messages": []}
-        
-        # Run the graph
-        result = graph.invoke(initial_state)
-        
-        # Extract the table data from the result
-        process_description = result.get('process_description')
-        
-
-        # Update run with results
-        run.generated_text = process_description
-        run.status = 'completed'
-        run.processing_completed_at = timezone.now()
-        run.save()
+        current_table = run.final_equipment_table
+        connectivity_table = run.final_table_for_node("generator_node")
+        incremental = incremental_plan(run, cassette_mode)
+        parts = None if incremental else map_reduce_plan(run)
+
+        if incremental and not incremental["regenerate_tags"]:
+            # nothing the description depends on changed: no model call
+            previous = run.generated_sections
+            sections = splice_sections(previous["sections"], [], incremental["table_tags"])
+            description = {"introduction": previous["introduction"], "sections": sections}
+            process_description = render_description(description["introduction"], sections)
+            mode = "unchanged"
+
+        else:
+            if incremental:
+                context = incremental["context_tags"]
+                llm_node = "regenerator_node"
+                llm_table = run.final_table_for_node(llm_node, title="Edited Equipment and Neighbours", only_tags=context)
+                plan = ([row for row in current_table if row.get("tag") in context], llm_table,
+                        llm_node, len(incremental["regenerate_tags"]))
+            else:
+                llm_node = "section_generator_node" if parts else "generator_node"
+                llm_table = connectivity_table
+                plan = (current_table, llm_table, "generator_node", None, parts)
+
+            try:
+                features, model_route, token_estimate = plan_step_2(*plan)
+            except PreflightError as e:
+                logger.error(f"Pre-flight of step 2 failed for run {run_id}: {str(e)}")
+                run.status = 'failed'
+                run.processing_error = str(e)
+                run.processing_completed_at = timezone.now()
+                run.save()
+                if stream:
+                    stream.fail(e)
+                return
+
+            run.model_route = {**run.model_route, "step_2": {"features": features, "routes": model_route}}
+            # the table format is kept with the estimate, for table_format_report
+            run.token_estimate = {**run.token_estimate, "step_2": {**token_estimate, "table_format": table_format(llm_node)}}
+            run.save(update_fields=['model_route', 'token_estimate'])
+            logger.info(f"Run {run_id} step 2 routed to {model_route} ({features}), "
+                        f"estimated {token_estimate['total_input_tokens']} input tokens ({table_format(llm_node)} table)")
+
+            # a speculation on this very table makes the generation unnecessary
+            current_hash = table_hash(connectivity_table)
+            speculation, waited_s = (speculative_artifacts(run, current_hash)
+                                     if speculation_enabled(cassette_mode) and not incremental else (None, 0.0))
+            speculations = run.artifacts.filter(step=2, speculative=True).values('version').distinct().count()
+
+            if speculation:
+                # the stitch of a map-reduce speculation holds the whole description
+                generator = next(artifact for artifact in speculation if artifact.node in ("generator_node", "stitch_node"))
+                output = GeneratorOutput.model_validate(generator.payload)
+                description, process_description = output.model_dump(mode="json"), output.to_text()
+                run.token_usage = {**run.token_usage, "step_2": usage_summary([
+                    {"node": a.node, "model_id": a.model_id, "input_tokens": a.input_tokens,
+                     "output_tokens": a.output_tokens} for a in speculation])}
+                run.speculation = {"outcome": "hit", "table_hash": current_hash, "speculations": speculations,
+                                   "waited_s": round(waited_s, 3)}
+                mode = "speculative"
+                logger.info(f"Run {run_id} step 2: speculation hit (waited {waited_s:.1f}s)")
+
+            else:
+                # Initialize and run the graph
+                graph = get_st2_graph(incremental=bool(incremental), map_reduce=bool(parts))
+
+                initial_state = {"connectivity_table": llm_table, "messages": []}
+                if parts:
+                    initial_state["parts"] = parts
+                if incremental:
+                    previous = run.generated_sections
+                    initial_state.update({"previous_description": {"introduction": previous["introduction"],
+                                                                   "sections": previous["sections"]},
+                                          "regenerate_tags": incremental["regenerate_tags"],
+                                          "context_tags": incremental["context_tags"],
+                                          "table_tags": incremental["table_tags"]})
+                cassette = get_cassette(run_id, "step_2", cassette_mode, replay_timing)
+                
+                # Run the graph
+                try:
+                    result = invoke_cancellable(graph, initial_state, {"configurable": {"cassette": cassette,
+                                                                                        "model_route": model_route,
+                                                                                        "stream": stream}}, run_id)
+                finally:
+                    # also after a failure: the calls made until then are kept for the replay
+                    if cassette:
+                        cassette.save()
+                
+                # Extract the table data from the result
+                process_description = result.get('process_description')
+                description = result.get('description')
+                mode = "incremental" if incremental else "map_reduce" if parts else "full"
+
+                save_node_artifacts(run, 2, result.get('node_artifacts', []), input_hash=current_hash)
+                if speculations and not incremental:
+                    run.speculation = {"outcome": "miss", "table_hash": current_hash, "speculations": speculations}
+                    logger.info(f"Run {run_id} step 2: speculation miss ({speculations} discarded)")
+
+        if incremental:
+            logger.info(f"Run {run_id} step 2: {len(incremental['regenerate_tags'])} of "
+                        f"{len(description['sections'])} sections rewritten")
+        elif parts:
+            logger.info(f"Run {run_id} step 2: {len(description['sections'])} sections generated in {len(parts)} parts")
+
+        # Update run with results; the table the sections describe is kept for the next incremental update
+        save_results(run, 'generating_description',
+                     generated_text=process_description,
+                     generated_sections={**description, "table": current_table, "mode": mode,
+                                         "regenerated": incremental["regenerate_tags"] if incremental else []},
+                     token_usage=run.token_usage, speculation=run.speculation,
+                     status='completed', processing_completed_at=timezone.now())
+
+        if stream:
+            stream.finish(process_description)
+
+    except CircuitOpen:
+        raise  # the run waits for its provider, the page keeps waiting for the description
 
     except Exception as e:
         logger.error(f"Error in step 2 of processing run {run_id}: {str(e)}")
+        if stream:
+            stream.fail(e)
+        raise
     
     return
+
+
+def pfd_bench_speculate_step_2(run_id, speculated_hash):
+    """
+    Speculative step 2 during the review: generate the description of the table hashed in
+    speculated_hash and keep its artifacts for the finalize. The run itself is not touched
+    (the reviewer is editing it); nothing is done if the table changed in the meantime.
+    Like step 2, the graph beats for the run and stops on RunCancelled if the run is cancelled
+    """
+
+    from ..models import Run  # Import here to avoid circular imports
+    from .PFD_bench_setup import get_st2_graph
+    from .PFD_preflight import PreflightError
+    from .PFD_speculation import table_hash, release_speculation
+    from .PFD_cancellation import invoke_cancellable
+
+    try:
+        run = Run.objects.get(pk=run_id)
+        connectivity_table = run.final_table_for_node("generator_node")
+
+        if run.status not in ['ready_for_review', 'under_review', 'draft'] \
+                or table_hash(connectivity_table) != speculated_hash:
+            logger.info(f"Run {run_id}: table changed since the speculation was requested, skipped")
+            return
+
+        parts = map_reduce_plan(run)
+        try:
+            features, model_route, token_estimate = plan_step_2(run.final_equipment_table, connectivity_table,
+                                                                parts=parts)
+        except PreflightError as e:
+            logger.info(f"Run {run_id}: no speculation, {str(e)}")
+            return
+
+        initial_state = {"connectivity_table": connectivity_table, "messages": []}
+        if parts:
+            initial_state["parts"] = parts
+        graph = get_st2_graph(map_reduce=bool(parts))
+        result = invoke_cancellable(graph, initial_state, {"configurable": {"model_route": model_route}}, run_id)
+
+        save_node_artifacts(run, 2, result.get('node_artifacts', []), speculative=True, input_hash=speculated_hash)
+        logger.info(f"Run {run_id}: speculative step 2 ready on table {speculated_hash[:12]}")
+
+    finally:
+        release_speculation(run_id, speculated_hash)
@@ -1,17 +1,27 @@
 
+import re
+import time
+import asyncio
+import hashlib
 import operator
 import logging
 
+from collections import Counter, deque
 from typing import (List, Optional, TypedDict, 
-                    Annotated
+                    Annotated, Dict, Tuple
                     )
 
 from pydantic import BaseModel, Field
 
+from django.conf import settings
+from django.utils.module_loading import import_string
+
 from langchain.chat_models import init_chat_model
+from langchain_core.runnables import RunnableConfig
 
-from langgraph.graph import StateGraph, END
+from langgraph.graph import StateGraph, START, END
 from langgraph.graph import add_messages
+from langgraph.types import Send
 
 
 
@@ -19,8 +29,19 @@ from langgraph.graph import add_messages
 
 from .PFD_prompt_templates import (PFD_extraction_worker_system_prompt, 
                                    PFD_extraction_auditor_system_prompt,
-                                   PFD_generator_system_prompt
+                                   PFD_generator_system_prompt,
+                                   PFD_regenerator_system_prompt,
+                                   PFD_section_generator_system_prompt,
+                                   PFD_stitcher_system_prompt
                                    )
+from .PFD_hedging import call_with_hedging
+from .PFD_rate_limiter import call_with_capacity
+from .PFD_circuit_breaker import call_with_breaker
+from .PFD_http_clients import transport_kwargs, share_transport, run_coroutine, call_deadline_s
+from .PFD_cancellation import check_cancelled
+from .PFD_heartbeats import beat
+from .PFD_utils import estimate_tokens
+from .PFD_table_serializer import serialize_table, table_format
 
 
 
@@ -56,25 +77,11 @@ class EquipmentTable(BaseModel):
 
     def to_markdown(self) -> str:
         """Convert table back to markdown format"""
+        return self.serialize('markdown')
 
-        lines = []
-        
-        # Add title if present
-        if self.title:
-            lines.append(f"### {self.title}\n")
-        
-        # Header
-        lines.append("| Tag | Equipment type | Inlet streams | Inlet count | Outlet streams | Outlet count | Remarks |")
-        lines.append("|---|---|---|---|---|---|---|")
-        
-        # Rows
-        for row in self.rows:
-            lines.append(
-                f"| {row.tag} | {row.equipment_type} | {row.inlet_streams} | "
-                f"{row.inlet_count} | {row.outlet_streams} | {row.outlet_count} | {row.remarks} |"
-            )
-        
-        return "\n".join(lines)
+    def serialize(self, table_format='markdown') -> str:
+        """The table in one of the formats of PFD_table_serializer.py"""
+        return serialize_table(self.rows, table_format, title=self.title)
 
 
 # classes that only the auditor needs
@@ -123,9 +130,43 @@ class AuditedEquipmentTables(BaseModel):
     corrected_equipment_table: EquipmentTable
 
 
+class DescriptionSection(BaseModel):
+    """Part of the process description about a single equipment"""
+    tag: str = Field(..., description="Tag of the equipment described in this section, as in the table")
+    heading: str = Field(..., description="Process section the equipment belongs to (e.g. 'Feed Preparation')")
+    text: str = Field(..., description="Description of the equipment: its purpose and how its streams flow")
+
+
 class GeneratorOutput(BaseModel):
-    """Process description generated based on the connectivity table"""
-    process_description: str = Field(..., description="Detailed process description based on the connectivity table")
+    """Process description generated based on the connectivity table, one section per equipment"""
+    introduction: str = Field(..., description="Overview of the process as a whole")
+    sections: List[DescriptionSection] = Field(..., description="One section per equipment of the table, in the order of the process flow")
+
+    def to_text(self) -> str:
+        """The flat process description"""
+        return render_description(self.introduction, [section.model_dump() for section in self.sections])
+
+
+class DescriptionSections(BaseModel):
+    """Sections of the process description rewritten after the table was edited"""
+    sections: List[DescriptionSection] = Field(..., description="One section per equipment to rewrite")
+
+
+class PartDescription(BaseModel):
+    """Sections of the process description of one part of a large process (map-reduce generation)"""
+    sections: List[DescriptionSection] = Field(..., description="One section per equipment to describe, in the order of the process flow")
+
+
+class SectionTransition(BaseModel):
+    """Sentences leading into one part of a process description written part by part"""
+    tag: str = Field(..., description="Tag of the first equipment of the part this transition opens")
+    text: str = Field(..., description="One or two sentences linking the previous parts to this one")
+
+
+class StitchOutput(BaseModel):
+    """What a process description written part by part needs to read as one"""
+    introduction: str = Field(..., description="Overview of the process as a whole")
+    transitions: List[SectionTransition] = Field(..., description="One transition per part after the first")
 
 
 
@@ -137,53 +178,392 @@ class ExtrationState(TypedDict):
     equipment_table: EquipmentTable
     audit_findings: AuditFindingsTable
     corrected_equipment_table: EquipmentTable
+    # ensemble mode only
+    worker_samples: Annotated[List[EquipmentTable], operator.add]  # one entry per parallel worker call
+    disputed_tags: List[str]  # rows without a majority among the samples, the only ones the auditor sees
+    ensemble_disputes: Dict[str, Dict[str, List[str]]]  # tag -> column -> candidate values
+    node_artifacts: Annotated[list, operator.add]  # output, model, prompt version, tokens and wall time per node call
 
 class GenerationState(TypedDict):
     messages: Annotated[list, add_messages]  # communication with the LLM...
-    connectivity_table: str  # the table that step 1 generates, in markdown format
+    connectivity_table: str  # the table that step 1 generates (after review), in the table format of the node
     process_description: str # the process description
+    description: dict  # the same, structured: introduction and one section per equipment
+    # incremental regeneration only
+    previous_description: dict  # the description to update (introduction, sections)
+    regenerate_tags: List[str]  # equipment whose section is rewritten
+    context_tags: List[str]  # the same and their direct neighbours: the rows of connectivity_table
+    table_tags: List[str]  # all equipment of the table, in order (where new sections go)
+    # map-reduce generation only
+    parts: List[dict]  # process sections generated in parallel: index, tags, their table (with neighbours)
+    part_sections: Annotated[list, operator.add]  # index and sections of each generated part
+    node_artifacts: Annotated[list, operator.add]  # output, model, prompt version, tokens and wall time per node call
+
+
+################################################################
+# Models used by the agents
+PFD_WORKER_MODEL = "google_genai:gemini-2.5-pro"
+PFD_AUDITOR_MODEL = "google_genai:gemini-2.5-pro"
+PFD_GENERATOR_MODEL = "openai:gpt-4o"
+
+################################################################
+# Model routing - pick the model of each role from pre-flight features of the input
+# Roles of the nodes; the routes of a role are configured in PFD_BENCH_MODEL_ROUTES
+NODE_ROLES = {"worker_node": "worker", "worker_sample_node": "worker",
+              "auditor_node": "auditor", "disputed_auditor_node": "auditor",
+              "generator_node": "generator", "regenerator_node": "generator",
+              "section_generator_node": "generator", "stitch_node": "generator"}
+DEFAULT_ROLE_MODELS = {"worker": PFD_WORKER_MODEL, "auditor": PFD_AUDITOR_MODEL, "generator": PFD_GENERATOR_MODEL}
+STEP_ROLES = {"step_1": ["worker", "auditor"], "step_2": ["generator"]}
+
+
+def _is_equipment_block(block):
+    """Tagged blocks that are not flow arrows (same rule as the arrow detection of the extraction)"""
+    block_name = block.get("block_name", "").lower()
+    return bool(block.get("attributes")) and 'arrow' not in block_name and 'flow' not in block_name
+
+
+def extract_features(dxf_extract_dict, dxf_extract: str) -> dict:
+    """Pre-flight features of a dxf extract (step 1): entity count, equipment count and estimated tokens"""
+    entities = dxf_extract_dict.get("entities", {})
+    return {"entity_count": sum(len(items) for items in entities.values()),
+            "equipment_count": sum(1 for block in entities.get("blocks", []) if _is_equipment_block(block)),
+            "estimated_tokens": estimate_tokens(dxf_extract)}
+
+
+def table_features(table_rows, connectivity_table: str) -> dict:
+    """Pre-flight features of a connectivity table (step 2)"""
+    return {"entity_count": len(table_rows),
+            "equipment_count": len(table_rows),
+            "estimated_tokens": estimate_tokens(connectivity_table)}
+
+
+def route_models(features: dict, step: str) -> dict:
+    """
+    Pick the model of each role of a step: the first route of the role whose limits
+    (max_entities, max_equipment, max_tokens; missing = no limit) all hold for the features.
+    Returns role -> {"route": name, "model": model_id}, the default model if no route matches
+    or routing is off (PFD_BENCH_MODEL_ROUTING_ENABLED)
+    """
+    limits = {"max_entities": "entity_count", "max_equipment": "equipment_count", "max_tokens": "estimated_tokens"}
+    routes = settings.PFD_BENCH_MODEL_ROUTES if settings.PFD_BENCH_MODEL_ROUTING_ENABLED else {}
+    routing = {}
+
+    for role in STEP_ROLES[step]:
+        routing[role] = {"route": "default", "model": DEFAULT_ROLE_MODELS[role]}
+        for route in routes.get(role, []):
+            if all(features[feature] <= route[limit] for limit, feature in limits.items() if limit in route):
+                routing[role] = {"route": route["name"], "model": route["model"]}
+                break
+
+    return routing
+
+
+def routed_model(node_name, config:Optional[RunnableConfig]=None) -> str:
+    """Model of a node for this run (configurable 'model_route'), the default model of its role otherwise"""
+    role = NODE_ROLES[node_name]
+    model_route = ((config or {}).get("configurable") or {}).get("model_route") or {}
+    return model_route.get(role, {}).get("model") or DEFAULT_ROLE_MODELS[role]
 
 
 ################################################################
 # Singletons - create only once and share across functions
-# Global variable to cache them
-_pfd_worker_agent = None
-_pfd_auditor_agent = None
-_pfd_generator_agent = None
+# Global variable to cache them, one structured agent per (model, output schema)
+_structured_agents = {}
+
+def _init_chat_model(model, temperature):
+    """
+    Create the chat model for the provider selected with PFD_BENCH_LLM_PROVIDER:
+    'live' (the real providers), 'offline' (local stand-in, no network) 
+    or the dotted path of a factory called as factory(model, temperature=...)
+    """
+    provider = settings.PFD_BENCH_LLM_PROVIDER
+
+    if provider == 'live':
+        # all chat models of a provider share the connection pool of this process
+        kwargs = transport_kwargs(model)
+        if model.startswith("openai:"):
+            kwargs["stream_usage"] = True  # token usage of the streamed calls as well
+        llm = init_chat_model(model, temperature=temperature, **kwargs)
+        return share_transport(llm, model)
+
+    if provider == 'offline':
+        from .PFD_offline_provider import OfflineChatModel
+        return OfflineChatModel(model, **settings.PFD_BENCH_OFFLINE_PROVIDER)
+
+    return import_string(provider)(model, temperature=temperature)
+
+
+def get_structured_agent(model_id, schema):
+    """Get or create the agent answering with schema on model_id"""
+    key = (model_id, schema.__name__)
+
+    if key not in _structured_agents:
+        llm = _init_chat_model(model_id, temperature=1)
+        _structured_agents[key] = llm.with_structured_output(schema, include_raw=True)
+        logger.info(f"Created new {schema.__name__} agent instance on {model_id}")
+
+    return _structured_agents[key]
+
 
 def get_pfd_worker_agent():
     """Get or create the pfd agents"""
-    global _pfd_worker_agent
-    
-    if _pfd_worker_agent is None:
-        llm = init_chat_model("google_genai:gemini-2.5-pro", temperature=1)
-        _pfd_worker_agent = llm.with_structured_output(EquipmentTable)
-        logger.info("Created new _pfd_worker_agent instance")
-    
-    return _pfd_worker_agent
+    return get_structured_agent(PFD_WORKER_MODEL, EquipmentTable)
 
 def get_pfd_auditor_agent():
     """Get or create the pfd agents"""
-    global _pfd_auditor_agent
-    
-    if _pfd_auditor_agent is None:
-        llm = init_chat_model("google_genai:gemini-2.5-pro", temperature=1)
-        _pfd_auditor_agent = llm.with_structured_output(AuditedEquipmentTables)
-        logger.info("Created new _pfd_auditor_agent instance")
-    
-    return _pfd_auditor_agent
+    return get_structured_agent(PFD_AUDITOR_MODEL, AuditedEquipmentTables)
 
 
 def get_pfd_generator_agent():
     """Get or create the pfd agents"""
-    global _pfd_generator_agent
-    
-    if _pfd_generator_agent is None:
-        llm = init_chat_model("openai:gpt-4o", temperature=1)
-        _pfd_generator_agent = llm.with_structured_output(GeneratorOutput)
-        logger.info("Created new _pfd_generator_agent instance")
-    
-    return _pfd_generator_agent
+    return get_structured_agent(PFD_GENERATOR_MODEL, GeneratorOutput)
+
+
+
+###################################################################
+# Ensemble reconciliation
+###################################################################
+
+# columns that decide whether the worker samples agree on a row; remarks are free text and only voted on
+ENSEMBLE_VOTE_COLUMNS = ["equipment_type", "inlet_streams", "inlet_count", "outlet_streams", "outlet_count"]
+
+
+def _normalize_cell(value) -> str:
+    """Compare cells ignoring case and whitespace"""
+    return " ".join(str(value).lower().split())
+
+
+def reconcile_worker_samples(samples: List[EquipmentTable]) -> Tuple[EquipmentTable, Dict[str, Dict[str, List[str]]]]:
+    """
+    Tag-aligned majority vote over the worker samples.
+    Rows are aligned by tag; each cell takes the most frequent value among the samples.
+    A row is disputed if its tag, or any of the ENSEMBLE_VOTE_COLUMNS, lacks a strict majority
+    of all samples (a sample that misses the tag counts as a vote against it).
+
+    Returns the consensus table and the disputes (tag -> column -> candidate values)
+    """
+    n_samples = len(samples)
+
+    # group the rows of all samples by tag, keeping the order in which tags first appear
+    rows_by_tag = {}
+    for sample in samples:
+        seen_in_sample = set()
+        for row in sample.rows:
+            key = _normalize_cell(row.tag)
+            if key in seen_in_sample:
+                continue  # duplicated tag within one sample, the first one counts
+            seen_in_sample.add(key)
+            rows_by_tag.setdefault(key, []).append(row)
+
+    consensus_rows = []
+    disputes = {}
+
+    for rows in rows_by_tag.values():
+        row_disputes = {}
+        tag_has_majority = len(rows) * 2 > n_samples
+        if not tag_has_majority:
+            row_disputes["tag"] = [f"found in {len(rows)} of {n_samples} samples"]
+
+        consensus = {"tag": rows[0].tag}
+        for column in ENSEMBLE_VOTE_COLUMNS + ["remarks"]:
+            values = [getattr(row, column) for row in rows]
+            votes = Counter(_normalize_cell(value) for value in values)
+            winner, winner_votes = votes.most_common(1)[0]
+            # keep the original spelling of the winning value
+            consensus[column] = next(value for value in values if _normalize_cell(value) == winner)
+
+            if tag_has_majority and column in ENSEMBLE_VOTE_COLUMNS and winner_votes * 2 <= n_samples:
+                candidates = []
+                for value in values:
+                    if str(value) not in candidates:
+                        candidates.append(str(value))
+                row_disputes[column] = candidates
+
+        consensus_rows.append(EquipmentRow(**consensus))
+        if row_disputes:
+            disputes[rows[0].tag] = row_disputes
+
+    consensus_table = EquipmentTable(title="Ensemble Consensus Table", rows=consensus_rows)
+
+    return consensus_table, disputes
+
+
+def merge_audited_rows(consensus_table: EquipmentTable, disputed_tags, audited_table: EquipmentTable) -> EquipmentTable:
+    """
+    Splice the rows returned by the auditor back into the consensus table:
+    audited rows replace the consensus row with the same tag, disputed rows that the auditor
+    did not return are dropped, and equipment the auditor added is appended at the end
+    """
+    audited_by_tag = {_normalize_cell(row.tag): row for row in audited_table.rows}
+    disputed_keys = {_normalize_cell(tag) for tag in disputed_tags}
+
+    merged_rows = []
+    for row in consensus_table.rows:
+        key = _normalize_cell(row.tag)
+        if key in audited_by_tag:
+            merged_rows.append(audited_by_tag.pop(key))
+        elif key not in disputed_keys:
+            merged_rows.append(row)
+
+    merged_rows.extend(audited_by_tag.values())
+
+    return EquipmentTable(title="Final Corrected Table", rows=merged_rows)
+
+
+
+###################################################################
+# Process description sections and incremental regeneration
+###################################################################
+
+# columns of a row that its section describes; a change in any of them rewrites the section
+DESCRIPTION_COLUMNS = ["tag", "equipment_type", "inlet_streams", "inlet_count", "outlet_streams", "outlet_count", "remarks"]
+
+
+def render_description(introduction, sections) -> str:
+    """
+    Flat text of a process description: the introduction, then the sections under the heading of
+    their process section. Sections may be partial dicts (streaming): a section is shown once its
+    text has started, by then its heading is complete
+    """
+    parts = [introduction] if introduction else []
+    heading = None
+    for section in sections:
+        if "text" not in section:
+            continue
+        if section.get("heading") and section["heading"] != heading:
+            heading = section["heading"]
+            parts.append(heading)
+        if section["text"]:
+            parts.append(section["text"])
+    return "\n\n".join(parts)
+
+
+def _mentions(row, tag) -> bool:
+    """Whether the streams of a row name the equipment tag (its direct neighbour)"""
+    streams = f"{row.get('inlet_streams', '')} {row.get('outlet_streams', '')}"
+    return re.search(rf"(?<![\w-]){re.escape(str(tag))}(?![\w-])", streams, re.IGNORECASE) is not None
+
+
+def _connected(row, other) -> bool:
+    return _mentions(row, other.get("tag", "")) or _mentions(other, row.get("tag", ""))
+
+
+def description_changes(previous_table, current_table):
+    """
+    Equipment whose section must be rewritten after the table went from previous_table to current_table
+    (lists of row dicts): the edited and the new rows, plus the direct neighbours of the edited, new and
+    removed rows (before or after the edit).
+    Returns the tags to rewrite, in table order, and the removed tags
+    """
+    previous = {_normalize_cell(row.get("tag", "")): row for row in previous_table}
+    current = {_normalize_cell(row.get("tag", "")): row for row in current_table}
+
+    changed = {key for key, row in current.items()
+               if key not in previous or any(_normalize_cell(row.get(column, "")) != _normalize_cell(previous[key].get(column, ""))
+                                             for column in DESCRIPTION_COLUMNS)}
+    removed = set(previous) - set(current)
+
+    # both versions of a touched row count: an edit may add or remove a connection
+    touched_rows = [version for key in changed | removed for version in (current.get(key), previous.get(key)) if version]
+    affected = changed | {key for key, row in current.items() if any(_connected(row, touched) for touched in touched_rows)}
+
+    return ([row["tag"] for key, row in current.items() if key in affected],
+            [previous[key]["tag"] for key in removed])
+
+
+def context_tags(current_table, tags):
+    """The given tags and their direct neighbours, in table order: the rows the regenerator sees"""
+    keys = {_normalize_cell(tag) for tag in tags}
+    rows = [row for row in current_table if _normalize_cell(row.get("tag", "")) in keys]
+    return [row["tag"] for row in current_table
+            if _normalize_cell(row.get("tag", "")) in keys or any(_connected(row, other) for other in rows)]
+
+
+def splice_sections(previous_sections, new_sections, table_tags):
+    """
+    Put the rewritten sections in place of the previous ones (same tag). Sections of equipment that
+    is no longer in the table are dropped; a section of new equipment goes after the section of the
+    closest equipment before it in the table
+    """
+    table_keys = [_normalize_cell(tag) for tag in table_tags]
+    new_by_tag = {_normalize_cell(section["tag"]): section for section in new_sections}
+
+    sections = []
+    for section in previous_sections:
+        key = _normalize_cell(section["tag"])
+        if key in table_keys:
+            sections.append(new_by_tag.pop(key, section))
+
+    for key, section in new_by_tag.items():
+        position = len(sections)
+        if key in table_keys:
+            placed = [_normalize_cell(s["tag"]) for s in sections]
+            before = [k for k in table_keys[:table_keys.index(key)] if k in placed]
+            if before:
+                position = placed.index(before[-1]) + 1
+        sections.insert(position, section)
+
+    return sections
+
+
+def partition_table(table_rows, max_rows):
+    """
+    Split the equipment of a table into parts for the map-reduce generation: the connected components
+    of the stream graph (rows whose streams name one another). A component larger than max_rows is cut
+    along the flow (breadth-first from its first row); small components are grouped up to max_rows.
+    Returns lists of tags, in table order, the parts in the order of their first row
+    """
+    count = len(table_rows)
+    neighbours = [[] for _ in range(count)]
+    for i in range(count):
+        for j in range(i + 1, count):
+            if _connected(table_rows[i], table_rows[j]):
+                neighbours[i].append(j)
+                neighbours[j].append(i)
+
+    pieces, seen = [], set()
+    for first in range(count):
+        if first in seen:
+            continue
+        component, queue = [], deque([first])
+        seen.add(first)
+        while queue:
+            index = queue.popleft()
+            component.append(index)
+            for other in neighbours[index]:
+                if other not in seen:
+                    seen.add(other)
+                    queue.append(other)
+
+        chunks = -(-len(component) // max_rows)  # as even as possible
+        size = -(-len(component) // chunks)
+        pieces.extend(component[start:start + size] for start in range(0, len(component), size))
+
+    parts = []
+    for piece in sorted(pieces, key=min):
+        if parts and len(parts[-1]) + len(piece) <= max_rows:
+            parts[-1].extend(piece)
+        else:
+            parts.append(list(piece))
+
+    return [[table_rows[index]["tag"] for index in sorted(part)] for part in parts]
+
+
+def stitch_description(part_sections, transitions):
+    """
+    One description from the sections of the parts (in part order) and the transitions of the stitch:
+    a transition goes before the text of the first section of the part it opens
+    """
+    transitions = {_normalize_cell(transition["tag"]): transition["text"] for transition in transitions}
+
+    sections = []
+    for part in sorted(part_sections, key=lambda part: part["index"]):
+        for position, section in enumerate(part["sections"]):
+            transition = transitions.get(_normalize_cell(section["tag"])) if position == 0 and sections else None
+            sections.append({**section, "text": f"{transition} {section['text']}"} if transition else section)
+
+    return sections
 
 
 
@@ -192,34 +572,187 @@ def get_pfd_generator_agent():
 ###################################################################
 
 
-def worker_node(state:ExtrationState) -> ExtrationState:
+def prompt_version(system_prompt: str) -> str:
+    """Short hash identifying the version of a system prompt"""
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def _node_artifact(node_name, payload, wall_time_s, model_id="", system_prompt="", usage=None):
+    """What a node call leaves behind for the run: its output and what it cost"""
+    usage = usage or {}
+    return {"node": node_name,
+            "model_id": model_id,
+            "prompt_version": prompt_version(system_prompt) if system_prompt else "",
+            "input_tokens": usage.get("input_tokens"),
+            "output_tokens": usage.get("output_tokens"),
+            "wall_time_s": round(wall_time_s, 3),
+            "payload": payload}
+
+
+def _structured_response(node_name, response):
+    """Parsed output and token usage of a response of an include_raw structured agent"""
+    if response["parsed"] is None:
+        raise response.get("parsing_error") or ValueError(f"{node_name}: no structured output in the response")
+    usage = getattr(response["raw"], "usage_metadata", None) or {}
+    return response["parsed"], {"input_tokens": usage.get("input_tokens"),
+                                "output_tokens": usage.get("output_tokens")}
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _invoke_llm(node_name, schema, model_id, message_for_llm, config:Optional[RunnableConfig]=None,
+                stream_text=None):
+    """
+    Single entry point for the LLM calls of the nodes.
+    The agent answering with schema on model_id is only created when the call really goes to
+    the provider (not on cassette replay)
+
+    With stream_text and a stream in the config (see PFD_streaming.py), the call is streamed and
+    stream_text(partial output as a dict) is published as it is generated
+
+    The call is made on the shared event loop (see PFD_http_clients.py) and cancelled past its
+    deadline, or as soon as its run is cancelled if there is a run id in the config (see
+    PFD_cancellation.py). The run beats while its call is in flight, streamed or not
+
+    Returns the parsed output and the node artifact
+    """
+    configurable = (config or {}).get("configurable") or {}
+    stream = configurable.get("stream") if stream_text else None
+    run_id = configurable.get("run_id")
+
+    def check_run():
+        # polled while the call is in flight: the run is alive, unless it was cancelled
+        beat(run_id)
+        check_cancelled(run_id)
+
+    check = check_run if run_id is not None else None
+
+    def call_model():
+        if not _in_event_loop():
+            return run_coroutine(acall_model_on(model_id)(), check, timeout_s=call_deadline_s())
+        return _structured_response(node_name, get_structured_agent(model_id, schema).invoke(message_for_llm))
+
+    def acall_model_on(call_model_id):
+        # async call, so that a hedged request can be cancelled
+        async def acall_model():
+            response = await get_structured_agent(call_model_id, schema).ainvoke(message_for_llm)
+            return _structured_response(node_name, response)
+        return acall_model
+
+    def stream_model():
+        # the stream is fed token by token through its callback; a retried call starts it over
+        stream.start(stream_text)
+        if not _in_event_loop():
+            return run_coroutine(astream_model(), check, timeout_s=call_deadline_s())
+        response = {}
+        for chunk in get_structured_agent(model_id, schema).stream(message_for_llm, config={"callbacks": [stream]}):
+            response.update(chunk)
+        return _structured_response(node_name, response)
+
+    async def astream_model():
+        response = {}
+        async for chunk in get_structured_agent(model_id, schema).astream(message_for_llm,
+                                                                          config={"callbacks": [stream]}):
+            response.update(chunk)
+        return _structured_response(node_name, response)
+
+    def call_with_limits():
+        # capacity is shared with all the other workers calling the same provider:model
+        estimated_tokens = sum(estimate_tokens(message["content"]) for message in message_for_llm)
+        if stream is not None:
+            # no hedging: the text of a second request would interleave with the first
+            return call_with_capacity(model_id, estimated_tokens, stream_model)
+        return call_with_hedging(node_name, model_id, estimated_tokens, call_model, acall_model_on, check)
+
+    def call_provider():
+        # fails fast while provider:model is down (see PFD_circuit_breaker.py)
+        return call_with_breaker(model_id, call_with_limits)
+
+    cassette = configurable.get("cassette")
+
+    started = time.perf_counter()
+
+    if cassette is None:
+        result, usage = call_provider()
+    else:
+        result, usage = cassette.play(node_name, message_for_llm, call_provider)
+
+    # a hedge may have been answered by the equivalent model
+    artifact = _node_artifact(node_name, result.model_dump(mode="json"), time.perf_counter() - started,
+                              usage.get("model_id") or model_id, message_for_llm[0]["content"], usage)
+
+    return result, artifact
+
+
+def _invoke_worker(node_name, dxf_extract: str, config:Optional[RunnableConfig]=None):
+    """Single call of the worker LLM on the dxf extract"""
 
-    logger.info("entered worker")
-    
-    this_llm = get_pfd_worker_agent()
-    
     # import the prompt for this function
     message_for_llm = [{"role": "system", "content": PFD_extraction_worker_system_prompt},
-                      {"role": "user", "content": state['dxf_extract']}
+                      {"role": "user", "content": dxf_extract}
                       ]
     
-    result = this_llm.invoke(message_for_llm)
+    return _invoke_llm(node_name, EquipmentTable, routed_model(node_name, config), message_for_llm, config)
+
+
+def worker_node(state:ExtrationState, config:RunnableConfig) -> dict:
 
-    state["equipment_table"] = result
+    logger.info("entered worker")
+    
+    result, artifact = _invoke_worker("worker_node", state['dxf_extract'], config)
     
     logger.info("left worker")
     
-    return state
+    return {"equipment_table": result, "node_artifacts": [artifact]}
 
 
-def auditor_node(state:ExtrationState) -> ExtrationState:
+def worker_sample_node(state:dict, config:RunnableConfig) -> dict:
+    """One of the parallel worker calls of the ensemble (receives its input through Send)"""
+
+    logger.info(f"entered worker sample {state['sample_index']}")
+    
+    result, artifact = _invoke_worker("worker_sample_node", state['dxf_extract'], config)
+    
+    logger.info(f"left worker sample {state['sample_index']}")
+    
+    return {"worker_samples": [result], "node_artifacts": [artifact]}
+
+
+def reconcile_node(state:ExtrationState) -> dict:
+    """Merge the worker samples locally; only the disputed rows go on to the auditor"""
+
+    logger.info("entered reconcile")
+
+    started = time.perf_counter()
+    consensus_table, disputes = reconcile_worker_samples(state['worker_samples'])
+    artifact = _node_artifact("reconcile_node",
+                              {"consensus_table": consensus_table.model_dump(mode="json"), "disputes": disputes},
+                              time.perf_counter() - started)
+
+    logger.info(f"reconciled {len(state['worker_samples'])} worker samples: "
+                f"{len(consensus_table.rows)} rows, {len(disputes)} disputed")
+
+    # if nothing is disputed the consensus is the final table and the auditor is skipped
+    return {"equipment_table": consensus_table,
+            "corrected_equipment_table": consensus_table,
+            "audit_findings": AuditFindingsTable(title="Audit Findings Table", findings=[]),
+            "disputed_tags": list(disputes.keys()),
+            "ensemble_disputes": disputes,
+            "node_artifacts": [artifact]}
 
-    logger.info("entered auditor")
 
-    this_llm = get_pfd_auditor_agent()
+def auditor_node(state:ExtrationState, config:RunnableConfig) -> dict:
+
+    logger.info("entered auditor")
     
-    # Convert to markdown using the method from the equipment_table class
-    table_markdown = state["equipment_table"].to_markdown()
+    # Serialize the worker table in the table format of the auditor
+    candidate_table = state["equipment_table"].serialize(table_format("auditor_node"))
 
     # import the prompt for this function
     message_for_llm = [{"role": "system", "content": PFD_extraction_auditor_system_prompt},
@@ -227,37 +760,196 @@ def auditor_node(state:ExtrationState) -> ExtrationState:
                       1) The original JSON data file containing the Process Flow Diagram extract: 
                       {state['dxf_extract']}
     
-                      2) The candidate markdown table produced by the junior engineer:
-                      {table_markdown}
+                      2) The candidate table produced by the junior engineer:
+                      {candidate_table}
                       """}
                       ]
     
-    result = this_llm.invoke(message_for_llm)
-    state['audit_findings'] = result.audit_findings
-    state['corrected_equipment_table'] = result.corrected_equipment_table
+    result, artifact = _invoke_llm("auditor_node", AuditedEquipmentTables, routed_model("auditor_node", config),
+                                   message_for_llm, config)
 
     logger.info("left auditor")
     
-    return state
+    return {"audit_findings": result.audit_findings,
+            "corrected_equipment_table": result.corrected_equipment_table,
+            "node_artifacts": [artifact]}
 
 
-def generator_node(state:GenerationState) -> GenerationState:
+def disputed_auditor_node(state:ExtrationState, config:RunnableConfig) -> dict:
+    """Auditor for the ensemble: audits only the rows the worker samples did not agree on"""
 
-    logger.info("entered generator")
+    logger.info("entered disputed auditor")
+
+    consensus_table = state["equipment_table"]
+    disputed_tags = set(state["disputed_tags"])
 
-    this_llm = get_pfd_generator_agent()
+    disputed_table = EquipmentTable(title="Disputed rows",
+                                    rows=[row for row in consensus_table.rows if row.tag in disputed_tags])
+    agreed_tags = [row.tag for row in consensus_table.rows if row.tag not in disputed_tags]
+
+    # show the auditor what the independent worker samples disagreed on
+    disagreement_lines = []
+    for tag, columns in state["ensemble_disputes"].items():
+        for column, values in columns.items():
+            candidates = " / ".join(f'"{value}"' for value in values)
+            disagreement_lines.append(f"- {tag}, {column}: {candidates}")
+    disagreements = "\n".join(disagreement_lines)
+
+    message_for_llm = [{"role": "system", "content": PFD_extraction_auditor_system_prompt},
+                      {"role": "user", "content": f""" 
+                      1) The original JSON data file containing the Process Flow Diagram extract: 
+                      {state['dxf_extract']}
+    
+                      2) The candidate table produced by the junior engineer. Several engineers analysed 
+                      the drawing independently and agreed on all other equipment ({", ".join(agreed_tags)}); 
+                      only the rows below are in question. Audit these rows only, and return only these rows 
+                      (plus any equipment that is missing entirely) in the final corrected table:
+                      {disputed_table.serialize(table_format("disputed_auditor_node"))}
+
+                      3) The values the engineers disagreed on:
+                      {disagreements}
+                      """}
+                      ]
+
+    result, artifact = _invoke_llm("disputed_auditor_node", AuditedEquipmentTables, routed_model("disputed_auditor_node", config),
+                                   message_for_llm, config)
+
+    corrected_table = merge_audited_rows(consensus_table, disputed_tags,
+                                         result.corrected_equipment_table)
+
+    logger.info("left disputed auditor")
+
+    return {"audit_findings": result.audit_findings,
+            "corrected_equipment_table": corrected_table,
+            "node_artifacts": [artifact]}
+
+
+def generator_node(state:GenerationState, config:RunnableConfig) -> dict:
+
+    logger.info("entered generator")
     
     # import the prompt for this function
     message_for_llm = [{"role": "system", "content": PFD_generator_system_prompt},
                       {"role": "user", "content": state["connectivity_table"]}
                       ]
     
-    result = this_llm.invoke(message_for_llm)
-    state['process_description'] = result.process_description
+    result, artifact = _invoke_llm("generator_node", GeneratorOutput, routed_model("generator_node", config),
+                                   message_for_llm, config,
+                                   stream_text=lambda partial: render_description(partial.get("introduction", ""),
+                                                                                  partial.get("sections") or []))
     
     logger.info("left generator")
     
-    return state
+    return {"process_description": result.to_text(),
+            "description": result.model_dump(mode="json"),
+            "node_artifacts": [artifact]}
+
+
+def regenerator_node(state:GenerationState, config:RunnableConfig) -> dict:
+    """Incremental step 2: rewrite only the sections of the equipment that changed, and splice them back"""
+
+    logger.info("entered regenerator")
+
+    previous = state["previous_description"]
+    regenerate = {_normalize_cell(tag) for tag in state["regenerate_tags"]}
+    context = {_normalize_cell(tag) for tag in state["context_tags"]}
+
+    # the neighbours keep their section: show it, so that the rewritten ones fit in
+    neighbour_sections = render_description("", [section for section in previous["sections"]
+                                                 if _normalize_cell(section["tag"]) in context - regenerate])
+
+    message_for_llm = [{"role": "system", "content": PFD_regenerator_system_prompt},
+                      {"role": "user", "content": f"""
+                      1) The edited equipment and its direct neighbours, from the equipment and stream table:
+                      {state['connectivity_table']}
+
+                      2) Equipment to rewrite: {", ".join(state["regenerate_tags"])}
+
+                      3) The current sections of the neighbouring equipment, which stay as they are:
+                      {neighbour_sections or "(none)"}
+                      """}
+                      ]
+
+    result, artifact = _invoke_llm("regenerator_node", DescriptionSections, routed_model("regenerator_node", config),
+                                   message_for_llm, config,
+                                   stream_text=lambda partial: render_description("", partial.get("sections") or []))
+
+    sections = splice_sections(previous["sections"], [section.model_dump(mode="json") for section in result.sections],
+                               state["table_tags"])
+    description = {"introduction": previous["introduction"], "sections": sections}
+
+    logger.info(f"left regenerator: {len(result.sections)} of {len(sections)} sections rewritten")
+
+    return {"process_description": render_description(description["introduction"], sections),
+            "description": description,
+            "node_artifacts": [artifact]}
+
+
+def section_generator_node(state:dict, config:RunnableConfig) -> dict:
+    """Map-reduce step 2: the sections of one part of the process (receives its part through Send)"""
+
+    part = state["part"]
+    logger.info(f"entered section generator {part['index']}")
+
+    message_for_llm = [{"role": "system", "content": PFD_section_generator_system_prompt},
+                      {"role": "user", "content": f"""
+                      1) The equipment of this part of the process and its direct neighbours in the other parts, 
+                      from the equipment and stream table:
+                      {part['connectivity_table']}
+
+                      2) Equipment to describe: {", ".join(part["tags"])}
+                      """}
+                      ]
+
+    # the parts are generated at once, so none of them streams: the stitch streams the introduction
+    result, artifact = _invoke_llm("section_generator_node", PartDescription, routed_model("section_generator_node", config),
+                                   message_for_llm, config)
+
+    logger.info(f"left section generator {part['index']}")
+
+    return {"part_sections": [{"index": part["index"], "sections": [section.model_dump(mode="json")
+                                                                    for section in result.sections]}],
+            "node_artifacts": [artifact]}
+
+
+def stitch_node(state:GenerationState, config:RunnableConfig) -> dict:
+    """Map-reduce step 2: introduction and transitions between the parts, from an outline of their sections"""
+
+    logger.info("entered stitch")
+
+    part_sections = sorted(state["part_sections"], key=lambda part: part["index"])
+
+    # the first sentence of every section is enough to see what each part is about
+    outline_lines = []
+    for number, part in enumerate(part_sections, start=1):
+        outline_lines.append(f"Part {number}:")
+        for section in part["sections"]:
+            first_sentence = section["text"].split(". ")[0].rstrip(".")
+            outline_lines.append(f"- {section['tag']} ({section['heading']}): {first_sentence}.")
+    outline = "\n".join(outline_lines)
+
+    message_for_llm = [{"role": "system", "content": PFD_stitcher_system_prompt},
+                      {"role": "user", "content": f"""
+                      The outline of the {len(part_sections)} parts of the process description:
+                      {outline}
+                      """}
+                      ]
+
+    result, artifact = _invoke_llm("stitch_node", StitchOutput, routed_model("stitch_node", config),
+                                   message_for_llm, config,
+                                   stream_text=lambda partial: partial.get("introduction", ""))
+
+    description = {"introduction": result.introduction,
+                   "sections": stitch_description(part_sections, [transition.model_dump(mode="json")
+                                                                  for transition in result.transitions])}
+    # the stitched description, as the generator would have answered it (a speculation hit reads it back)
+    artifact["payload"] = description
+
+    logger.info(f"left stitch: {len(description['sections'])} sections in {len(part_sections)} parts")
+
+    return {"process_description": render_description(description["introduction"], description["sections"]),
+            "description": description,
+            "node_artifacts": [artifact]}
 
 
 ###################################################################
@@ -272,12 +964,62 @@ def generator_node(state:GenerationState) -> GenerationState:
 # Graphs
 ###################################################################
 
-def pfd_bench_st1_setup():
+# Singletons - a compiled graph holds no run state, one of each per process
+_compiled_graphs = {}
+
+
+def get_st1_graph(ensemble_size=1, checkpointer=None):
+    """Get or create the compiled graph of step 1"""
+    key = ("step_1", ensemble_size, id(checkpointer))
+
+    if key not in _compiled_graphs:
+        _compiled_graphs[key] = pfd_bench_st1_setup(ensemble_size=ensemble_size, checkpointer=checkpointer)
+        logger.info(f"Compiled the step 1 graph (ensemble of {ensemble_size})")
+
+    return _compiled_graphs[key]
+
+
+def get_st2_graph(incremental=False, map_reduce=False):
+    """Get or create the compiled graph of step 2"""
+    key = ("step_2", incremental, map_reduce)
+
+    if key not in _compiled_graphs:
+        _compiled_graphs[key] = pfd_bench_st2_setup(incremental=incremental, map_reduce=map_reduce)
+        logger.info(f"Compiled the step 2 graph (incremental={incremental}, map_reduce={map_reduce})")
+
+    return _compiled_graphs[key]
+
+
+def pfd_bench_st1_setup(ensemble_size=1, checkpointer=None):
     """
     We set up a graph for the first leg of the workflow: 
     worker and auditor, the output will be reviewed by a human
+
+    With ensemble_size > 1 the worker runs ensemble_size times in parallel (fan-out), 
+    the samples are reconciled locally and only the disputed rows are sent to the auditor
+
+    With a checkpointer every completed node is saved, so a failed run can resume where it stopped
     """
     workflow = StateGraph(ExtrationState)
+
+    if ensemble_size > 1:
+        def dispatch_worker_samples(state:ExtrationState):
+            return [Send("worker_sample_node", {"dxf_extract": state["dxf_extract"], "sample_index": i})
+                    for i in range(ensemble_size)]
+
+        def route_after_reconcile(state:ExtrationState):
+            return "disputed_auditor_node" if state["disputed_tags"] else END
+
+        workflow.add_node("worker_sample_node", worker_sample_node)
+        workflow.add_node("reconcile_node", reconcile_node)
+        workflow.add_node("disputed_auditor_node", disputed_auditor_node)
+
+        workflow.add_conditional_edges(START, dispatch_worker_samples, ["worker_sample_node"])
+        workflow.add_edge("worker_sample_node", "reconcile_node")
+        workflow.add_conditional_edges("reconcile_node", route_after_reconcile, ["disputed_auditor_node", END])
+        workflow.add_edge("disputed_auditor_node", END)
+
+        return workflow.compile(checkpointer=checkpointer)
  
     workflow.add_node("worker_node", worker_node)
     workflow.add_node("auditor_node", auditor_node)
@@ -287,17 +1029,42 @@ def pfd_bench_st1_setup():
     
     workflow.set_entry_point("worker_node") 
     
-    pfd_bench_st1_graph = workflow.compile()
+    pfd_bench_st1_graph = workflow.compile(checkpointer=checkpointer)
 
     return pfd_bench_st1_graph
 
 
-def pfd_bench_st2_setup():
+def pfd_bench_st2_setup(incremental=False, map_reduce=False):
     """
     We set up a graph for the second leg of the workflow: 
     After human review, get the connectivity table and prepare a process description
+
+    With incremental=True the description of a reopened run is updated instead: only the sections
+    of the edited equipment and its neighbours are rewritten
+
+    With map_reduce=True (large tables) the parts of the process in the state are described in
+    parallel (fan-out), then a short stitch writes the introduction and the transitions
     """
     workflow = StateGraph(GenerationState)
+
+    if map_reduce:
+        def dispatch_parts(state:GenerationState):
+            return [Send("section_generator_node", {"part": part}) for part in state["parts"]]
+
+        workflow.add_node("section_generator_node", section_generator_node)
+        workflow.add_node("stitch_node", stitch_node)
+
+        workflow.add_conditional_edges(START, dispatch_parts, ["section_generator_node"])
+        workflow.add_edge("section_generator_node", "stitch_node")
+        workflow.add_edge("stitch_node", END)
+
+        return workflow.compile()
+
+    if incremental:
+        workflow.add_node("regenerator_node", regenerator_node)
+        workflow.add_edge("regenerator_node", END)
+        workflow.set_entry_point("regenerator_node")
+        return workflow.compile()
  
     workflow.add_node("generator_node", generator_node)
     #workflow.add_node("auditor_generated_node", auditor_generated_node)  # later in time we may add this
@@ -0,0 +1,94 @@
+"""
+Cancellation of the runs in flight
+
+A run is cancelled from the processing page, or when it is deleted while still processed
+(cancel_run). Its status becomes 'cancelled' and:
+- the task it is queued as (Run.task_id) is revoked, so a worker that has not started it drops it
+- a flag is set in Redis for the task already running it: the graphs are run with
+  invoke_cancellable, which checks the flag between the nodes, and the calls to the provider made
+  on the shared event loop check it while waiting, and cancel the request (its HTTP connection is
+  closed) as soon as it is set; a streamed step-2 call checks it as its tokens come in
+
+The tasks stop on RunCancelled without retrying. The part that cannot be interrupted (the DXF
+parsing) runs to its end and the task stops at the next check.
+Redis errors never fail a run: without Redis the revoke and the status are all there is.
+"""
+
+import logging
+
+import redis
+from celery import current_app
+from kombu.exceptions import OperationalError
+
+from .PFD_redis import get_redis
+from .PFD_heartbeats import beat
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_cancellation')
+
+
+KEY_PREFIX = "pfd_bench:cancel"
+FLAG_TTL_S = 24 * 3600      # longer than any run; the run ids are never reused
+
+
+class RunCancelled(Exception):
+    """The run was cancelled while a task was processing it"""
+
+
+def cancel_key(run_id):
+    return f"{KEY_PREFIX}:{run_id}"
+
+
+def request_cancel(run_id):
+    """Set the cancel flag of a run. Never raises"""
+    try:
+        get_redis().set(cancel_key(run_id), 1, ex=FLAG_TTL_S)
+    except redis.RedisError as e:
+        logger.warning(f"Could not flag run {run_id} as cancelled: {str(e)}")
+
+
+def is_cancelled(run_id):
+    """Whether the cancel flag of a run is set (False if Redis is unavailable)"""
+    try:
+        return bool(get_redis().exists(cancel_key(run_id)))
+    except redis.RedisError:
+        return False
+
+
+def check_cancelled(run_id):
+    """Raise RunCancelled if the run was cancelled"""
+    if is_cancelled(run_id):
+        raise RunCancelled(f"Run {run_id} was cancelled")
+
+
+def cancel_run(run):
+    """Stop the processing of run: flag it for the task running it and revoke its queued task"""
+    request_cancel(run.id)
+
+    if run.task_id:
+        try:
+            current_app.control.revoke(run.task_id)
+        except OperationalError as e:
+            logger.warning(f"Could not revoke task {run.task_id} of run {run.id}: {str(e)}")
+
+    logger.info(f"Cancelled run {run.id}")
+
+
+def invoke_cancellable(graph, graph_input, config, run_id):
+    """
+    graph.invoke(graph_input, config), checking the cancel flag of run_id after every step of the
+    graph, where the heartbeat of the run is written too (see PFD_heartbeats). The run id is also
+    passed to the nodes (configurable 'run_id') for the provider calls
+    """
+    config = {**config, "configurable": {**config.get("configurable", {}), "run_id": run_id}}
+
+    result = None
+    for mode, chunk in graph.stream(graph_input, config=config, stream_mode=["updates", "values"]):
+        if mode == "values":
+            result = chunk
+            continue
+        beat(run_id, ",".join(chunk))
+        check_cancelled(run_id)
+
+    return result
@@ -0,0 +1,199 @@
+"""
+Record/replay cassettes for the LLM calls of the step-1 and step-2 graphs
+
+In record mode every node call is captured (node, request hash, response, start, latency) into one
+cassette file per run; in replay mode the recorded responses are served back in order, per node,
+without calling the providers (concurrent calls of a node, like the parts of a map-reduce generation,
+get the response recorded for the same request). Replay either honours the recorded latencies ('original') or
+answers immediately ('fast'), which isolates orchestration, DB and extraction overhead.
+
+A step that resumes from its checkpoints (after a retry) only calls the nodes left: in record mode
+its cassette keeps what the interrupted attempt recorded and appends to it (resume_recording).
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from collections import defaultdict, deque
+
+from django.conf import settings
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_cassettes')
+
+
+CASSETTE_MODES = ('off', 'record', 'replay')
+REPLAY_TIMINGS = ('original', 'fast')
+
+
+class CassetteError(Exception):
+    """The cassette cannot serve the requested call"""
+    pass
+
+
+def request_hash(node_name, messages):
+    """Stable hash of a node request, used to flag replays whose inputs have changed"""
+    payload = json.dumps({"node": node_name, "messages": messages}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cassette_path(run_id):
+    return os.path.join(settings.PFD_BENCH_CASSETTE_DIR, f"run_{run_id}.json")
+
+
+def provider_critical_path_s(interactions):
+    """
+    Provider latency on the critical path of recorded interactions: the length of the union of their
+    call intervals, so that concurrent calls (ensemble samples, map-reduce parts) count once.
+    Interactions recorded without their start are taken as sequential
+    """
+    intervals = sorted((i["started_at"], i["started_at"] + i["latency_s"]) for i in interactions if "started_at" in i)
+    total = sum(i["latency_s"] for i in interactions if "started_at" not in i)
+
+    covered_until = None
+    for start, end in intervals:
+        if covered_until is None or start > covered_until:
+            total += end - start
+            covered_until = end
+        elif end > covered_until:
+            total += end - covered_until
+            covered_until = end
+    return total
+
+
+class Cassette:
+    """
+    The interactions of one step ('step_1' or 'step_2') of a run
+
+    The cassette file holds both steps of the run, so recording step 2 keeps the step-1 section
+    """
+
+    def __init__(self, path, step, mode, replay_timing='fast'):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if replay_timing not in REPLAY_TIMINGS:
+            raise ValueError(f"Unknown replay timing: {replay_timing}")
+
+        self.path = path
+        self.step = step
+        self.mode = mode
+        self.replay_timing = replay_timing
+        self.interactions = []
+        self._lock = threading.Lock()  # ensemble workers record concurrently
+        self._queues = defaultdict(deque)
+        self.recorded_latency_s = 0.0  # total provider latency of the recorded calls
+
+        if mode == 'replay':
+            if not os.path.exists(path):
+                raise CassetteError(f"No cassette recorded at {path}")
+            with open(path) as f:
+                recorded = json.load(f).get(step, [])
+            for interaction in recorded:
+                self._queues[interaction["node"]].append(interaction)
+            self.recorded_latency_s = sum(i["latency_s"] for i in recorded)
+
+    def play(self, node_name, messages, invoke):
+        """
+        Serve the call of node_name: invoke() in record mode, the next recorded response in replay mode.
+        invoke() returns the parsed response and its token usage, and so does play()
+        """
+        if self.mode == 'record':
+            return self._record(node_name, messages, invoke)
+        return self._replay(node_name, messages)
+
+    def _record(self, node_name, messages, invoke):
+        started_at = time.time()
+        started = time.perf_counter()
+        response, usage = invoke()
+        latency = time.perf_counter() - started
+
+        with self._lock:
+            self.interactions.append({
+                "node": node_name,
+                "request_hash": request_hash(node_name, messages),
+                "schema": type(response).__name__,
+                "response": response.model_dump(mode="json"),
+                "usage": usage,
+                "started_at": round(started_at, 3),
+                "latency_s": round(latency, 3),
+            })
+        return response, usage
+
+    def _replay(self, node_name, messages):
+        from . import PFD_bench_setup
+
+        current_hash = request_hash(node_name, messages)
+        with self._lock:
+            queue = self._queues[node_name]
+            if not queue:
+                raise CassetteError(f"Cassette {self.path} has no more {self.step} responses for {node_name}")
+            interaction = next((i for i in queue if i["request_hash"] == current_hash), queue[0])
+            queue.remove(interaction)
+
+        if interaction["request_hash"] != current_hash:
+            logger.warning(f"Replaying {node_name} for a request that differs from the recorded one ({self.path})")
+
+        if self.replay_timing == 'original':
+            time.sleep(interaction["latency_s"])
+
+        schema = getattr(PFD_bench_setup, interaction["schema"])
+        return schema.model_validate(interaction["response"]), interaction.get("usage", {})
+
+    def resume_recording(self):
+        """
+        Record mode, on the resume of an interrupted attempt: keep the interactions it recorded, the
+        calls made from here on are appended to them
+        """
+        if self.mode != 'record':
+            return
+
+        recorded = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                recorded = json.load(f).get(self.step)
+        if recorded is None:
+            logger.warning(f"No {self.step} interactions recorded before the resume in {self.path}: "
+                           f"the cassette only has the calls made from here on")
+            return
+        with self._lock:
+            self.interactions = recorded + self.interactions
+
+    def save(self):
+        """Write the recorded interactions of this step (record mode only)"""
+        if self.mode != 'record':
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        content = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                content = json.load(f)
+        content[self.step] = self.interactions
+
+        with open(self.path, "w") as f:
+            json.dump(content, f, indent=2)
+
+        self.recorded_latency_s = sum(i["latency_s"] for i in self.interactions)
+        logger.info(f"Recorded {len(self.interactions)} {self.step} interactions "
+                    f"({self.recorded_latency_s:.1f}s provider latency) to {self.path}")
+
+
+def get_cassette(run_id, step, mode=None, replay_timing=None):
+    """
+    Cassette for a step of a run, or None when cassettes are off.
+    mode and replay_timing default to PFD_BENCH_CASSETTE_MODE and PFD_BENCH_CASSETTE_REPLAY_TIMING
+    """
+    mode = mode or settings.PFD_BENCH_CASSETTE_MODE
+    replay_timing = replay_timing or settings.PFD_BENCH_CASSETTE_REPLAY_TIMING
+
+    if mode not in CASSETTE_MODES:
+        raise ValueError(f"Unknown cassette mode: {mode}")
+    if mode == 'off':
+        return None
+
+    return Cassette(cassette_path(run_id), step, mode, replay_timing)
@@ -0,0 +1,78 @@
+"""
+LangGraph checkpointer for the PFD bench graphs
+
+Every completed node is checkpointed under the thread of its run, so a Celery retry resumes from the
+last completed node instead of re-running the extraction and the worker. Postgres-backed in
+production, SQLite locally (PFD_BENCH_CHECKPOINTER); checkpoints are pruned once a run completes.
+"""
+
+import logging
+import sqlite3
+
+from django.conf import settings
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_checkpoints')
+
+
+# Singleton - one checkpointer (and DB connection / pool) per process
+_checkpointer = None
+
+
+def get_checkpointer():
+    """Get or create the checkpointer selected with PFD_BENCH_CHECKPOINTER ('sqlite', 'postgres' or 'none')"""
+    global _checkpointer
+
+    if _checkpointer is not None:
+        return _checkpointer
+
+    backend = settings.PFD_BENCH_CHECKPOINTER
+
+    if backend == 'none':
+        return None
+
+    if backend == 'sqlite':
+        from langgraph.checkpoint.sqlite import SqliteSaver
+
+        conn = sqlite3.connect(settings.PFD_BENCH_CHECKPOINT_SQLITE_PATH, check_same_thread=False)
+        _checkpointer = SqliteSaver(conn)
+
+    elif backend == 'postgres':
+        from psycopg.rows import dict_row
+        from psycopg_pool import ConnectionPool
+        from langgraph.checkpoint.postgres import PostgresSaver
+
+        pool = ConnectionPool(
+            conninfo=settings.PFD_BENCH_CHECKPOINT_DB_URL,
+            max_size=settings.PFD_BENCH_CHECKPOINT_POOL_SIZE,
+            kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+            open=True,
+        )
+        _checkpointer = PostgresSaver(pool)
+
+    else:
+        raise ValueError(f"Unknown checkpointer backend: {backend}")
+
+    _checkpointer.setup()
+    logger.info(f"Created new {backend} checkpointer instance")
+
+    return _checkpointer
+
+
+def checkpoint_thread_id(run_id, step):
+    """Checkpoint thread of one step of a run; both steps have their own graph and state"""
+    return f"{run_id}:{step}"
+
+
+def prune_checkpoints(run_id, step):
+    """Delete the checkpoints of a step once it has completed"""
+    checkpointer = get_checkpointer()
+    if checkpointer is None:
+        return
+
+    try:
+        checkpointer.delete_thread(checkpoint_thread_id(run_id, step))
+    except Exception as e:
+        # stale checkpoints only cost disk space, never fail the run for them
+        logger.warning(f"Could not prune the {step} checkpoints of run {run_id}: {str(e)}")
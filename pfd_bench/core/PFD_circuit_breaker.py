@@ -0,0 +1,240 @@
+"""
+Circuit breaker per provider:model, so that an outage does not tie up the workers
+
+During an outage every call fails after its timeout, and every run burns its Celery retries
+(60/120/180s apart) on calls that cannot succeed. The outcomes of the calls to each provider:model
+are counted in Redis, shared by all workers, over the last PFD_BENCH_CIRCUIT_BREAKER['window_s']:
+- closed: calls go through. Once at least 'min_calls' were made in the window and the share of
+  provider failures (timeouts, connection errors, 408 and 5xx; not the 429s, the rate limiter's
+  business) reaches 'error_rate', the breaker opens
+- open: calls fail fast with CircuitOpen, and the tasks park their run in 'waiting_for_provider'
+  (no retry spent, the checkpoints of step 1 kept) instead of failing it
+- half-open: 'open_s' after opening, the next call goes through as the probe (one at a time).
+  Its success closes the breaker, its failure opens it again
+
+Parked runs are resumed by the resume_parked_runs task (Celery beat): all of them once the breaker
+of their model is closed, one at a time as the probe while it is half-open. A run parked in step 1
+keeps its extract, so it resumes at the LLM calls without parsing its drawing again. If Redis is
+unreachable the breaker fails open (calls are not blocked).
+"""
+
+import json
+import time
+import uuid
+import logging
+
+import httpx
+import redis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+from .PFD_rate_limiter import provider_status_code, lease_ttl_s, THROTTLE_RETRIES
+from .PFD_cancellation import RunCancelled
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_circuit_breaker')
+
+
+KEY_PREFIX = "pfd_bench:breaker"
+PARKED_KEY = f"{KEY_PREFIX}:parked"
+PARKED_EXTRACT_TTL_S = 7 * 24 * 3600
+BUCKET_S = 10               # resolution of the error-rate window
+
+# exceptions without an HTTP status that mean the provider could not be reached
+TRANSPORT_ERRORS = (TimeoutError, ConnectionError, httpx.TransportError)
+TRANSPORT_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "ServiceUnavailable", "DeadlineExceeded"}
+
+
+class CircuitOpen(Exception):
+    """The breaker of model_id is open: the call was not made"""
+
+    def __init__(self, model_id, retry_in_s=None):
+        self.model_id = model_id
+        wait = f", next probe in {retry_in_s:.0f}s" if retry_in_s else ""
+        super().__init__(f"{model_id} is failing, calls paused{wait}")
+
+
+
+###################################################################
+# Breaker state (Redis)
+###################################################################
+
+def breaker_enabled():
+    return settings.PFD_BENCH_CIRCUIT_BREAKER['enabled']
+
+
+def _keys(model_id):
+    base = f"{KEY_PREFIX}:{model_id}"
+    return {"state": f"{base}:state", "probe": f"{base}:probe", "window": f"{base}:window"}
+
+
+def probe_ttl_s():
+    """
+    Lifetime of the probe, after which the probe of a crashed worker is given up: longer than a live
+    probe can take (each throttled attempt waits for its capacity, then calls until its deadline)
+    """
+    return (THROTTLE_RETRIES + 1) * lease_ttl_s()
+
+
+def _window_buckets(now):
+    last = int(now // BUCKET_S)
+    return range(last - int(settings.PFD_BENCH_CIRCUIT_BREAKER['window_s'] // BUCKET_S), last + 1)
+
+
+def is_provider_failure(exc):
+    """Whether exc says the provider is failing (as opposed to a bad request or a bad answer)"""
+    status_code = provider_status_code(exc)
+    if status_code is not None:
+        return status_code == 408 or status_code >= 500
+    return isinstance(exc, TRANSPORT_ERRORS) or type(exc).__name__ in TRANSPORT_ERROR_NAMES
+
+
+def breaker_state(model_id):
+    """'closed', 'open' (cooling down), 'probing' (a probe is in flight) or 'half_open' (probe due)"""
+    client = get_redis()
+    keys = _keys(model_id)
+    opened_at = client.hget(keys["state"], "opened_at")
+    if opened_at is None:
+        return 'closed'
+    if time.time() - float(opened_at) < settings.PFD_BENCH_CIRCUIT_BREAKER['open_s']:
+        return 'open'
+    return 'probing' if client.exists(keys["probe"]) else 'half_open'
+
+
+def _admit(client, model_id):
+    """
+    Token of the probe if a call to model_id is the probe of a half-open breaker, else None;
+    raises CircuitOpen if it cannot go
+    """
+    keys = _keys(model_id)
+    opened_at = client.hget(keys["state"], "opened_at")
+    if opened_at is None:
+        return None
+
+    remaining = settings.PFD_BENCH_CIRCUIT_BREAKER['open_s'] - (time.time() - float(opened_at))
+    if remaining > 0:
+        raise CircuitOpen(model_id, remaining)
+    token = uuid.uuid4().hex
+    if client.set(keys["probe"], token, nx=True, ex=probe_ttl_s()):
+        logger.info(f"Probing {model_id}")
+        return token
+    raise CircuitOpen(model_id)  # another call is the probe
+
+
+def _release_probe(client, model_id, probe):
+    """Drop the probe key, if it is still this probe's (not the next probe, after this one expired)"""
+    if client.get(_keys(model_id)["probe"]) == probe:
+        client.delete(_keys(model_id)["probe"])
+
+
+def _record(client, model_id, failed, probe):
+    """Count the outcome of a call (probe: its token, if it is the probe); open or close the breaker accordingly"""
+    config = settings.PFD_BENCH_CIRCUIT_BREAKER
+    keys = _keys(model_id)
+    now = time.time()
+
+    if probe:
+        if failed:
+            client.hset(keys["state"], "opened_at", now)
+            logger.warning(f"Probe of {model_id} failed, breaker open again")
+        else:
+            client.delete(keys["state"], *[f"{keys['window']}:{bucket}" for bucket in _window_buckets(now)])
+            logger.info(f"Probe of {model_id} succeeded, breaker closed")
+        _release_probe(client, model_id, probe)
+        return
+
+    bucket_key = f"{keys['window']}:{int(now // BUCKET_S)}"
+    pipe = client.pipeline()
+    pipe.hincrby(bucket_key, "calls", 1)
+    if failed:
+        pipe.hincrby(bucket_key, "errors", 1)
+    pipe.expire(bucket_key, int(config['window_s']) + BUCKET_S)
+    pipe.execute()
+    if not failed:
+        return
+
+    pipe = client.pipeline()
+    for bucket in _window_buckets(now):
+        pipe.hmget(f"{keys['window']}:{bucket}", "calls", "errors")
+    counts = [(int(calls or 0), int(errors or 0)) for calls, errors in pipe.execute()]
+    calls, errors = sum(c for c, _ in counts), sum(e for _, e in counts)
+
+    if calls >= config['min_calls'] and errors / calls >= config['error_rate'] \
+            and client.hsetnx(keys["state"], "opened_at", now):
+        logger.error(f"{model_id}: {errors} of the last {calls} calls failed, breaker open")
+
+
+def call_with_breaker(model_id, invoke):
+    """
+    invoke() unless the breaker of model_id is open (raises CircuitOpen without calling).
+    The outcome of the call is counted for the breaker
+    """
+    if not breaker_enabled():
+        return invoke()
+
+    try:
+        client = get_redis()
+        probe = _admit(client, model_id)
+    except redis.RedisError as e:
+        logger.warning(f"Circuit breaker unavailable, calling {model_id} without it: {str(e)}")
+        return invoke()
+
+    try:
+        result = invoke()
+    except RunCancelled:
+        if probe:
+            _safe(_release_probe, client, model_id, probe)  # no verdict, the next call probes
+        raise
+    except Exception as e:
+        _safe(_record, client, model_id, is_provider_failure(e), probe)
+        raise
+
+    _safe(_record, client, model_id, False, probe)
+    return result
+
+
+def _safe(function, *args):
+    try:
+        function(*args)
+    except redis.RedisError as e:
+        logger.warning(f"Circuit breaker state not updated: {str(e)}")
+
+
+
+###################################################################
+# Runs parked while a breaker is open
+###################################################################
+
+def parked_extract_key(run_id):
+    return f"{KEY_PREFIX}:extract:{run_id}"
+
+
+def park_run(run_id, model_id, step, dxf_extract=None):
+    """Record that run_id waits for model_id, in step 1 (with its extract) or 2. Never raises"""
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(PARKED_KEY, run_id, json.dumps({"model_id": model_id, "step": step, "at": time.time()}))
+        if dxf_extract is not None:
+            pipe.set(parked_extract_key(run_id), dxf_extract, ex=PARKED_EXTRACT_TTL_S)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not record the parking of run {run_id}: {str(e)}")
+
+
+def parked_runs():
+    """{run id: {'model_id', 'step', 'at'}} of the parked runs"""
+    return {int(run_id): json.loads(record) for run_id, record in get_redis().hgetall(PARKED_KEY).items()}
+
+
+def parked_extract(run_id):
+    """The extract of a run parked in step 1, None if it was not kept"""
+    return get_redis().get(parked_extract_key(run_id))
+
+
+def unpark_runs(run_ids):
+    if run_ids:
+        pipe = get_redis().pipeline()
+        pipe.hdel(PARKED_KEY, *run_ids)
+        pipe.delete(*[parked_extract_key(run_id) for run_id in run_ids])
+        pipe.execute()
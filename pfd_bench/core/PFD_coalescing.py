@@ -0,0 +1,233 @@
+"""
+Coalescing of identical step-1 computations
+
+Two runs on the same drawing (ProjectFile rows are deduplicated by file hash) routed to the same
+pipeline configuration get the same table from step 1. The first one to reach the LLM calls takes
+a Redis lease keyed by (file hash, configuration hash) and runs the graph (the leader); a run that
+finds the lease taken waits for the leader and copies its table instead of calling the models (a
+follower, Run.coalesced_from).
+
+A follower does not hold a worker while it waits: as long as the leader computes, lead_or_follow
+raises LeaderComputing and the task queues itself again PFD_BENCH_COALESCING['poll_s'] later. The
+follower gives up and computes its own table after waiting 'wait_s' in all (counted in Redis from its
+first look at the leader).
+
+The leader renews its lease with a heartbeat while it runs and drops it when it is done, saved or
+failed. A leader that crashed stops renewing: its lease expires after PFD_BENCH_COALESCING['lease_s']
+and the next follower to notice takes over and runs the graph itself. Redis errors never fail a
+run: without Redis every run computes its own table.
+"""
+
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import redis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+from .PFD_prompt_templates import PFD_extraction_worker_system_prompt, PFD_extraction_auditor_system_prompt
+from .PFD_table_serializer import table_format
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_coalescing')
+
+
+KEY_PREFIX = "pfd_bench:coalesce"
+
+# statuses of a leader: still computing, or done without a table to copy
+COMPUTING_STATUSES = ('pending', 'processing')
+NO_TABLE_STATUSES = ('failed', 'cancelled', 'waiting_for_provider')
+
+
+class LeaderComputing(Exception):
+    """The leader of a follower still computes: look again in retry_in_s"""
+
+    def __init__(self, leader_id, retry_in_s):
+        self.leader_id = leader_id
+        self.retry_in_s = retry_in_s
+        super().__init__(f"Waiting for run {leader_id}, next look in {retry_in_s:.0f}s")
+
+
+def coalescing_enabled(cassette_mode=None):
+    # cassettes are kept per run: a follower has nothing to record (or replay); cassette_mode overrides the setting
+    return settings.PFD_BENCH_COALESCING['enabled'] and (cassette_mode or settings.PFD_BENCH_CASSETTE_MODE) == 'off'
+
+
+def pipeline_config_hash(model_route, encoding):
+    """Hash of everything besides the drawing that shapes the table of step 1"""
+    from .PFD_bench_setup import prompt_version
+
+    config = {"routes": model_route,
+              "encoding": encoding,
+              "ensemble_size": settings.PFD_BENCH_WORKER_ENSEMBLE_SIZE,
+              "provider": settings.PFD_BENCH_LLM_PROVIDER,
+              "auditor_table_format": [table_format("auditor_node"), table_format("disputed_auditor_node")],
+              "prompts": [prompt_version(PFD_extraction_worker_system_prompt),
+                          prompt_version(PFD_extraction_auditor_system_prompt)]}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def coalesce_key(file_hash, config_hash):
+    return f"{KEY_PREFIX}:lease:{file_hash}:{config_hash}"
+
+
+def following_key(run_id):
+    return f"{KEY_PREFIX}:following:{run_id}"
+
+
+class Lease:
+    """
+    The leader's hold on a coalescing key, renewed by a heartbeat thread until released.
+    Use it as a context manager around the computation
+    """
+
+    def __init__(self, key, run_id):
+        self.key = key
+        self.run_id = str(run_id)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _heartbeat(self):
+        while not self._stop.wait(settings.PFD_BENCH_COALESCING['heartbeat_s']):
+            try:
+                client = get_redis()
+                if client.get(self.key) != self.run_id:
+                    return  # expired and taken over: nothing left to renew
+                client.expire(self.key, settings.PFD_BENCH_COALESCING['lease_s'])
+            except redis.RedisError as e:
+                logger.warning(f"Could not renew the coalescing lease of run {self.run_id}: {str(e)}")
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True,
+                                        name=f"coalesce-heartbeat-{self.run_id}")
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        try:
+            client = get_redis()
+            if client.get(self.key) == self.run_id:
+                client.delete(self.key)
+        except redis.RedisError as e:
+            logger.warning(f"Could not release the coalescing lease of run {self.run_id}: {str(e)}")
+        return False
+
+
+def _claim_or_follow(key, run_id):
+    """
+    Take the lease of key for run_id, or find who holds it.
+    Returns (Lease, None) for the leader (also when run_id already held it, e.g. on a retry),
+    (None, leader run id) for a follower, or (None, None) if Redis is unavailable
+    """
+    try:
+        client = get_redis()
+        while True:
+            if client.set(key, run_id, nx=True, ex=settings.PFD_BENCH_COALESCING['lease_s']):
+                return Lease(key, run_id), None
+            leader_id = client.get(key)
+            if leader_id == str(run_id):
+                client.expire(key, settings.PFD_BENCH_COALESCING['lease_s'])
+                return Lease(key, run_id), None
+            if leader_id is not None:
+                return None, int(leader_id)
+            # released between the two calls: try again
+
+    except redis.RedisError as e:
+        logger.warning(f"No coalescing for run {run_id}: {str(e)}")
+        return None, None
+
+
+def _has_table(leader):
+    return leader is not None and leader.status not in COMPUTING_STATUSES + NO_TABLE_STATUSES
+
+
+def _leader_run(leader_id):
+    from ..models import Run  # Import here to avoid circular imports
+
+    return Run.objects.filter(pk=leader_id).only('id', 'status', 'generated_table').first()
+
+
+def _follow(client, run_id, leader_id):
+    """Record that run_id follows leader_id; returns the seconds it has followed so far, any leader"""
+    key = following_key(run_id)
+    client.hsetnx(key, 'since', time.time())
+    client.hset(key, 'leader', leader_id)
+    client.expire(key, int(settings.PFD_BENCH_COALESCING['wait_s']) + 3600)  # outlives the wait
+    return time.time() - float(client.hget(key, 'since'))
+
+
+def _followed_leader(run_id):
+    """The leader run_id followed at its last look, None if it was not following"""
+    try:
+        leader_id = get_redis().hget(following_key(run_id), 'leader')
+    except redis.RedisError:
+        return None
+    return int(leader_id) if leader_id else None
+
+
+def _stop_following(run_id):
+    try:
+        get_redis().delete(following_key(run_id))
+    except redis.RedisError:
+        pass
+
+
+def _check_leader(key, leader_id, run_id):
+    """
+    One look at the leader of key. Returns the leader run once it has its table, or None if the
+    follower run_id has to compute its own (the leader failed, was cancelled or parked, crashed, or
+    the follower waited PFD_BENCH_COALESCING['wait_s']). Raises LeaderComputing while the leader computes
+    """
+    leader = _leader_run(leader_id)
+    if leader is None or leader.status in NO_TABLE_STATUSES:
+        return None
+    if leader.status not in COMPUTING_STATUSES:
+        return leader
+
+    try:
+        client = get_redis()
+        holder = client.get(key)
+        waited_s = _follow(client, run_id, leader_id)
+    except redis.RedisError:
+        holder, waited_s = None, 0.0
+    if holder != str(leader_id) or waited_s > settings.PFD_BENCH_COALESCING['wait_s']:
+        # the lease was dropped: the leader may have saved its table just before
+        leader.refresh_from_db(fields=['status', 'generated_table'])
+        return leader if _has_table(leader) else None
+
+    raise LeaderComputing(leader_id, settings.PFD_BENCH_COALESCING['poll_s'])
+
+
+def lead_or_follow(key, run_id):
+    """
+    Whether run_id computes the table of key or copies it from another run.
+    Returns (Lease, None): compute it, holding the lease; (None, None): compute it without the lease
+    (no Redis, or the leader took too long); (None, leader run): copy the table of the leader.
+    Raises LeaderComputing while the leader still computes: call it again retry_in_s later
+    """
+    # the leader followed at the last look may have finished since, and released the lease
+    leader_id = _followed_leader(run_id)
+    if leader_id is not None:
+        leader = _leader_run(leader_id)
+        if _has_table(leader):
+            _stop_following(run_id)
+            return None, leader
+
+    waited = set()
+    while True:
+        lease, leader_id = _claim_or_follow(key, run_id)
+        if leader_id is None or leader_id in waited:
+            _stop_following(run_id)
+            return lease, None
+
+        waited.add(leader_id)
+        leader = _check_leader(key, leader_id, run_id)
+        if leader is not None:
+            _stop_following(run_id)
+            return None, leader
+        # the leader is gone: take over, or follow whoever did first
@@ -0,0 +1,115 @@
+"""
+Heartbeats of the runs in flight, for the stuck-run reaper
+
+A worker that is OOM-killed, restarted, or hits CELERY_TASK_TIME_LIMIT mid-run (only the prefork CPU
+worker enforces it; on the threads pool of the I/O worker the model calls have their own deadline, see
+PFD_http_clients) leaves its run in 'processing' (or 'generating_description') for good: the task message is gone (acked on receipt) and nothing
+else will ever save the run. So the task processing a run writes a heartbeat to Redis:
+- when it starts (state 'running')
+- at every node boundary of the graphs (invoke_cancellable), and every BEAT_EVERY_S while it waits
+  for a provider call or receives the tokens of a streamed one
+- when it hands the run over to a task still in the broker (state 'queued'): the parse task at the
+  end, a task before its retry, a coalesced follower queued again to wait for its leader, the reaper
+  when it requeues the run
+
+The reap_stuck_runs task (Celery beat, every PFD_BENCH_REAPER['every_s']) looks for running runs
+whose last heartbeat is older than PFD_BENCH_REAPER['stale_s']: it requeues them, step 1 resuming
+from its checkpoints, up to 'max_requeues' times, then fails them with the reason. Queued runs (and
+the runs not started yet, outside of a batch) are given 'queued_stale_s', longer than any wait in
+the broker: a worker that dies after taking their message, before its first heartbeat, would leave
+them queued for good. Redis errors never fail a run.
+"""
+
+import time
+import logging
+import threading
+
+import redis
+
+from .PFD_redis import get_redis
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_heartbeats')
+
+
+KEY_PREFIX = "pfd_bench:heartbeat"
+BEAT_EVERY_S = 10           # at most one write per run and process, besides the node boundaries
+BEAT_TTL_S = 24 * 3600
+
+# Last write per run in this process
+_last_beat = {}
+_lock = threading.Lock()
+
+
+def heartbeat_key(run_id):
+    return f"{KEY_PREFIX}:{run_id}"
+
+
+def beat(run_id, node=None, state='running'):
+    """
+    Heartbeat of a run. Without node (while waiting on something), at most every BEAT_EVERY_S.
+    Never raises
+    """
+    now = time.time()
+    with _lock:
+        if state != 'running':
+            _last_beat.pop(run_id, None)  # handed over: the next task may run in another process
+        elif node is None and now - _last_beat.get(run_id, 0) < BEAT_EVERY_S:
+            return
+        else:
+            _last_beat[run_id] = now
+
+    fields = {"at": now, "state": state}
+    if node is not None:
+        fields["node"] = node
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(heartbeat_key(run_id), mapping=fields)
+        pipe.expire(heartbeat_key(run_id), BEAT_TTL_S)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not write the heartbeat of run {run_id}: {str(e)}")
+
+
+def heartbeats(run_ids):
+    """{run id: {'at', 'state', 'node', 'requeues'}} of the runs that have a heartbeat"""
+    pipe = get_redis().pipeline()
+    for run_id in run_ids:
+        pipe.hgetall(heartbeat_key(run_id))
+
+    found = {}
+    for run_id, fields in zip(run_ids, pipe.execute()):
+        if fields:
+            found[run_id] = {"at": float(fields.get("at", 0)), "state": fields.get("state", "running"),
+                             "node": fields.get("node", ""), "requeues": int(fields.get("requeues", 0))}
+    return found
+
+
+def count_requeue(run_id):
+    """Count a requeue of the run by the reaper, and mark it queued. Returns the requeues so far"""
+    pipe = get_redis().pipeline()
+    pipe.hincrby(heartbeat_key(run_id), "requeues", 1)
+    pipe.hset(heartbeat_key(run_id), mapping={"at": time.time(), "state": "queued"})
+    pipe.expire(heartbeat_key(run_id), BEAT_TTL_S)
+    return pipe.execute()[0]
+
+
+def stale_runs(runs, stale_s, queued_stale_s):
+    """
+    The runs among runs (pending, or in a processing status) whose task stopped beating, or whose
+    message has been queued for queued_stale_s: [(run, heartbeat)], heartbeat None for a run that never
+    had one (its last save stands for it)
+    """
+    now = time.time()
+    beats = heartbeats([run.id for run in runs])
+
+    stale = []
+    for run in runs:
+        heartbeat = beats.get(run.id)
+        if heartbeat is None:
+            if now - run.updated_at.timestamp() > (queued_stale_s if run.status == 'pending' else stale_s):
+                stale.append((run, None))
+        elif now - heartbeat["at"] > (stale_s if heartbeat["state"] == 'running' else queued_stale_s):
+            stale.append((run, heartbeat))
+    return stale
@@ -0,0 +1,266 @@
+"""
+Hedged requests for the LLM calls of the nodes
+
+When hedging is enabled for a node (PFD_BENCH_HEDGING) and a call has not answered within the
+observed p90 latency of that node, a second request is sent, to the same model or to the equivalent
+one configured in PFD_BENCH_HEDGE_MODELS, and whichever answers first wins; the other is cancelled.
+Hedges are capped to a fraction of the tokens the node sends per day, so the tail is cut for a
+bounded extra spend.
+
+Latencies and counters live in Redis, shared by all workers; hedging_report() summarises them per node
+(hedge rate, win rate, estimated time saved and the latency quantiles of the first request vs. what
+the node experienced). A cancelled first request has no latency; the time a hedge saved is estimated
+from the completed first requests that took longer than the hedged call.
+"""
+
+import time
+import asyncio
+import logging
+import datetime
+
+import redis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+from .PFD_rate_limiter import call_with_capacity, acall_with_capacity
+from .PFD_http_clients import run_coroutine, call_deadline_s
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_hedging')
+
+
+KEY_PREFIX = "pfd_bench:hedging"
+LATENCY_HISTORY = 200       # latest latencies kept per node
+STATS_DAYS = 7              # the budget is per day, the report covers the last STATS_DAYS days
+
+
+###################################################################
+# Lua script (atomic across workers)
+###################################################################
+
+# KEYS[1] stats hash of the node for today; ARGV estimated tokens, max hedge fraction, ttl
+# Returns 1 and counts the hedge if its tokens fit the budget of the day, 0 otherwise
+_RESERVE_HEDGE = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens')) or 0
+local hedge_tokens = tonumber(redis.call('HGET', KEYS[1], 'hedge_tokens')) or 0
+if hedge_tokens + tonumber(ARGV[1]) > tokens * tonumber(ARGV[2]) then
+    return 0
+end
+
+redis.call('HINCRBY', KEYS[1], 'hedge_tokens', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'hedges', 1)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+return 1
+"""
+
+
+
+###################################################################
+# Latency history and counters (Redis)
+###################################################################
+
+def _latency_key(node_name, kind):
+    # kind: 'first' (the first request of each call) or 'node' (what the node waited for)
+    return f"{KEY_PREFIX}:latency:{kind}:{node_name}"
+
+
+def _stats_key(node_name, day=None):
+    day = day or datetime.date.today()
+    return f"{KEY_PREFIX}:stats:{node_name}:{day.isoformat()}"
+
+
+def _record_latency(client, node_name, kind, seconds):
+    key = _latency_key(node_name, kind)
+    pipe = client.pipeline()
+    pipe.lpush(key, round(seconds, 3))
+    pipe.ltrim(key, 0, LATENCY_HISTORY - 1)
+    pipe.execute()
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_quantile(node_name, q, kind='first'):
+    """Quantile q of the recent latencies of a node, or None until enough calls were seen"""
+    values = [float(v) for v in get_redis().lrange(_latency_key(node_name, kind), 0, -1)]
+    if len(values) < settings.PFD_BENCH_HEDGING['min_samples']:
+        return None
+    return _quantile(values, q)
+
+
+def _reserve_hedge(client, node_name, estimated_tokens):
+    """Count a hedge against today's budget of the node; False if it would exceed it"""
+    return bool(client.eval(_RESERVE_HEDGE, 1, _stats_key(node_name), int(estimated_tokens),
+                            settings.PFD_BENCH_HEDGING['max_hedge_fraction'], (STATS_DAYS + 1) * 24 * 3600))
+
+
+def _estimated_saving(client, node_name, elapsed):
+    """Expected remaining latency of a first request still running after elapsed seconds"""
+    values = [float(v) for v in client.lrange(_latency_key(node_name, 'first'), 0, -1)]
+    slower = [v for v in values if v > elapsed]
+    return sum(slower) / len(slower) - elapsed if slower else 0.0
+
+
+def _count_call(client, node_name, estimated_tokens, hedge_won=False, saved_s=0.0):
+    key = _stats_key(node_name)
+    pipe = client.pipeline()
+    pipe.hincrby(key, "calls", 1)
+    pipe.hincrby(key, "tokens", estimated_tokens)
+    if hedge_won:
+        pipe.hincrby(key, "hedge_wins", 1)
+        pipe.hincrbyfloat(key, "saved_s", saved_s)
+    pipe.expire(key, (STATS_DAYS + 1) * 24 * 3600)
+    pipe.execute()
+
+
+
+###################################################################
+# Hedged call
+###################################################################
+
+def hedging_enabled(node_name):
+    hedging = settings.PFD_BENCH_HEDGING
+    return hedging['enabled'] and node_name in hedging['nodes']
+
+
+def hedge_model(model_id):
+    """The model the hedge of a call to model_id goes to (the same model unless configured)"""
+    return settings.PFD_BENCH_HEDGE_MODELS.get(model_id, model_id)
+
+
+def call_with_hedging(node_name, model_id, estimated_tokens, invoke, ainvoke_for, check=None):
+    """
+    Call the model of a node, hedging the call if it is slower than the p90 of the node.
+
+    invoke() is the plain synchronous call; ainvoke_for(model_id) returns the async call on a model.
+    Both return the parsed response and its token usage, and so does call_with_hedging(); the usage
+    also names the model that answered. check() is polled while a hedged race runs (see run_coroutine)
+    """
+    if not hedging_enabled(node_name):
+        return call_with_capacity(model_id, estimated_tokens, invoke)
+
+    try:
+        client = get_redis()
+        delay = latency_quantile(node_name, settings.PFD_BENCH_HEDGING['quantile'])
+    except redis.RedisError as e:
+        logger.warning(f"Hedging unavailable for {node_name}: {str(e)}")
+        return call_with_capacity(model_id, estimated_tokens, invoke)
+
+    started = time.perf_counter()
+
+    try:
+        asyncio.get_running_loop()
+        in_event_loop = True
+    except RuntimeError:
+        in_event_loop = False
+
+    if delay is None or in_event_loop:
+        # not enough history yet (or called from async code): plain call, that feeds the history
+        response, usage = call_with_capacity(model_id, estimated_tokens, invoke)
+        elapsed = time.perf_counter() - started
+        first_latency, hedge_won = elapsed, False
+    else:
+        # on the shared event loop of the process, where the async transports live
+        response, usage, first_latency, hedge_won = run_coroutine(
+            _race(node_name, model_id, estimated_tokens, ainvoke_for, delay, client), check, timeout_s=call_deadline_s())
+        elapsed = time.perf_counter() - started
+
+    try:
+        saved_s = _estimated_saving(client, node_name, elapsed) if hedge_won else 0.0
+        if first_latency is not None:
+            _record_latency(client, node_name, 'first', first_latency)
+        _record_latency(client, node_name, 'node', elapsed)
+        _count_call(client, node_name, estimated_tokens, hedge_won, saved_s)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record the latency of {node_name}: {str(e)}")
+
+    return response, usage
+
+
+async def _race(node_name, model_id, estimated_tokens, ainvoke_for, delay, client):
+    """
+    Run the first request; past delay, race it against a hedge.
+    Returns the response, the usage, the latency of the first request (None if it was cancelled
+    or failed) and whether the hedge won
+    """
+    started = time.perf_counter()
+    first = asyncio.ensure_future(acall_with_capacity(model_id, estimated_tokens, ainvoke_for(model_id)))
+
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return (*await first, time.perf_counter() - started, False)
+
+    try:
+        hedge_allowed = _reserve_hedge(client, node_name, estimated_tokens)
+    except redis.RedisError:
+        hedge_allowed = False
+
+    if not hedge_allowed:
+        return (*await first, time.perf_counter() - started, False)
+
+    second_model = hedge_model(model_id)
+    logger.info(f"{node_name} slower than {delay:.1f}s, hedging on {second_model}")
+    second = asyncio.ensure_future(acall_with_capacity(second_model, estimated_tokens, ainvoke_for(second_model)))
+
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        # if both answered at once the first request wins
+        for task in sorted(done, key=lambda task: task is not first):
+            if task.exception() is not None:
+                error = task.exception()
+                continue
+
+            for loser in pending:
+                loser.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+            response, usage = task.result()
+            hedge_won = task is second
+            elapsed = time.perf_counter() - started
+            first_latency = None if hedge_won else elapsed
+            logger.info(f"{node_name} answered by the {'hedge' if hedge_won else 'first request'} "
+                        f"after {elapsed:.1f}s")
+            return response, {**usage, "model_id": second_model if hedge_won else model_id}, first_latency, hedge_won
+
+    raise error
+
+
+
+###################################################################
+# Report
+###################################################################
+
+def hedging_report(node_names):
+    """Per node: calls, hedge rate, hedge win rate and latency quantiles (first request vs. node)"""
+    client = get_redis()
+    today = datetime.date.today()
+    report = {}
+
+    for node_name in node_names:
+        totals = {"calls": 0, "tokens": 0, "hedges": 0, "hedge_tokens": 0, "hedge_wins": 0, "saved_s": 0.0}
+        for days_ago in range(STATS_DAYS):
+            stats = client.hgetall(_stats_key(node_name, today - datetime.timedelta(days=days_ago)))
+            for field in totals:
+                totals[field] += type(totals[field])(float(stats.get(field, 0)))
+
+        latencies = {}
+        for kind in ('first', 'node'):
+            values = [float(v) for v in client.lrange(_latency_key(node_name, kind), 0, -1)]
+            latencies[kind] = {f"p{int(q * 100)}": _quantile(values, q) for q in (0.5, 0.9, 0.99)} if values else {}
+
+        calls = totals["calls"]
+        report[node_name] = {
+            **totals,
+            "hedge_rate": totals["hedges"] / calls if calls else 0.0,
+            "hedge_win_rate": totals["hedge_wins"] / totals["hedges"] if totals["hedges"] else 0.0,
+            "hedge_token_fraction": totals["hedge_tokens"] / totals["tokens"] if totals["tokens"] else 0.0,
+            "latency_first_request": latencies['first'],
+            "latency_node": latencies['node'],
+        }
+
+    return report
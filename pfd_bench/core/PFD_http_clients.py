@@ -0,0 +1,304 @@
+"""
+Shared transports for the chat models, one set per process
+
+All chat models of a provider share the same connection pool instead of opening their own:
+- OpenAI: one httpx Client and one AsyncClient (keep-alive pool, HTTP/2 if h2 is installed)
+- Google GenAI: one gRPC client (a single HTTP/2 channel multiplexing all calls) and its async twin
+
+Async calls (the model calls of the nodes, hedged requests) all run on one long-lived event loop
+per process, so the async clients, which are bound to the loop they were created on, can be reused
+across calls. The thread waiting for a call gives up at its deadline (PFD_BENCH_HTTP_POOL
+['call_deadline_s']) and cancels it: the threads pool of the I/O worker does not enforce
+CELERY_TASK_TIME_LIMIT, so this deadline is what frees a thread stuck on a provider that hangs.
+
+Pool size and timeouts are set with PFD_BENCH_HTTP_POOL. Connection reuse of the httpx clients
+is traced per host and logged every METRICS_LOG_EVERY requests (connection_metrics() returns it).
+"""
+
+import time
+import asyncio
+import logging
+import concurrent.futures
+import threading
+
+import httpx
+from django.conf import settings
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_http_clients')
+
+
+METRICS_LOG_EVERY = 50
+
+
+# Singletons - one of each per process
+_http_client = None
+_async_http_client = None
+_google_client = None
+_google_async_client = None
+_event_loop = None
+_lock = threading.Lock()
+
+
+
+###################################################################
+# Long-lived event loop for the async calls
+###################################################################
+
+def get_event_loop():
+    """The event loop of this process for async model calls, running in a daemon thread"""
+    global _event_loop
+
+    with _lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="pfd-bench-event-loop", daemon=True).start()
+            _event_loop = loop
+            logger.info("Started the shared event loop")
+
+    return _event_loop
+
+
+def call_deadline_s():
+    """Wall time a model call may take, retries of the SDK included"""
+    return settings.PFD_BENCH_HTTP_POOL['call_deadline_s']
+
+
+def run_coroutine(coro, check=None, check_every_s=1.0, timeout_s=None):
+    """
+    Run coro on the shared event loop and wait for its result (from any thread but the loop's own).
+    check(), if given, is called every check_every_s while waiting: if it raises, coro is cancelled
+    (its requests in flight are closed) and the exception propagates.
+    Past timeout_s, if given, coro is cancelled the same way and TimeoutError is raised
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    deadline = time.monotonic() + timeout_s if timeout_s else None
+
+    while True:
+        wait_s = check_every_s if check is not None else None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                future.cancel()
+                raise TimeoutError(f"No answer after {timeout_s:.0f}s, the call was cancelled")
+            wait_s = remaining if wait_s is None else min(wait_s, remaining)
+
+        try:
+            return future.result(timeout=wait_s)
+        except concurrent.futures.TimeoutError:
+            if future.done():
+                raise  # raised by coro itself
+            if check is None:
+                continue
+            try:
+                check()
+            except BaseException:
+                future.cancel()
+                raise
+
+
+
+###################################################################
+# Connection reuse metrics
+###################################################################
+
+class ConnectionMetrics:
+    """Requests, new connections and TLS handshakes per host, for this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host, event):
+        with self._lock:
+            counters = self._hosts.setdefault(host, {"requests": 0, "connections": 0, "tls_handshakes": 0})
+            counters[event] += 1
+            log_now = event == "requests" and counters["requests"] % METRICS_LOG_EVERY == 0
+            snapshot = dict(counters)
+
+        if log_now:
+            reuse = 1 - snapshot["connections"] / snapshot["requests"]
+            logger.info(f"{host}: {snapshot['requests']} requests over {snapshot['connections']} connections "
+                        f"({reuse:.1%} reuse, {snapshot['tls_handshakes']} TLS handshakes)")
+
+    def snapshot(self):
+        with self._lock:
+            return {host: {**counters,
+                           "reuse": 1 - counters["connections"] / counters["requests"] if counters["requests"] else 0.0}
+                    for host, counters in self._hosts.items()}
+
+
+_metrics = ConnectionMetrics()
+
+
+def connection_metrics():
+    """Connection reuse per host of the shared httpx clients of this process"""
+    return _metrics.snapshot()
+
+
+# httpcore reports the steps of every request to the 'trace' extension; a new connection
+# shows up as connect_tcp, a TLS handshake as start_tls
+_TRACED_EVENTS = {"connection.connect_tcp.started": "connections",
+                  "connection.start_tls.started": "tls_handshakes"}
+
+
+def _trace_request(request):
+    host = request.url.host
+    _metrics.record(host, "requests")
+
+    def trace(event_name, info):
+        if event_name in _TRACED_EVENTS:
+            _metrics.record(host, _TRACED_EVENTS[event_name])
+
+    request.extensions["trace"] = trace
+
+
+async def _atrace_request(request):
+    host = request.url.host
+    _metrics.record(host, "requests")
+
+    async def trace(event_name, info):
+        if event_name in _TRACED_EVENTS:
+            _metrics.record(host, _TRACED_EVENTS[event_name])
+
+    request.extensions["trace"] = trace
+
+
+
+###################################################################
+# httpx clients (OpenAI)
+###################################################################
+
+def _http2_enabled():
+    if not settings.PFD_BENCH_HTTP_POOL['http2']:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("HTTP/2 requested but the h2 package is not installed, using HTTP/1.1")
+        return False
+
+
+def http_timeout():
+    pool = settings.PFD_BENCH_HTTP_POOL
+    return httpx.Timeout(pool['timeout_s'], connect=pool['connect_timeout_s'])
+
+
+def _client_kwargs():
+    pool = settings.PFD_BENCH_HTTP_POOL
+    return {
+        "limits": httpx.Limits(max_connections=pool['max_connections'],
+                               max_keepalive_connections=pool['max_keepalive_connections'],
+                               keepalive_expiry=pool['keepalive_expiry_s']),
+        "timeout": http_timeout(),
+        "http2": _http2_enabled(),
+    }
+
+
+def get_http_client():
+    """Get or create the shared httpx client"""
+    global _http_client
+
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(**_client_kwargs(), event_hooks={"request": [_trace_request]})
+            logger.info("Created new shared httpx client")
+
+    return _http_client
+
+
+def get_async_http_client():
+    """Get or create the shared async httpx client (only use it on the shared event loop)"""
+    global _async_http_client
+
+    with _lock:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(**_client_kwargs(), event_hooks={"request": [_atrace_request]})
+            logger.info("Created new shared async httpx client")
+
+    return _async_http_client
+
+
+
+###################################################################
+# Chat model transports
+###################################################################
+
+def transport_kwargs(model_id):
+    """Extra init_chat_model arguments so that the chat model uses the shared transport"""
+    provider = model_id.split(":", 1)[0]
+
+    if provider == "openai":
+        return {"http_client": get_http_client(),
+                "http_async_client": get_async_http_client(),
+                "timeout": http_timeout()}
+
+    if provider == "google_genai":
+        return {"timeout": settings.PFD_BENCH_HTTP_POOL['timeout_s']}
+
+    return {}
+
+
+# fields of the Google GenAI chat model that share_transport sets or reads; like the helpers of
+# _google_internals() they are private to langchain-google-genai (pinned in requirements.txt)
+_GOOGLE_FIELDS = ("client", "async_client_running", "google_api_key", "credentials", "transport", "client_options")
+
+
+def _google_internals(llm):
+    """
+    The async client builder and the client info helper of langchain_google_genai, or None if the
+    installed version lacks them or llm lacks one of _GOOGLE_FIELDS
+    """
+    try:
+        from langchain_google_genai import _genai_extension as genaix
+        from langchain_google_genai._common import get_client_info
+        build_async_service = genaix.build_generative_async_service
+    except (ImportError, AttributeError):
+        return None
+
+    if not all(field in getattr(type(llm), "model_fields", {}) for field in _GOOGLE_FIELDS):
+        return None
+    return build_async_service, get_client_info
+
+
+def share_transport(llm, model_id):
+    """
+    Point a Google GenAI chat model at the shared gRPC clients. The first model created provides
+    the sync client; the async one is created on the shared event loop, to which it is bound.
+    If langchain_google_genai no longer has the internals this relies on, the model keeps its own
+    transport
+    """
+    global _google_client, _google_async_client
+
+    if model_id.split(":", 1)[0] != "google_genai":
+        return llm
+
+    internals = _google_internals(llm)
+    if internals is None:
+        logger.warning(f"langchain_google_genai internals not found, {model_id} keeps its own transport")
+        return llm
+    build_async_service, get_client_info = internals
+
+    with _lock:
+        if _google_client is None:
+            _google_client = llm.client
+            logger.info("Created new shared Google GenAI client")
+    llm.client = _google_client
+
+    if _google_async_client is None:
+        async def build_async_client():
+            api_key = llm.google_api_key.get_secret_value() if llm.google_api_key and not llm.credentials else None
+            transport = "grpc_asyncio" if llm.transport == "rest" else llm.transport  # async clients have no rest transport
+            return build_async_service(credentials=llm.credentials, api_key=api_key,
+                                       client_info=get_client_info("ChatGoogleGenerativeAI"),
+                                       client_options=llm.client_options, transport=transport)
+
+        async_client = run_coroutine(build_async_client())
+        with _lock:
+            if _google_async_client is None:
+                _google_async_client = async_client
+    llm.async_client_running = _google_async_client
+
+    return llm
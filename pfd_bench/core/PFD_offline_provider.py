@@ -0,0 +1,304 @@
+"""
+Offline stand-in for the chat models used in PFD_bench_setup.py
+
+Selected with PFD_BENCH_LLM_PROVIDER=offline. It needs no network and no API keys, and returns
+schema-valid structured outputs derived from the request itself:
+- EquipmentTable: one row per equipment block of the dxf extract
+- AuditedEquipmentTables: the same rows, without findings
+- GeneratorOutput: one section per row of the connectivity table
+- DescriptionSections: one section per equipment to rewrite
+- PartDescription: one section per equipment of the part to describe
+- StitchOutput: an introduction and one transition per part after the first
+
+Latency follows a log-normal distribution and a configurable fraction of the calls fail like an
+overloaded provider would (429/503), so the Celery pipeline and the UI can be load-tested end to end.
+Streamed calls deliver the JSON of the output in chunks spread over that latency.
+"""
+
+import re
+import json
+import math
+import random
+import time
+import asyncio
+import logging
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_offline_provider')
+
+
+STREAM_CHUNK_CHARS = 16             # about 4 tokens per streamed chunk
+STREAM_FIRST_TOKEN_FRACTION = 0.1   # share of the latency before the first chunk
+
+
+class OfflineProviderError(Exception):
+    """Simulated provider failure; status_code mimics the HTTP status of the real providers"""
+
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+
+###################################################################
+# Responses derived from the request
+###################################################################
+
+def _find_json_object(text):
+    """Return the first JSON object embedded in text (the dxf extract), or None"""
+    decoder = json.JSONDecoder()
+    start = text.find('{')
+    while start != -1:
+        try:
+            obj, _ = decoder.raw_decode(text, start)
+            return obj
+        except ValueError:
+            start = text.find('{', start + 1)
+    return None
+
+
+def _user_content(messages):
+    """Concatenate the user content of a list of chat messages (dicts or langchain messages)"""
+    parts = []
+    for message in messages:
+        if isinstance(message, dict):
+            role, content = message.get("role"), message.get("content", "")
+        else:
+            role, content = getattr(message, "type", None), getattr(message, "content", "")
+        if role in ("user", "human"):
+            parts.append(str(content))
+    return "\n".join(parts)
+
+
+def offline_equipment_rows(dxf_extract):
+    """One row per equipment block of the extract (flow arrows and untagged blocks are skipped)"""
+    rows = []
+    blocks = (dxf_extract or {}).get("entities", {}).get("blocks", [])
+
+    for idx, block in enumerate(blocks):
+        block_name = block.get("block_name", "")
+        if 'arrow' in block_name.lower() or 'flow' in block_name.lower():
+            continue
+        attributes = block.get("attributes") or {}
+        if not attributes:
+            continue
+
+        tag = next(iter(attributes.values()))
+        near_lines = int(block.get("near_lines", 0))
+        inlet_count = (near_lines + 1) // 2
+        outlet_count = near_lines // 2
+
+        rows.append({
+            "tag": tag,
+            "equipment_type": block_name,
+            "inlet_streams": ", ".join(f"Stream {n + 1}" for n in range(inlet_count)) or "None",
+            "inlet_count": inlet_count,
+            "outlet_streams": ", ".join(f"Stream {n + 1}" for n in range(outlet_count)) or "None",
+            "outlet_count": outlet_count,
+            "remarks": f"Offline stand-in, block {idx} on layer {block.get('layer', '')}",
+        })
+
+    return rows
+
+
+def offline_description_sections(connectivity_table, tags=None):
+    """One section per equipment row of the connectivity table, in any table format (only the given tags, if any)"""
+    from .PFD_table_serializer import parse_table
+
+    sections = []
+    for row in parse_table(connectivity_table):
+        tag = row.get("tag", "")
+        if tags is not None and tag not in tags:
+            continue
+        sections.append({"tag": tag, "heading": "Main Process",
+                         "text": f"{tag} ({row.get('equipment_type', '')}) receives {row.get('inlet_streams') or 'no streams'} "
+                                 f"and sends {row.get('outlet_streams') or 'no streams'}."})
+    return sections
+
+
+def _tags_to_rewrite(content):
+    """The tags of the 'Equipment to rewrite:' (or 'to describe:') line of a regenerator (or section generator) request"""
+    match = re.search(r"Equipment to (?:rewrite|describe):\s*(.+)", content)
+    return [tag.strip() for tag in match.group(1).split(",")] if match else None
+
+
+def _first_tags_of_parts(content):
+    """The first equipment of every part of the outline of a stitch request"""
+    return re.findall(r"Part \d+:\s*\n\s*- (.+?) \(", content)
+
+
+def build_offline_response(schema, messages):
+    """Build a schema-valid response for one of the structured outputs of PFD_bench_setup.py"""
+    from .PFD_bench_setup import (EquipmentTable, AuditedEquipmentTables,
+                                  AuditFindingsTable, GeneratorOutput, DescriptionSections,
+                                  PartDescription, StitchOutput)
+
+    content = _user_content(messages)
+
+    if schema is EquipmentTable:
+        rows = offline_equipment_rows(_find_json_object(content))
+        return EquipmentTable(title="Offline Equipment Table", rows=rows)
+
+    if schema is AuditedEquipmentTables:
+        rows = offline_equipment_rows(_find_json_object(content))
+        return AuditedEquipmentTables(
+            audit_findings=AuditFindingsTable(title="Audit Findings Table", findings=[]),
+            corrected_equipment_table=EquipmentTable(title="Final Corrected Table", rows=rows),
+        )
+
+    if schema is GeneratorOutput:
+        return GeneratorOutput(introduction="Process Description (offline stand-in)",
+                               sections=offline_description_sections(content))
+
+    if schema is DescriptionSections:
+        return DescriptionSections(sections=offline_description_sections(content, _tags_to_rewrite(content)))
+
+    if schema is PartDescription:
+        return PartDescription(sections=offline_description_sections(content, _tags_to_rewrite(content)))
+
+    if schema is StitchOutput:
+        return StitchOutput(introduction="Process Description (offline stand-in)",
+                            transitions=[{"tag": tag, "text": f"The process continues with {tag}."}
+                                         for tag in _first_tags_of_parts(content)[1:]])
+
+    raise ValueError(f"The offline provider has no stand-in for {schema.__name__}")
+
+
+
+###################################################################
+# Chat model stand-in
+###################################################################
+
+class OfflineChatModel:
+    """
+    Drop-in for the object returned by init_chat_model, as far as PFD_bench_setup.py uses it
+
+    latency_median_s and latency_sigma parametrize the log-normal latency of each call;
+    error_rate is the probability that a call fails with a simulated 429/503
+    """
+
+    def __init__(self, model_id, latency_median_s=2.0, latency_sigma=0.5, error_rate=0.0, seed=None):
+        self.model_id = model_id
+        self.latency_median_s = latency_median_s
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+    def with_structured_output(self, schema, include_raw=False, **kwargs):
+        return OfflineStructuredModel(self, schema, include_raw)
+
+    def sample_latency(self):
+        if self.latency_median_s <= 0:
+            return 0.0
+        return self._random.lognormvariate(math.log(self.latency_median_s), self.latency_sigma)
+
+    def sample_error(self):
+        """Return an OfflineProviderError to raise, or None"""
+        if self._random.random() < self.error_rate:
+            status_code = self._random.choice([429, 503])
+            return OfflineProviderError(f"Simulated error {status_code} from offline {self.model_id}",
+                                        status_code=status_code)
+        return None
+
+
+class OfflineStructuredModel:
+    """Result of OfflineChatModel.with_structured_output"""
+
+    def __init__(self, model, schema, include_raw=False):
+        self.model = model
+        self.schema = schema
+        self.include_raw = include_raw
+
+    def _respond(self, messages):
+        parsed = build_offline_response(self.schema, messages)
+        if not self.include_raw:
+            return parsed
+
+        # same shape as the live models with include_raw=True; tokens estimated at ~4 characters each
+        from langchain_core.messages import AIMessage
+
+        output = parsed.model_dump_json()
+        input_tokens = sum(len(str(m.get("content", "")) if isinstance(m, dict) else str(m.content))
+                           for m in messages) // 4
+        output_tokens = len(output) // 4
+        raw = AIMessage(content=output,
+                        usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                        "total_tokens": input_tokens + output_tokens})
+        return {"raw": raw, "parsed": parsed, "parsing_error": None}
+
+    def invoke(self, messages, config=None, **kwargs):
+        latency = self.model.sample_latency()
+        error = self.model.sample_error()
+        time.sleep(latency)
+        if error:
+            raise error
+        logger.info(f"offline {self.model.model_id} answered {self.schema.__name__} in {latency:.2f}s")
+        return self._respond(messages)
+
+    def stream(self, messages, config=None, **kwargs):
+        """
+        Like the live structured agents: the tokens go to the on_llm_new_token callbacks of config,
+        the output is yielded as the 'raw', 'parsed' and 'parsing_error' parts of the response
+        """
+        from langchain_core.messages import AIMessageChunk
+        from langchain_core.outputs import ChatGenerationChunk
+
+        latency = self.model.sample_latency()
+        error = self.model.sample_error()
+        response = self._respond(messages)
+        output = response["raw"].content if self.include_raw else response.model_dump_json()
+        callbacks = (config or {}).get("callbacks") or []
+
+        pieces = [output[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(output), STREAM_CHUNK_CHARS)]
+        time.sleep(latency * STREAM_FIRST_TOKEN_FRACTION)
+        if error:
+            raise error
+        for piece in pieces:
+            for callback in callbacks:
+                callback.on_llm_new_token(piece, chunk=ChatGenerationChunk(message=AIMessageChunk(content=piece)))
+            time.sleep(latency * (1 - STREAM_FIRST_TOKEN_FRACTION) / len(pieces))
+
+        logger.info(f"offline {self.model.model_id} streamed {self.schema.__name__} in {latency:.2f}s")
+        if not self.include_raw:
+            yield response
+            return
+        for key in ("raw", "parsed", "parsing_error"):
+            yield {key: response[key]}
+
+    async def ainvoke(self, messages, config=None, **kwargs):
+        latency = self.model.sample_latency()
+        error = self.model.sample_error()
+        await asyncio.sleep(latency)
+        if error:
+            raise error
+        logger.info(f"offline {self.model.model_id} answered {self.schema.__name__} in {latency:.2f}s")
+        return self._respond(messages)
+
+    async def astream(self, messages, config=None, **kwargs):
+        """Async stream(); the callbacks run off the event loop, as the sync handlers of the live models do"""
+        from langchain_core.messages import AIMessageChunk
+        from langchain_core.outputs import ChatGenerationChunk
+
+        latency = self.model.sample_latency()
+        error = self.model.sample_error()
+        response = self._respond(messages)
+        output = response["raw"].content if self.include_raw else response.model_dump_json()
+        callbacks = (config or {}).get("callbacks") or []
+
+        pieces = [output[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(output), STREAM_CHUNK_CHARS)]
+        await asyncio.sleep(latency * STREAM_FIRST_TOKEN_FRACTION)
+        if error:
+            raise error
+        for piece in pieces:
+            for callback in callbacks:
+                await asyncio.to_thread(callback.on_llm_new_token, piece,
+                                        chunk=ChatGenerationChunk(message=AIMessageChunk(content=piece)))
+            await asyncio.sleep(latency * (1 - STREAM_FIRST_TOKEN_FRACTION) / len(pieces))
+
+        logger.info(f"offline {self.model.model_id} streamed {self.schema.__name__} in {latency:.2f}s")
+        if not self.include_raw:
+            yield response
+            return
+        for key in ("raw", "parsed", "parsing_error"):
+            yield {key: response[key]}
@@ -0,0 +1,204 @@
+"""
+Pre-flight token estimates for the nodes of the step-1 and step-2 graphs
+
+Before a graph is invoked, the prompt and output tokens of every node are estimated with the
+tokenizer we ship (tiktoken) and compared with the context window and output limit of the model
+the node is routed to (PFD_BENCH_MODEL_LIMITS). If a node does not fit, the plan degrades in order:
+1) compact encoding of the dxf extract (no indentation)
+2) the default (larger) model of the roles that still do not fit
+3) fail fast with a PreflightError, before any model is called
+"""
+
+import json
+import logging
+
+from django.conf import settings
+
+from .PFD_utils import estimate_tokens
+from .PFD_prompt_templates import (PFD_extraction_worker_system_prompt,
+                                   PFD_extraction_auditor_system_prompt,
+                                   PFD_generator_system_prompt,
+                                   PFD_regenerator_system_prompt,
+                                   PFD_section_generator_system_prompt,
+                                   PFD_stitcher_system_prompt
+                                   )
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_preflight')
+
+
+EXTRACT_ENCODINGS = ('indented', 'compact')
+
+# output sizes, measured on the structured outputs of the nodes
+TABLE_HEADER_TOKENS = 50
+TABLE_ROW_TOKENS = 80           # one EquipmentRow as JSON
+DESCRIPTION_ROW_TOKENS = 150    # one paragraph of the process description per equipment
+PROMPT_WRAPPER_TOKENS = 200     # instructions around the content in the user messages
+OUTLINE_ROW_TOKENS = 40         # one section in the outline the stitch reads (tag, heading, first sentence)
+INTRODUCTION_TOKENS = 300       # the introduction the stitch writes
+TRANSITION_TOKENS = 60          # one transition between two parts
+
+
+class PreflightError(Exception):
+    """The input of a step does not fit the models it can be routed to"""
+    pass
+
+
+def encode_extract(dxf_extract_dict, encoding='indented'):
+    """Serialize the dxf extract for the prompts; 'compact' drops indentation and spaces"""
+    if encoding == 'compact':
+        return json.dumps(dxf_extract_dict, separators=(',', ':'), default=str)
+    return json.dumps(dxf_extract_dict, indent=2, default=str)
+
+
+def _node_estimate(model_id, input_tokens, output_tokens, calls=1):
+    """Estimate of one node (tokens per call) and whether it fits the limits of its model"""
+    limits = settings.PFD_BENCH_MODEL_LIMITS.get(model_id, {})
+    margin = settings.PFD_BENCH_PREFLIGHT_MARGIN  # tiktoken is not the tokenizer of every provider
+    context_window, max_output = limits.get('context_window'), limits.get('max_output')
+
+    fits = True
+    if context_window and (input_tokens + output_tokens) * margin > context_window:
+        fits = False
+    if max_output and output_tokens * margin > max_output:
+        fits = False
+
+    return {"model": model_id, "calls": calls, "input_tokens": input_tokens, "output_tokens": output_tokens,
+            "context_window": context_window, "max_output": max_output, "fits": fits}
+
+
+def estimate_step_1(dxf_extract, equipment_count, model_route, ensemble_size=1):
+    """Token estimate of the worker and auditor nodes of step 1 (the auditor also reads the worker table)"""
+    extract_tokens = estimate_tokens(dxf_extract)
+    table_tokens = TABLE_HEADER_TOKENS + equipment_count * TABLE_ROW_TOKENS
+
+    worker_node = "worker_sample_node" if ensemble_size > 1 else "worker_node"
+    auditor_node = "disputed_auditor_node" if ensemble_size > 1 else "auditor_node"
+
+    return {
+        worker_node: _node_estimate(model_route["worker"]["model"],
+                                    estimate_tokens(PFD_extraction_worker_system_prompt) + extract_tokens,
+                                    table_tokens, calls=ensemble_size),
+        # corrected table plus (at most) one finding per row; with an ensemble only the disputed rows, so an upper bound
+        auditor_node: _node_estimate(model_route["auditor"]["model"],
+                                     estimate_tokens(PFD_extraction_auditor_system_prompt) + extract_tokens
+                                     + table_tokens + PROMPT_WRAPPER_TOKENS,
+                                     2 * table_tokens),
+    }
+
+
+STEP_2_PROMPTS = {"generator_node": PFD_generator_system_prompt,
+                  "regenerator_node": PFD_regenerator_system_prompt}
+
+
+def estimate_step_2(connectivity_table, equipment_count, model_route, node_name="generator_node", parts=None):
+    """
+    Token estimate of the generator node of step 2 (or of the regenerator, incremental mode, where
+    equipment_count is the number of sections to rewrite).
+    With parts (map-reduce mode: tags and table of each part) the section generators and the stitch
+    """
+    if parts:
+        model_id = model_route["generator"]["model"]
+        prompt_tokens = estimate_tokens(PFD_section_generator_system_prompt) + PROMPT_WRAPPER_TOKENS
+        # every part must fit: the largest one, for each call (the totals are an upper bound)
+        return {
+            "section_generator_node": _node_estimate(model_id,
+                                                     prompt_tokens + max(estimate_tokens(part["connectivity_table"]) for part in parts),
+                                                     max(len(part["tags"]) for part in parts) * DESCRIPTION_ROW_TOKENS,
+                                                     calls=len(parts)),
+            "stitch_node": _node_estimate(model_id,
+                                          estimate_tokens(PFD_stitcher_system_prompt) + PROMPT_WRAPPER_TOKENS
+                                          + equipment_count * OUTLINE_ROW_TOKENS,
+                                          INTRODUCTION_TOKENS + (len(parts) - 1) * TRANSITION_TOKENS),
+        }
+
+    return {
+        node_name: _node_estimate(model_route["generator"]["model"],
+                                  estimate_tokens(STEP_2_PROMPTS[node_name]) + estimate_tokens(connectivity_table),
+                                  equipment_count * DESCRIPTION_ROW_TOKENS),
+    }
+
+
+def _summary(nodes, **extra):
+    return {**extra,
+            "nodes": nodes,
+            "total_input_tokens": sum(n["input_tokens"] * n["calls"] for n in nodes.values()),
+            "total_output_tokens": sum(n["output_tokens"] * n["calls"] for n in nodes.values())}
+
+
+def _reroute_to_default(model_route, nodes, node_roles, default_models):
+    """Send the roles whose node does not fit to the default model of the role"""
+    rerouted = dict(model_route)
+    for node_name, estimate in nodes.items():
+        role = node_roles[node_name]
+        if not estimate["fits"] and model_route[role]["model"] != default_models[role]:
+            rerouted[role] = {"route": "preflight", "model": default_models[role]}
+    return rerouted
+
+
+def _oversize_message(nodes):
+    return "; ".join(f"{node_name} needs {n['input_tokens']} input + {n['output_tokens']} output tokens, "
+                     f"{n['model']} allows {n['context_window']} (max output {n['max_output']})"
+                     for node_name, n in nodes.items() if not n["fits"])
+
+
+def preflight_step_1(dxf_extract_dict, equipment_count, model_route, ensemble_size=1):
+    """
+    Plan step 1 so that every node fits its model.
+    Returns the encoded extract, the (possibly rerouted) model route and the estimate; raises PreflightError
+    """
+    from .PFD_bench_setup import NODE_ROLES, DEFAULT_ROLE_MODELS
+
+    for encoding in EXTRACT_ENCODINGS:
+        dxf_extract = encode_extract(dxf_extract_dict, encoding)
+        nodes = estimate_step_1(dxf_extract, equipment_count, model_route, ensemble_size)
+        if all(n["fits"] for n in nodes.values()):
+            return dxf_extract, model_route, _summary(nodes, encoding=encoding)
+
+    rerouted = _reroute_to_default(model_route, nodes, NODE_ROLES, DEFAULT_ROLE_MODELS)
+    if rerouted != model_route:
+        nodes = estimate_step_1(dxf_extract, equipment_count, rerouted, ensemble_size)
+        if all(n["fits"] for n in nodes.values()):
+            logger.info(f"Pre-flight rerouted step 1 to {rerouted}")
+            return dxf_extract, rerouted, _summary(nodes, encoding='compact', rerouted=True)
+
+    raise PreflightError(f"The drawing is too large for step 1: {_oversize_message(nodes)}")
+
+
+def preflight_step_2(connectivity_table, equipment_count, model_route, node_name="generator_node", parts=None):
+    """
+    Plan step 2 so that the generator (or the regenerator, or the map-reduce nodes) fits its model.
+    Returns the (possibly rerouted) model route and the estimate; raises PreflightError
+    """
+    from .PFD_bench_setup import NODE_ROLES, DEFAULT_ROLE_MODELS
+
+    nodes = estimate_step_2(connectivity_table, equipment_count, model_route, node_name, parts)
+    if all(n["fits"] for n in nodes.values()):
+        return model_route, _summary(nodes)
+
+    rerouted = _reroute_to_default(model_route, nodes, NODE_ROLES, DEFAULT_ROLE_MODELS)
+    if rerouted != model_route:
+        nodes = estimate_step_2(connectivity_table, equipment_count, rerouted, node_name, parts)
+        if all(n["fits"] for n in nodes.values()):
+            logger.info(f"Pre-flight rerouted step 2 to {rerouted}")
+            return rerouted, _summary(nodes, rerouted=True)
+
+    raise PreflightError(f"The table is too large for step 2: {_oversize_message(nodes)}")
+
+
+def usage_summary(node_artifacts):
+    """Actual token usage of a step per node, in the same shape as the estimate"""
+    nodes = {}
+    for artifact in node_artifacts:
+        if not artifact.get("model_id"):
+            continue  # local nodes (e.g. reconcile) call no model
+        node = nodes.setdefault(artifact["node"], {"model": artifact["model_id"], "calls": 0,
+                                                   "input_tokens": 0, "output_tokens": 0})
+        node["calls"] += 1
+        node["input_tokens"] += artifact.get("input_tokens") or 0
+        node["output_tokens"] += artifact.get("output_tokens") or 0
+
+    return {"nodes": nodes,
+            "total_input_tokens": sum(n["input_tokens"] for n in nodes.values()),
+            "total_output_tokens": sum(n["output_tokens"] for n in nodes.values())}
@@ -0,0 +1,356 @@
+"""
+Cross-worker rate limiter for the LLM providers
+
+All Celery processes share, per provider:model (e.g. 'google_genai:gemini-2.5-pro'), in Redis:
+- a token bucket for requests/min and one for tokens/min, refilled continuously
+- an adaptive concurrency limit (AIMD): halved on a 429/503, increased by 1/limit on every success,
+  so a batch of runs settles just below what the provider accepts instead of burning Celery retries
+
+The nodes acquire capacity through call_with_capacity() (acall_with_capacity() for async calls)
+before calling the model. Limits are set per model in PFD_BENCH_RATE_LIMITS. If Redis is
+unreachable the limiter fails open (calls are not blocked).
+"""
+
+import time
+import uuid
+import random
+import asyncio
+import logging
+import threading
+
+import redis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+from .PFD_http_clients import call_deadline_s
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_rate_limiter')
+
+
+KEY_PREFIX = "pfd_bench:ratelimit"
+
+THROTTLE_STATUS_CODES = (429, 503)
+THROTTLE_RETRIES = 3            # throttled calls are retried here, once capacity is available again
+THROTTLE_COOLDOWN_S = 10        # one halving of the concurrency limit per cooldown, however many calls fail
+ACQUIRE_TIMEOUT_S = 10 * 60
+LEASE_MARGIN_S = 60
+MAX_POLL_S = 2.0
+
+
+def lease_ttl_s():
+    """
+    Lifetime of a concurrency slot, after which the slot of a crashed worker is freed: longer than a
+    live holder can keep it (the wait for the buckets, then the call until its deadline)
+    """
+    return int(ACQUIRE_TIMEOUT_S + call_deadline_s() + LEASE_MARGIN_S)
+
+
+class RateLimitTimeout(Exception):
+    """No provider capacity became available within ACQUIRE_TIMEOUT_S"""
+    pass
+
+
+
+###################################################################
+# Lua scripts (atomic across workers, Redis clock)
+###################################################################
+
+# KEYS[1] bucket hash; ARGV rpm, tpm, cost (0 = no limit)
+# Takes one request and `cost` tokens and returns '0', or returns the seconds to wait (nothing taken)
+_TAKE_BUCKET = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), tpm)
+
+local bucket = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts')
+local requests = tonumber(bucket[1]) or rpm
+local tokens = tonumber(bucket[2]) or tpm
+local elapsed = math.max(0, now - (tonumber(bucket[3]) or now))
+requests = math.min(rpm, requests + elapsed * rpm / 60)
+tokens = math.min(tpm, tokens + elapsed * tpm / 60)
+
+local wait = 0
+if rpm > 0 and requests < 1 then
+    wait = (1 - requests) * 60 / rpm
+end
+if tpm > 0 and tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60 / tpm)
+end
+if wait == 0 then
+    requests = requests - 1
+    tokens = tokens - cost
+end
+
+redis.call('HSET', KEYS[1], 'requests', tostring(requests), 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(wait)
+"""
+
+# KEYS[1] bucket hash; ARGV delta (actual - estimated tokens), tpm
+# Charges the difference once the real usage is known (may leave the bucket in debt)
+_SETTLE_BUCKET = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[2]), tokens - tonumber(ARGV[1]))))
+end
+return 0
+"""
+
+# KEYS[1] leases zset, KEYS[2] concurrency limit; ARGV lease id, max concurrency, lease ttl
+# Returns 1 if the lease was taken
+_TAKE_SLOT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+
+local limit = tonumber(redis.call('GET', KEYS[2])) or tonumber(ARGV[2])
+if redis.call('ZCARD', KEYS[1]) < math.max(1, math.floor(limit)) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] concurrency limit, KEYS[2] cooldown flag; ARGV 'success' or 'throttle', max concurrency, cooldown
+# Returns the new limit
+_ADAPT_LIMIT = """
+local max_concurrency = tonumber(ARGV[2])
+local limit = tonumber(redis.call('GET', KEYS[1])) or max_concurrency
+
+if ARGV[1] == 'throttle' then
+    if redis.call('SET', KEYS[2], '1', 'NX', 'EX', tonumber(ARGV[3])) then
+        limit = math.max(1, limit / 2)
+    end
+else
+    limit = math.min(max_concurrency, limit + 1 / limit)
+end
+
+redis.call('SET', KEYS[1], tostring(limit), 'EX', 3600)
+return tostring(limit)
+"""
+
+
+
+###################################################################
+# Helpers
+###################################################################
+
+def provider_status_code(exc):
+    """HTTP status of a provider exception (openai, google genai, offline stand-in), or None"""
+    for candidate in (getattr(exc, "status_code", None), getattr(exc, "code", None),
+                      getattr(getattr(exc, "response", None), "status_code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def is_throttle_error(exc):
+    return provider_status_code(exc) in THROTTLE_STATUS_CODES
+
+
+def model_limits(model_id):
+    """rpm, tpm and max_concurrency of a model (PFD_BENCH_RATE_LIMITS, falling back to 'default')"""
+    limits = settings.PFD_BENCH_RATE_LIMITS
+    return {**limits.get('default', {}), **limits.get(model_id, {})}
+
+
+def _keys(model_id):
+    base = f"{KEY_PREFIX}:{model_id}"
+    return {"bucket": f"{base}:bucket", "leases": f"{base}:leases",
+            "limit": f"{base}:limit", "cooldown": f"{base}:cooldown"}
+
+
+
+###################################################################
+# Limiter
+###################################################################
+
+class ProviderRateLimiter:
+    """Rate limits and adaptive concurrency of one provider:model, shared through Redis"""
+
+    def __init__(self, model_id, rpm=0, tpm=0, max_concurrency=0):
+        self.model_id = model_id
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.keys = _keys(model_id)
+
+    def acquire(self, estimated_tokens, cancel_event=None):
+        """
+        Block until a request of estimated_tokens fits the buckets and a concurrency slot is free; returns the lease id.
+        Returns None, holding nothing, if cancel_event is set while waiting
+        """
+        client = get_redis()
+        lease_id = uuid.uuid4().hex
+        deadline = time.monotonic() + ACQUIRE_TIMEOUT_S
+        waited = 0.0
+
+        # concurrency first, so a queued call does not hold rpm/tpm budget while it waits
+        if self.max_concurrency:
+            while not client.eval(_TAKE_SLOT, 2, self.keys["leases"], self.keys["limit"],
+                                  lease_id, self.max_concurrency, lease_ttl_s()):
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                waited += self._sleep(MAX_POLL_S, deadline)
+
+        if self.rpm or self.tpm:
+            while True:
+                try:
+                    wait = float(client.eval(_TAKE_BUCKET, 1, self.keys["bucket"],
+                                             self.rpm, self.tpm, estimated_tokens))
+                except redis.RedisError:
+                    # the caller goes on without the limiter: do not leave the slot taken until its lease expires
+                    _safe_release(self, lease_id, estimated_tokens)
+                    raise
+                if wait <= 0:
+                    break
+                if cancel_event is not None and cancel_event.is_set():
+                    self.release(lease_id)
+                    return None
+                try:
+                    waited += self._sleep(wait, deadline)
+                except RateLimitTimeout:
+                    self.release(lease_id)
+                    raise
+
+        if waited:
+            logger.info(f"waited {waited:.1f}s for {self.model_id} capacity")
+
+        return lease_id
+
+    def release(self, lease_id, estimated_tokens=0, used_tokens=None, outcome=None):
+        """
+        Free the concurrency slot, charge the real token usage against the estimate and adapt the
+        concurrency limit ('success' or 'throttle'; None leaves it unchanged)
+        """
+        client = get_redis()
+
+        if self.max_concurrency:
+            client.zrem(self.keys["leases"], lease_id)
+            if outcome:
+                limit = float(client.eval(_ADAPT_LIMIT, 2, self.keys["limit"], self.keys["cooldown"],
+                                          outcome, self.max_concurrency, THROTTLE_COOLDOWN_S))
+                if outcome == 'throttle':
+                    logger.warning(f"{self.model_id} throttled, concurrency limit now {limit:.2f}")
+
+        if self.tpm and used_tokens is not None and used_tokens != estimated_tokens:
+            client.eval(_SETTLE_BUCKET, 1, self.keys["bucket"], used_tokens - estimated_tokens, self.tpm)
+
+    @staticmethod
+    def _sleep(seconds, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RateLimitTimeout("No provider capacity available")
+        # jitter, so waiting workers do not all come back at the same moment
+        seconds = min(seconds, MAX_POLL_S, remaining) * random.uniform(0.8, 1.2)
+        time.sleep(seconds)
+        return seconds
+
+
+def get_rate_limiter(model_id):
+    """Limiter of a provider:model, or None when rate limiting is disabled"""
+    if not settings.PFD_BENCH_RATE_LIMIT_ENABLED:
+        return None
+    return ProviderRateLimiter(model_id, **model_limits(model_id))
+
+
+def call_with_capacity(model_id, estimated_tokens, invoke):
+    """
+    Call invoke() once capacity is available for model_id.
+    invoke() returns the parsed response and its token usage, and so does call_with_capacity().
+
+    Throttled calls (429/503) halve the shared concurrency limit and are retried up to
+    THROTTLE_RETRIES times; any other error is raised as is
+    """
+    limiter = get_rate_limiter(model_id)
+    if limiter is None:
+        return invoke()
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        try:
+            lease_id = limiter.acquire(estimated_tokens)
+        except redis.RedisError as e:
+            # never block the pipeline on the limiter itself
+            logger.warning(f"Rate limiter unavailable, calling {model_id} without it: {str(e)}")
+            return invoke()
+
+        try:
+            response, usage = invoke()
+        except Exception as e:
+            if not _after_error(limiter, lease_id, estimated_tokens, e, attempt):
+                raise
+            continue
+
+        _after_success(limiter, lease_id, estimated_tokens, usage)
+        return response, usage
+
+
+async def acall_with_capacity(model_id, estimated_tokens, ainvoke):
+    """
+    Async counterpart of call_with_capacity(), for calls that may be cancelled (e.g. the loser of
+    a hedged request): a cancelled call gives its capacity back without adapting the limit
+    """
+    limiter = get_rate_limiter(model_id)
+    if limiter is None:
+        return await ainvoke()
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        cancel_event = threading.Event()
+        try:
+            lease_id = await asyncio.to_thread(_acquire_or_release, limiter, estimated_tokens, cancel_event)
+        except asyncio.CancelledError:
+            cancel_event.set()  # the waiting thread gives up (or releases what it got) on its own
+            raise
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable, calling {model_id} without it: {str(e)}")
+            return await ainvoke()
+
+        try:
+            response, usage = await ainvoke()
+        except asyncio.CancelledError:
+            _safe_release(limiter, lease_id, estimated_tokens)
+            raise
+        except Exception as e:
+            if not _after_error(limiter, lease_id, estimated_tokens, e, attempt):
+                raise
+            continue
+
+        _after_success(limiter, lease_id, estimated_tokens, usage)
+        return response, usage
+
+
+def _acquire_or_release(limiter, estimated_tokens, cancel_event):
+    """acquire() for a thread whose caller may be cancelled meanwhile"""
+    lease_id = limiter.acquire(estimated_tokens, cancel_event)
+    if lease_id is not None and cancel_event.is_set():
+        _safe_release(limiter, lease_id, estimated_tokens)
+    return lease_id
+
+
+def _after_error(limiter, lease_id, estimated_tokens, exc, attempt):
+    """Release the lease of a failed call; returns True if the call should be retried"""
+    throttled = is_throttle_error(exc)
+    _safe_release(limiter, lease_id, estimated_tokens, outcome='throttle' if throttled else None)
+    if not throttled or attempt == THROTTLE_RETRIES:
+        return False
+    logger.warning(f"{limiter.model_id} returned {provider_status_code(exc)}, retry {attempt + 1}/{THROTTLE_RETRIES}")
+    return True
+
+
+def _after_success(limiter, lease_id, estimated_tokens, usage):
+    used_tokens = None
+    if usage.get("input_tokens") is not None:
+        used_tokens = usage["input_tokens"] + (usage.get("output_tokens") or 0)
+    _safe_release(limiter, lease_id, estimated_tokens, used_tokens, outcome='success')
+
+
+def _safe_release(limiter, lease_id, estimated_tokens, used_tokens=None, outcome=None):
+    try:
+        limiter.release(lease_id, estimated_tokens, used_tokens, outcome)
+    except redis.RedisError as e:
+        logger.warning(f"Could not release the {limiter.model_id} lease: {str(e)}")
@@ -0,0 +1,38 @@
+"""
+Shared Redis connection for the coordination state of the pipeline (rate limits and other
+cross-worker bookkeeping). Redis is already our Celery broker, so it adds no new service.
+
+Its callers fail open on Redis errors, so a connect or a read gives up after
+PFD_BENCH_REDIS_TIMEOUT_S: an unreachable or hung Redis then costs a request or a run a few
+seconds, not the TCP timeouts of the system.
+"""
+
+import logging
+
+import redis
+from django.conf import settings
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_redis')
+
+
+# Singleton - one connection pool per process
+_redis_client = None
+
+
+def redis_timeouts():
+    """Timeouts of the clients that must not wait on Redis, for Redis.from_url"""
+    return {"socket_timeout": settings.PFD_BENCH_REDIS_TIMEOUT_S,
+            "socket_connect_timeout": settings.PFD_BENCH_REDIS_TIMEOUT_S}
+
+
+def get_redis():
+    """Get or create the Redis client (PFD_BENCH_REDIS_URL, defaults to the Celery broker)"""
+    global _redis_client
+
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.PFD_BENCH_REDIS_URL, decode_responses=True, **redis_timeouts())
+        logger.info("Created new Redis client instance")
+
+    return _redis_client
@@ -0,0 +1,113 @@
+"""
+Speculative generation of the process description (step 2) while the review is still in progress
+
+Once the reviewer has gone through PFD_BENCH_SPECULATIVE['fraction'] of the rows (or all of them),
+the generator runs in the background on the table as it stands. Its artifacts are saved as
+speculative, keyed by the hash of the connectivity table. When the run is finalized, step 2 looks
+for the artifacts of the same table: on a hit the description is used as is (waiting for a
+speculation still in flight), on a miss step 2 runs normally and the speculation is wasted.
+
+At most one speculation per run is in flight, held by a Redis lease; the outcome of each run is
+recorded on Run.speculation (speculation_report summarises the hit rate).
+"""
+
+import time
+import hashlib
+import logging
+
+import redis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_speculation')
+
+
+KEY_PREFIX = "pfd_bench:speculation"
+POLL_S = 1.0
+
+
+def table_hash(connectivity_table):
+    """Key of a speculation: the connectivity table the generator sees"""
+    return hashlib.sha256(connectivity_table.encode("utf-8")).hexdigest()
+
+
+def _lease_key(run_id):
+    return f"{KEY_PREFIX}:lease:{run_id}"
+
+
+def speculation_enabled(cassette_mode=None):
+    # cassettes are kept per run and step: a speculative call must not record over (or replay) step 2,
+    # nor stand in for the calls of a step 2 recorded or replayed (cassette_mode overrides the setting)
+    return settings.PFD_BENCH_SPECULATIVE['enabled'] and (cassette_mode or settings.PFD_BENCH_CASSETTE_MODE) == 'off'
+
+
+def claim_speculation(run, reviewed_count):
+    """
+    Whether the review of run is far enough along for a speculation on its current table.
+    Returns the hash of the table to speculate on (the lease is taken) or None
+    """
+    from ..models import RunArtifact  # Import here to avoid circular imports
+
+    total = run.equipment_count
+    if not speculation_enabled() or not total:
+        return None
+    if run.generated_sections:
+        return None  # reopened run: the finalize only rewrites the sections of the edited rows
+    if reviewed_count < total and reviewed_count / total < settings.PFD_BENCH_SPECULATIVE['fraction']:
+        return None
+
+    current_hash = table_hash(run.final_table_for_node("generator_node"))
+    if RunArtifact.objects.filter(run=run, step=2, speculative=True, input_hash=current_hash).exists():
+        return None  # already speculated on this table
+
+    try:
+        # one speculation at a time: the next review action after it finished starts the next one
+        claimed = get_redis().set(_lease_key(run.id), current_hash, nx=True,
+                                  ex=settings.PFD_BENCH_SPECULATIVE['timeout_s'])
+    except redis.RedisError as e:
+        logger.warning(f"No speculation for run {run.id}: {str(e)}")
+        return None
+
+    return current_hash if claimed else None
+
+
+def release_speculation(run_id, speculated_hash):
+    """Drop the lease of a speculation that finished (or gave up)"""
+    try:
+        client = get_redis()
+        if client.get(_lease_key(run_id)) == speculated_hash:
+            client.delete(_lease_key(run_id))
+    except redis.RedisError as e:
+        logger.warning(f"Could not release the speculation lease of run {run_id}: {str(e)}")
+
+
+def _in_flight(run_id, speculated_hash):
+    try:
+        return get_redis().get(_lease_key(run_id)) == speculated_hash
+    except redis.RedisError:
+        return False
+
+
+def speculative_artifacts(run, current_hash):
+    """
+    Artifacts of the speculation on current_hash, waiting up to PFD_BENCH_SPECULATIVE['wait_s']
+    for one still in flight. Returns the list of artifacts and the seconds waited, or (None, waited)
+    """
+    from ..models import RunArtifact  # Import here to avoid circular imports
+
+    started = time.perf_counter()
+    deadline = started + settings.PFD_BENCH_SPECULATIVE['wait_s']
+
+    while True:
+        speculation = RunArtifact.objects.filter(run=run, step=2, speculative=True, input_hash=current_hash)
+        latest = speculation.order_by('-version').values_list('version', flat=True).first()
+        if latest is not None:
+            return list(speculation.filter(version=latest)), time.perf_counter() - started
+
+        if not _in_flight(run.id, current_hash) or time.perf_counter() > deadline:
+            return None, time.perf_counter() - started
+
+        time.sleep(POLL_S)
@@ -0,0 +1,81 @@
+"""
+Push of the status transitions of the runs to the browser
+
+Every time a run is saved with a new status, the status is published on a Redis channel per run
+(Run.save calls publish_status once the transaction commits). The processing page subscribes to it through run_status_events,
+an async generator of Server-Sent Events served by the uvicorn ASGI app, instead of polling
+check_run_status: one long-lived request per open page, and no Run row fetched every 2 seconds.
+
+Redis errors never fail a run or a save. Without Redis the stream says 'unavailable' and the
+page falls back to polling.
+"""
+
+import json
+import logging
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+from .PFD_streaming import sse_event
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_status')
+
+
+KEY_PREFIX = "pfd_bench:status"
+
+# while a run has one of these, the processing page keeps waiting
+PROCESSING_STATUSES = ('scheduled', 'pending', 'processing', 'waiting_for_provider')
+
+
+def status_channel(run_id):
+    return f"{KEY_PREFIX}:channel:{run_id}"
+
+
+def publish_status(run_id, status, error=""):
+    """Publish the new status of a run. Never raises"""
+    try:
+        get_redis().publish(status_channel(run_id), json.dumps({"status": status, "error": error}))
+    except redis.RedisError as e:
+        logger.warning(f"Could not publish the status of run {run_id}: {str(e)}")
+
+
+async def run_status_events(run_id, current_status):
+    """
+    Server-Sent Events of the status of a run while it is processed: a 'status' event with the
+    status now, then one per transition, until the run leaves PROCESSING_STATUSES.
+    current_status() is awaited on subscribe and at every heartbeat (a transition published before
+    we subscribed, or while Redis was unreachable, is not missed)
+    """
+    heartbeat_s = settings.PFD_BENCH_STREAMING['heartbeat_s']
+    client = aioredis.Redis.from_url(settings.PFD_BENCH_REDIS_URL, decode_responses=True)
+    pubsub = client.pubsub()
+
+    try:
+        # subscribe before reading the status: a transition in between shows up in both
+        await pubsub.subscribe(status_channel(run_id))
+        status = await current_status()
+        yield sse_event("status", {"status": status})
+
+        while status in PROCESSING_STATUSES:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=heartbeat_s)
+            if message is None:
+                latest = await current_status()
+                if latest == status:
+                    yield ": heartbeat\n\n"
+                    continue
+                status = latest
+            else:
+                status = json.loads(message["data"])["status"]
+            yield sse_event("status", {"status": status})
+
+    except redis.RedisError as e:
+        logger.warning(f"Status stream of run {run_id} unavailable: {str(e)}")
+        yield sse_event("unavailable", {})
+
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
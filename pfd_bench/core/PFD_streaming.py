@@ -0,0 +1,196 @@
+"""
+Live streaming of the process description of step 2 to the browser
+
+While the generator answers, the text of its partial structured output is published on a Redis
+channel per run and appended to a Redis key holding the text so far:
+- the worker side (DescriptionStream) is a callback handler on the LLM call, fed token by token
+- the web side (description_events) is an async generator of Server-Sent Events, served by the
+  uvicorn ASGI app: a snapshot of the text so far, then the deltas as they are published
+
+Every delta carries the offset at which it starts, so a browser that connects mid-generation
+neither misses nor repeats text. A retried call resets the stream. Redis errors never fail a run:
+without Redis the description simply shows up when the run completes.
+"""
+
+import json
+import logging
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.utils.json import parse_partial_json
+
+from .PFD_redis import get_redis
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_streaming')
+
+
+KEY_PREFIX = "pfd_bench:stream"
+
+
+def stream_channel(run_id):
+    return f"{KEY_PREFIX}:channel:{run_id}"
+
+
+def stream_text_key(run_id):
+    return f"{KEY_PREFIX}:text:{run_id}"
+
+
+def streaming_enabled():
+    return settings.PFD_BENCH_STREAMING['enabled']
+
+
+
+###################################################################
+# Partial structured output
+###################################################################
+
+def partial_output(message):
+    """
+    Structured output accumulated so far in message (an AIMessageChunk), as a dict:
+    tool call arguments (function calling) or JSON content (json mode), parsed leniently
+    """
+    if message.tool_calls:
+        return message.tool_calls[0]["args"]
+    content = message.content if isinstance(message.content, str) else ""
+    parsed = parse_partial_json(content) if content.strip() else None
+    return parsed if isinstance(parsed, dict) else {}
+
+
+
+###################################################################
+# Worker side: publish the text as it grows
+###################################################################
+
+class DescriptionStream(BaseCallbackHandler):
+    """
+    Publishes the text of a streamed structured output as it grows, for one run.
+    Pass it as a callback of the streamed call; call start() before each attempt and
+    finish() / fail() once the run is saved
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self._render = None
+        self._message = None
+        self._text = ""
+        self._client = None
+
+    def _redis(self):
+        if self._client is None:
+            self._client = get_redis()
+        return self._client
+
+    def _send(self, event, text=None, **fields):
+        """Publish an event; with text, append it to the text so far. Never raises"""
+        try:
+            pipe = self._redis().pipeline()
+            if text is not None:
+                pipe.append(stream_text_key(self.run_id), text)
+                pipe.expire(stream_text_key(self.run_id), settings.PFD_BENCH_STREAMING['ttl_s'])
+            pipe.publish(stream_channel(self.run_id), json.dumps({"event": event, **fields}))
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Could not stream the description of run {self.run_id}: {str(e)}")
+
+    def start(self, render=None):
+        """New attempt: clear the text so far. render(partial output as a dict) gives the text to show"""
+        self._render = render or self._render
+        self._message, self._text = None, ""
+        try:
+            self._redis().set(stream_text_key(self.run_id), "", ex=settings.PFD_BENCH_STREAMING['ttl_s'])
+        except redis.RedisError as e:
+            logger.warning(f"Could not stream the description of run {self.run_id}: {str(e)}")
+        self._send("reset")
+
+    def publish(self, text):
+        """Publish text, the whole partial text so far"""
+        if text == self._text:
+            return
+        if not text.startswith(self._text):
+            # the partial parse changed its mind (rare): start over with the new text
+            self.start()
+        delta, offset = text[len(self._text):], len(self._text)
+        self._text = text
+        self._send("delta", text=delta, offset=offset, delta=delta)
+
+    def finish(self, text):
+        """The run is saved with text as its description"""
+        self.publish(text)
+        self._send("done")
+
+    def fail(self, error):
+        self._send("failed", error=str(error))
+
+    def on_llm_new_token(self, token, *, chunk=None, **kwargs):
+        message = getattr(chunk, "message", None)
+        if message is None:
+            return
+        self._message = message if self._message is None else self._message + message
+        self.publish(self._render(partial_output(self._message)))
+
+
+
+###################################################################
+# Web side: Server-Sent Events
+###################################################################
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def description_events(run_id, is_generating):
+    """
+    Server-Sent Events of the description of a run: a 'snapshot' of the text so far, then 'delta'
+    events until 'done' (or 'failed'). is_generating() is awaited at every heartbeat, so the stream
+    also ends if the run finished without us seeing its last message
+    """
+    heartbeat_s = settings.PFD_BENCH_STREAMING['heartbeat_s']
+    client = aioredis.Redis.from_url(settings.PFD_BENCH_REDIS_URL, decode_responses=True)
+    pubsub = client.pubsub()
+
+    try:
+        # subscribe before reading the text so far: a delta published in between shows up in both,
+        # and its offset tells which part was already sent
+        await pubsub.subscribe(stream_channel(run_id))
+        text = await client.get(stream_text_key(run_id)) or ""
+        sent = len(text)
+        yield sse_event("snapshot", {"text": text})
+
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=heartbeat_s)
+            if message is None:
+                if not await is_generating():
+                    yield sse_event("done", {})
+                    return
+                yield ": heartbeat\n\n"
+                continue
+
+            data = json.loads(message["data"])
+            if data["event"] == "delta":
+                delta = data["delta"][max(0, sent - data["offset"]):]
+                if data["offset"] > sent:
+                    # we missed a message: send the whole text again
+                    text = await client.get(stream_text_key(run_id)) or ""
+                    sent = len(text)
+                    yield sse_event("snapshot", {"text": text})
+                elif delta:
+                    sent += len(delta)
+                    yield sse_event("delta", {"text": delta})
+            elif data["event"] == "reset":
+                sent = 0
+                yield sse_event("snapshot", {"text": ""})
+            else:
+                yield sse_event(data["event"], {k: v for k, v in data.items() if k != "event"})
+                return
+
+    except redis.RedisError as e:
+        logger.warning(f"Description stream of run {run_id} unavailable: {str(e)}")
+        yield sse_event("unavailable", {})
+
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,123 @@
+"""
+Serialization of the equipment tables, for people and for the prompts
+
+One serializer for every table we show or send (the worker table, the reviewed table of a run, a
+subset of its rows), in one of TABLE_FORMATS:
+- 'markdown': all the columns between pipes (cells not padded to the column width), with a
+  header separator; what people read
+- 'compact': delimiter-separated, one header line, only the columns the models need
+- 'keyed': one JSON object per row, short keys, empty cells left out
+
+The compact and keyed encodings are meant for the models: they drop the columns the prompts do not
+need (the stream counts repeat the stream lists, 'Modified' is review bookkeeping). The format of
+each node is set in PFD_BENCH_TABLE_FORMATS; parse_table() reads any of them back.
+"""
+
+import re
+import json
+
+from django.conf import settings
+
+
+TABLE_FORMATS = ('markdown', 'compact', 'keyed')
+
+# column key -> markdown header
+MARKDOWN_COLUMNS = {"tag": "Tag", "equipment_type": "Equipment type", "inlet_streams": "Inlet streams",
+                    "inlet_count": "Inlet count", "outlet_streams": "Outlet streams", "outlet_count": "Outlet count",
+                    "remarks": "Remarks"}
+
+# column key -> key in the compact and keyed encodings
+LLM_COLUMNS = {"tag": "tag", "equipment_type": "type", "inlet_streams": "inlets",
+               "outlet_streams": "outlets", "remarks": "remarks"}
+
+DELIMITER = "|"
+
+
+def table_format(node_name):
+    """Format of the tables in the prompts of a node (markdown unless configured)"""
+    return settings.PFD_BENCH_TABLE_FORMATS.get(node_name) or 'markdown'
+
+
+def _cell(value):
+    """Text of a cell on one line, the delimiter escaped"""
+    text = "" if value is None else str(value)
+    return " ".join(text.split()).replace(DELIMITER, "\\" + DELIMITER)
+
+
+def serialize_table(rows, table_format='markdown', title=None, modified=None):
+    """
+    Serialize rows (dicts or EquipmentRow) in table_format.
+    modified: markdown only, the indices of the rows changed in review (adds the 'Modified' column)
+    """
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format: {table_format}")
+
+    rows = [row if isinstance(row, dict) else row.model_dump() for row in rows]
+    lines = []
+
+    # Add title if present
+    if title:
+        lines.append(f"### {title}\n")
+
+    if table_format == 'markdown':
+        headers = list(MARKDOWN_COLUMNS.values()) + (["Modified"] if modified is not None else [])
+        lines.append("| " + " | ".join(headers) + " |")
+        lines.append("|" + "---|" * len(headers))
+        for idx, row in enumerate(rows):
+            cells = [_cell(row.get(column, '')) for column in MARKDOWN_COLUMNS]
+            if modified is not None:
+                cells.append("Yes" if idx in modified else "No")
+            lines.append("| " + " | ".join(cells) + " |")
+
+    elif table_format == 'compact':
+        lines.append(DELIMITER.join(LLM_COLUMNS.values()))
+        for row in rows:
+            lines.append(DELIMITER.join(_cell(row.get(column, '')) for column in LLM_COLUMNS))
+
+    else:
+        for row in rows:
+            lines.append(json.dumps({key: " ".join(str(row[column]).split()) for column, key in LLM_COLUMNS.items()
+                                     if row.get(column) not in (None, "")}, ensure_ascii=False, separators=(",", ":")))
+
+    return "\n".join(lines)
+
+
+def _split_cells(line):
+    return [cell.strip().replace("\\" + DELIMITER, DELIMITER) for cell in re.split(r"(?<!\\)\|", line)]
+
+
+def parse_table(text):
+    """
+    Rows (dicts keyed like EquipmentRow, with the columns of the format) of the table(s) serialized
+    in text, in any of TABLE_FORMATS; lines that are not part of a table are skipped
+    """
+    markdown_keys = {header.lower(): column for column, header in MARKDOWN_COLUMNS.items()}
+    llm_keys = {key: column for column, key in LLM_COLUMNS.items()}
+
+    rows, columns = [], None
+    for line in text.splitlines():
+        line = line.strip()
+
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            rows.append({llm_keys[key]: value for key, value in record.items() if key in llm_keys})
+            continue
+
+        if DELIMITER not in line:
+            columns = None  # a table ends at the first line that is not a row
+            continue
+        if set(line) <= set('|-: '):
+            continue  # markdown header separator
+
+        cells = _split_cells(line.strip(DELIMITER) if line.startswith(DELIMITER) else line)
+        header = [markdown_keys.get(cell.lower()) or llm_keys.get(cell) for cell in cells]
+        if header and header[0] == "tag":
+            columns = header
+            continue
+        if columns:
+            rows.append({column: cell for column, cell in zip(columns, cells) if column})
+
+    return rows
@@ -1,5 +1,35 @@
 
 import ezdxf
+import logging
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_utils')
+
+
+# tokenizer used for estimates; loaded once per process
+_token_encoding = None
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens of text with tiktoken (cl100k_base).
+    This is an estimate for every provider; if the encoding cannot be loaded we fall back to ~4 characters per token
+    """
+    global _token_encoding
+
+    if _token_encoding is None:
+        try:
+            import tiktoken
+            _token_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken encoding not available, estimating tokens from length: {str(e)}")
+            _token_encoding = False
+
+    if _token_encoding is False:
+        return len(text) // 4
+
+    return len(_token_encoding.encode(text, disallowed_special=()))
 
 
 ##################################################################
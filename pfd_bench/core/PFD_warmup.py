@@ -0,0 +1,186 @@
+"""
+Warm start of the Celery workers
+
+Without it the first task of a worker process pays for the imports (langchain, langgraph, the
+provider SDKs, ezdxf, tiktoken), the chat models, the compiled graphs and the connections. The
+worker bootstrap (signals in PFD_agent/celery.py) moves that work before the first task:
+- preload_modules(): the imports, in the parent before the pool forks, so the children share them
+- warm_up_process(): the per-process singletons (Redis client, checkpointer, shared event loop,
+  structured agents of the default models, compiled graphs), in each child after the fork (the
+  connections and the loop thread would not survive a fork); with the threads pool, in the worker
+  itself. Optionally one call to the offline stand-in exercises the structured-output path.
+  A worker that does not consume the I/O queue (the DXF parsing) never calls a model: it only
+  warms up Redis and the tokenizer
+
+The latency of every task is recorded per process as cold (the first run of that task in the
+process) or warm, in Redis; task_latency_report compares them. The last RECENT_RUNS latencies of
+each task are kept too, for the wait estimate of the admission control (see PFD_admission).
+"""
+
+import time
+import logging
+import importlib
+import threading
+
+import redis
+from django.conf import settings
+
+from .PFD_redis import get_redis
+
+
+## logger instance for this module
+logger = logging.getLogger(f'pfd_bench.pfd_warmup')
+
+
+KEY_PREFIX = "pfd_bench:task_latency"
+RECENT_RUNS = 50
+
+# imported lazily by the pipeline; preloaded by the worker bootstrap
+PRELOAD_MODULES = [
+    "ezdxf",
+    "tiktoken",
+    "langchain.chat_models",
+    "langchain_openai",
+    "langchain_google_genai",
+    "langgraph.graph",
+    "pfd_bench.core.PFD_bench_setup",
+    "pfd_bench.core.PFD_bench_runs",
+    "pfd_bench.core.PFD_offline_provider",
+]
+CHECKPOINTER_MODULES = {"sqlite": ["langgraph.checkpoint.sqlite"],
+                        "postgres": ["psycopg_pool", "langgraph.checkpoint.postgres"]}
+
+
+
+###################################################################
+# Bootstrap
+###################################################################
+
+def preload_modules():
+    """Import the modules of the pipeline (safe before a fork: no connection, no thread)"""
+    modules = PRELOAD_MODULES + CHECKPOINTER_MODULES.get(settings.PFD_BENCH_CHECKPOINTER, [])
+
+    started = time.perf_counter()
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning(f"Could not preload {module}: {str(e)}")
+    logger.info(f"Preloaded {len(modules)} modules in {time.perf_counter() - started:.2f}s")
+
+
+def _offline_warmup_call():
+    """One structured call to the offline stand-in (no network, whatever the provider)"""
+    from .PFD_offline_provider import OfflineChatModel
+    from .PFD_bench_setup import EquipmentTable, PFD_WORKER_MODEL
+
+    agent = OfflineChatModel(PFD_WORKER_MODEL, latency_median_s=0).with_structured_output(EquipmentTable,
+                                                                                           include_raw=True)
+    agent.invoke([{"role": "user", "content": "Warm-up: no equipment"}])
+
+
+def warm_up_process(llm_calls=True):
+    """
+    Create the singletons of this process before its first task. Every part is best effort: a
+    failure is logged and the task creates what it needs as usual
+
+    llm_calls: the process serves the queue of the LLM calls; without it (the DXF parsing of the
+    CPU queue) only Redis and the tokenizer are warmed up, not the event loop, agents and graphs
+    """
+    from .PFD_bench_setup import (DEFAULT_ROLE_MODELS, EquipmentTable, AuditedEquipmentTables, GeneratorOutput,
+                                  get_structured_agent, get_st1_graph, get_st2_graph)
+    from .PFD_checkpoints import get_checkpointer
+    from .PFD_http_clients import get_event_loop
+    from .PFD_utils import estimate_tokens
+
+    started = time.perf_counter()
+    steps = [
+        ("redis", lambda: get_redis().ping()),
+        ("tokenizer", lambda: estimate_tokens("warm-up")),
+    ]
+    llm_steps = [
+        ("event loop", get_event_loop),
+        ("agents", lambda: [get_structured_agent(DEFAULT_ROLE_MODELS[role], schema) for role, schema in
+                            [("worker", EquipmentTable), ("auditor", AuditedEquipmentTables),
+                             ("generator", GeneratorOutput)]]),
+        ("step 1 graph", lambda: get_st1_graph(ensemble_size=settings.PFD_BENCH_WORKER_ENSEMBLE_SIZE,
+                                               checkpointer=get_checkpointer())),
+        ("step 2 graphs", lambda: [get_st2_graph(incremental=incremental, map_reduce=map_reduce)
+                                   for incremental, map_reduce in [(False, False), (True, False), (False, True)]]),
+    ]
+    if settings.PFD_BENCH_WARMUP['offline_call']:
+        llm_steps.append(("offline call", _offline_warmup_call))
+    if llm_calls:
+        steps += llm_steps
+
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"Warm-up step '{name}' failed: {str(e)}")
+
+    logger.info(f"Warmed up the worker process in {time.perf_counter() - started:.2f}s")
+
+
+
+###################################################################
+# Cold versus warm task latency
+###################################################################
+
+class TaskLatency:
+    """Times the tasks of this process; the first run of each task is the cold one"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = {}
+        self._seen = set()
+
+    def start(self, task_id):
+        self._started[task_id] = time.perf_counter()
+
+    def finish(self, task_id, task_name):
+        started = self._started.pop(task_id, None)
+        if started is None:
+            return
+        with self._lock:
+            kind = "warm" if task_name in self._seen else "cold"
+            self._seen.add(task_name)
+        record_task_latency(task_name, kind, time.perf_counter() - started)
+
+
+task_latency = TaskLatency()
+
+
+def record_task_latency(task_name, kind, seconds):
+    """Add one task run to the cross-worker counters (kind: 'cold' or 'warm'). Never raises"""
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hincrby(KEY_PREFIX, f"{task_name}:{kind}:count", 1)
+        pipe.hincrbyfloat(KEY_PREFIX, f"{task_name}:{kind}:total_s", seconds)
+        pipe.lpush(f"{KEY_PREFIX}:recent:{task_name}", round(seconds, 3))
+        pipe.ltrim(f"{KEY_PREFIX}:recent:{task_name}", 0, RECENT_RUNS - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not record the latency of {task_name}: {str(e)}")
+
+
+def task_latencies():
+    """{task name: {'cold'|'warm': {'count', 'total_s'}}} recorded so far"""
+    latencies = {}
+    for field, value in get_redis().hgetall(KEY_PREFIX).items():
+        task_name, kind, counter = field.rsplit(":", 2)
+        latencies.setdefault(task_name, {}).setdefault(kind, {"count": 0, "total_s": 0.0})[counter] = float(value)
+    return latencies
+
+
+def reset_task_latencies():
+    """Clear the cold/warm counters and the recent latencies of every task"""
+    client = get_redis()
+    keys = [KEY_PREFIX, *client.scan_iter(match=f"{KEY_PREFIX}:recent:*")]
+    client.delete(*keys)
+
+
+def recent_task_latency(task_name):
+    """Mean latency of the last RECENT_RUNS runs of a task, None before its first run"""
+    recent = get_redis().lrange(f"{KEY_PREFIX}:recent:{task_name}", 0, -1)
+    return sum(float(seconds) for seconds in recent) / len(recent) if recent else None
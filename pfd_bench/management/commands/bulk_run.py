@@ -0,0 +1,36 @@
+# pfd_bench/management/commands/bulk_run.py
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from pfd_bench.models import Project, RunBatch
+from pfd_bench.tasks import pfd_extraction_batch
+
+
+class Command(BaseCommand):
+    help = 'Start a run of every DXF file of a project, as one batch (same as "Run all files" on the project page)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('project', type=int, help='Id of the project')
+        parser.add_argument('--name', help='Name of the batch, prefix of the run names (default: dated)')
+        parser.add_argument('--user', help='Username the runs are created by (default: the project owner)')
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=options['project'])
+        except Project.DoesNotExist:
+            raise CommandError(f"Project {options['project']} not found")
+
+        user = project.created_by
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['user']} not found")
+
+        name = options['name'] or f"Batch {timezone.now().strftime('%Y-%m-%d %H:%M')}"
+        batch = RunBatch.create_for_project(project, user, name)
+        if batch is None:
+            raise CommandError(f"Project {project.id} has no DXF file")
+
+        pfd_extraction_batch(batch).delay()
+        self.stdout.write(self.style.SUCCESS(f"Batch {batch.id} started: {len(batch.run_ids)} runs"))
@@ -0,0 +1,39 @@
+# pfd_bench/management/commands/hedging_report.py
+from django.core.management.base import BaseCommand
+from pfd_bench.core.PFD_hedging import hedging_report, STATS_DAYS
+
+
+LLM_NODES = ['worker_node', 'worker_sample_node', 'auditor_node', 'disputed_auditor_node', 'generator_node',
+             'regenerator_node', 'section_generator_node', 'stitch_node']
+
+
+class Command(BaseCommand):
+    help = f'Report hedge rate and latency per node (last {STATS_DAYS} days)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', nargs='+', default=LLM_NODES, help='Nodes to report (default: all LLM nodes)')
+
+    def handle(self, *args, **options):
+        report = hedging_report(options['nodes'])
+
+        for node_name, stats in report.items():
+            if not stats['calls']:
+                continue
+
+            self.stdout.write(self.style.SUCCESS(node_name))
+            self.stdout.write(
+                f"  calls {stats['calls']}, hedged {stats['hedges']} ({stats['hedge_rate']:.1%}), "
+                f"hedge won {stats['hedge_wins']} ({stats['hedge_win_rate']:.1%}), "
+                f"hedge tokens {stats['hedge_token_fraction']:.1%} of the estimated input"
+            )
+
+            if stats['hedge_wins']:
+                self.stdout.write(
+                    f"  estimated time saved {stats['saved_s']:.1f}s "
+                    f"({stats['saved_s'] / stats['hedge_wins']:.2f}s per winning hedge)"
+                )
+
+            first, node = stats['latency_first_request'], stats['latency_node']
+            for quantile in ('p50', 'p90', 'p99'):
+                if quantile in first and quantile in node:
+                    self.stdout.write(f"  {quantile}: first request {first[quantile]:.2f}s, node {node[quantile]:.2f}s")
@@ -0,0 +1,72 @@
+# pfd_bench/management/commands/replay_run.py
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from pfd_bench.models import Run
+from pfd_bench.core.PFD_bench_runs import pfd_bench_run_step_1, pfd_bench_run_step_2
+from pfd_bench.core.PFD_cassettes import cassette_path, provider_critical_path_s
+
+
+class Command(BaseCommand):
+    help = 'Re-run the graphs of a run against its recorded cassette and report the time spent besides provider latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('run_id', type=int, help='Run ID with a recorded cassette')
+        parser.add_argument('--steps', type=int, nargs='+', choices=[1, 2], default=[1, 2],
+                            help='Steps to replay (default: both)')
+        parser.add_argument('--timing', choices=['original', 'fast'], default='fast',
+                            help='Honour the recorded latencies or answer immediately (default: fast)')
+
+    def handle(self, *args, **options):
+        run_id = options['run_id']
+
+        try:
+            run = Run.objects.get(pk=run_id)
+        except Run.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f"Run {run_id} not found"))
+            return
+
+        path = cassette_path(run_id)
+        if not os.path.exists(path):
+            self.stdout.write(self.style.ERROR(f"No cassette recorded for run {run_id} ({path})"))
+            return
+
+        with open(path) as f:
+            recorded = json.load(f)
+
+        # replaying writes its results over those of the run (table, description, usage, artifacts):
+        # keep every field of the run, and put them back afterwards without the artifacts of the replay
+        original_fields = {field.attname: getattr(run, field.attname)
+                           for field in Run._meta.concrete_fields if not field.primary_key}
+        last_artifact_id = run.artifacts.aggregate(last=Max('id'))['last'] or 0
+
+        step_functions = {1: pfd_bench_run_step_1, 2: pfd_bench_run_step_2}
+
+        try:
+            for step in options['steps']:
+                interactions = recorded.get(f"step_{step}", [])
+                if not interactions:
+                    self.stdout.write(self.style.WARNING(f"Step {step}: nothing recorded, skipped"))
+                    continue
+
+                # concurrent calls overlap: only the latency on the critical path adds to the wall time
+                provider_latency = provider_critical_path_s(interactions)
+
+                started = time.perf_counter()
+                step_functions[step](run_id, cassette_mode='replay', replay_timing=options['timing'])
+                elapsed = time.perf_counter() - started
+
+                overhead = elapsed - provider_latency if options['timing'] == 'original' else elapsed
+                self.stdout.write(
+                    f"Step {step}: {len(interactions)} calls, recorded provider latency {provider_latency:.2f}s (critical path), "
+                    f"replay wall time {elapsed:.2f}s, overhead {overhead:.2f}s"
+                )
+
+        finally:
+            run.artifacts.filter(id__gt=last_artifact_id).delete()
+            Run.objects.filter(pk=run_id).update(**original_fields)
+
+        self.stdout.write(self.style.SUCCESS(f"Replay of run {run_id} finished"))
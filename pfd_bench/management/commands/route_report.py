@@ -0,0 +1,55 @@
+# pfd_bench/management/commands/route_report.py
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from pfd_bench.models import Run, RunArtifact
+
+
+class Command(BaseCommand):
+    help = 'Compare latency and review corrections of the runs per model route'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, help='Only the runs of this project')
+
+    def handle(self, *args, **options):
+        runs = Run.objects.exclude(model_route={})
+        if options['project']:
+            runs = runs.filter(project_id=options['project'])
+
+        # LLM wall time per run and step, all attempts included
+        wall_times = {
+            (row['run_id'], row['step']): row['total']
+            for row in RunArtifact.objects.filter(run__in=runs)
+                                          .values('run_id', 'step').annotate(total=Sum('wall_time_s'))
+        }
+
+        groups = defaultdict(lambda: {'runs': 0, 'wall_times': [], 'corrections': []})
+
+        for run in runs:
+            for step_key, step in (('step_1', 1), ('step_2', 2)):
+                routing = run.model_route.get(step_key)
+                if not routing:
+                    continue
+
+                route = ", ".join(f"{role}={choice['route']} ({choice['model']})"
+                                  for role, choice in routing['routes'].items())
+                group = groups[(step, route)]
+                group['runs'] += 1
+                if (run.id, step) in wall_times:
+                    group['wall_times'].append(wall_times[(run.id, step)])
+
+                # quality of step 1: share of the generated rows the reviewer had to correct
+                if step == 1 and run.status == 'completed' and run.equipment_count:
+                    changed = len((run.review_state or {}).get('equipment_data', {}))
+                    group['corrections'].append(changed / run.equipment_count)
+
+        for (step, route), group in sorted(groups.items()):
+            self.stdout.write(self.style.SUCCESS(f"Step {step}: {route}"))
+            line = f"  runs {group['runs']}"
+            if group['wall_times']:
+                line += f", mean LLM wall time {sum(group['wall_times']) / len(group['wall_times']):.1f}s"
+            if group['corrections']:
+                line += (f", rows corrected in review {sum(group['corrections']) / len(group['corrections']):.1%} "
+                         f"({len(group['corrections'])} reviewed runs)")
+            self.stdout.write(line)
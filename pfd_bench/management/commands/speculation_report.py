@@ -0,0 +1,50 @@
+# pfd_bench/management/commands/speculation_report.py
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from pfd_bench.models import Run, RunArtifact
+
+
+class Command(BaseCommand):
+    help = 'Hit rate, finalize latency and wasted tokens of the speculative step 2'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, help='Only the runs of this project')
+
+    def handle(self, *args, **options):
+        runs = Run.objects.filter(status='completed').exclude(speculation={})
+        if options['project']:
+            runs = runs.filter(project_id=options['project'])
+
+        outcomes = {'hit': [], 'miss': []}
+        for run in runs:
+            # from the finalize to the description: what the reviewer waited for
+            latency = None
+            if run.processing_started_at and run.processing_completed_at:
+                latency = (run.processing_completed_at - run.processing_started_at).total_seconds()
+            outcomes[run.speculation['outcome']].append(latency)
+
+        total = len(outcomes['hit']) + len(outcomes['miss'])
+        if not total:
+            self.stdout.write("No finalized runs with a speculation yet")
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Speculation hit rate {len(outcomes['hit']) / total:.1%} ({len(outcomes['hit'])} of {total} runs)"))
+
+        for outcome, latencies in outcomes.items():
+            latencies = [latency for latency in latencies if latency is not None]
+            if latencies:
+                self.stdout.write(f"  {outcome}: mean finalize latency {sum(latencies) / len(latencies):.1f}s "
+                                  f"({len(latencies)} runs)")
+
+        # speculations that were never used: their artifacts are not those of the final table
+        wasted = RunArtifact.objects.filter(run__in=runs, speculative=True)
+        for run in runs:
+            wasted = wasted.exclude(run=run, input_hash=run.speculation['table_hash'])
+        tokens = wasted.aggregate(input=Sum('input_tokens'), output=Sum('output_tokens'))
+        used = RunArtifact.objects.filter(run__in=runs, step=2).aggregate(input=Sum('input_tokens'),
+                                                                         output=Sum('output_tokens'))
+        wasted_tokens = (tokens['input'] or 0) + (tokens['output'] or 0)
+        all_tokens = (used['input'] or 0) + (used['output'] or 0)
+        self.stdout.write(f"  discarded speculations: {wasted_tokens} tokens "
+                          f"({wasted_tokens / all_tokens if all_tokens else 0:.1%} of the step 2 tokens)")
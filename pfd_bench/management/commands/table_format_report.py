@@ -0,0 +1,62 @@
+# pfd_bench/management/commands/table_format_report.py
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from pfd_bench.models import Run, RunArtifact
+from pfd_bench.core.PFD_table_serializer import TABLE_FORMATS, serialize_table
+from pfd_bench.core.PFD_utils import estimate_tokens
+
+
+STEP_2_NODES = ['generator_node', 'regenerator_node', 'section_generator_node']
+
+
+class Command(BaseCommand):
+    help = 'Tokens of the step-2 table in each table format, and the step-2 latency per format used'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, help='Only the runs of this project')
+        parser.add_argument('--limit', type=int, default=100, help='Latest completed runs to measure (default: 100)')
+
+    def handle(self, *args, **options):
+        runs = Run.objects.filter(status='completed').order_by('-created_at')
+        if options['project']:
+            runs = runs.filter(project_id=options['project'])
+        runs = list(runs[:options['limit']])
+
+        # the table of every run, in every format: markdown as the generator got it before (with 'Modified')
+        tokens = defaultdict(list)
+        for run in runs:
+            rows = run.final_equipment_table
+            if not rows:
+                continue
+            for table_format in TABLE_FORMATS:
+                table = (run.final_table_to_markdown() if table_format == 'markdown'
+                         else serialize_table(rows, table_format, title="Equipment and Stream Table"))
+                tokens[table_format].append(estimate_tokens(table))
+
+        if not tokens:
+            self.stdout.write("No completed runs with a table yet")
+            return
+
+        baseline = sum(tokens['markdown']) / len(tokens['markdown'])
+        self.stdout.write(self.style.SUCCESS(f"Table tokens, mean of {len(tokens['markdown'])} runs"))
+        for table_format in TABLE_FORMATS:
+            mean = sum(tokens[table_format]) / len(tokens[table_format])
+            self.stdout.write(f"  {table_format}: {mean:.0f} ({mean / baseline - 1:+.1%} vs markdown)")
+
+        # what the step-2 calls cost with the format they were sent (recorded with the estimate)
+        formats = {run.id: (run.token_estimate.get('step_2') or {}).get('table_format', 'markdown') for run in runs}
+        calls = defaultdict(lambda: {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'wall_time_s': 0.0})
+        for artifact in RunArtifact.objects.filter(run__in=runs, step=2, speculative=False, node__in=STEP_2_NODES):
+            group = calls[(artifact.node, formats[artifact.run_id])]
+            group['calls'] += 1
+            group['input_tokens'] += artifact.input_tokens or 0
+            group['output_tokens'] += artifact.output_tokens or 0
+            group['wall_time_s'] += artifact.wall_time_s or 0.0
+
+        for (node, table_format), group in sorted(calls.items()):
+            count = group['calls']
+            self.stdout.write(self.style.SUCCESS(f"{node}, {table_format} table"))
+            self.stdout.write(f"  {count} calls, mean {group['input_tokens'] / count:.0f} input / "
+                              f"{group['output_tokens'] / count:.0f} output tokens, "
+                              f"mean wall time {group['wall_time_s'] / count:.1f}s")
@@ -0,0 +1,35 @@
+# pfd_bench/management/commands/task_latency_report.py
+from django.core.management.base import BaseCommand, CommandError
+import redis
+from pfd_bench.core.PFD_warmup import task_latencies, reset_task_latencies
+
+
+class Command(BaseCommand):
+    help = 'Mean latency of the Celery tasks, cold (first run in a worker process) versus warm'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters and the recent latencies after the report')
+
+    def handle(self, *args, **options):
+        try:
+            latencies = task_latencies()
+        except redis.RedisError as e:
+            raise CommandError(f"Redis unavailable: {str(e)}")
+
+        if not latencies:
+            self.stdout.write("No task latency recorded yet")
+            return
+
+        for task_name, kinds in sorted(latencies.items()):
+            self.stdout.write(self.style.SUCCESS(task_name))
+            means = {}
+            for kind in ('cold', 'warm'):
+                if kind in kinds and kinds[kind]['count']:
+                    means[kind] = kinds[kind]['total_s'] / kinds[kind]['count']
+                    self.stdout.write(f"  {kind}: mean {means[kind]:.2f}s ({kinds[kind]['count']:.0f} runs)")
+            if len(means) == 2:
+                self.stdout.write(f"  cold start overhead: {means['cold'] - means['warm']:+.2f}s")
+
+        if options['reset']:
+            reset_task_latencies()  # the recent latencies too, the admission ETAs start over
+            self.stdout.write("Counters cleared")
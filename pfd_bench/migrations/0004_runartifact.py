@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-19 12:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0003_alter_projectfile_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step', models.PositiveSmallIntegerField(choices=[(1, 'Step 1 - Equipment extraction'), (2, 'Step 2 - Description generation')])),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('node', models.CharField(max_length=50)),
+                ('model_id', models.CharField(blank=True, max_length=100)),
+                ('prompt_version', models.CharField(blank=True, max_length=20)),
+                ('input_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('output_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('wall_time_s', models.FloatField(blank=True, null=True)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='artifacts', to='pfd_bench.run')),
+            ],
+            options={
+                'ordering': ['run', 'step', 'version', 'created_at'],
+                'indexes': [models.Index(fields=['run', 'step', 'version'], name='pfd_bench_r_run_id_0c51ed_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0005_run_model_route'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='token_estimate',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='token_usage',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
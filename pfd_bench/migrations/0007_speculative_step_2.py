@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-19 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0006_run_token_estimate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='speculation',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='runartifact',
+            name='input_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='runartifact',
+            name='speculative',
+            field=models.BooleanField(default=False),
+        ),
+    ]
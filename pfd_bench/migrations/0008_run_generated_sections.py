@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0007_speculative_step_2'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='generated_sections',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 13:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0009_run_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='runbatch',
+            name='lanes',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-19 13:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0010_run_batch_lanes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='coalesced_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='coalesced_runs', to='pfd_bench.run'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0011_run_coalesced_from'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='run',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready_for_review', 'Ready for Review'), ('under_review', 'Under Review'), ('draft', 'Draft'), ('generating_description', 'Generating Description'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=30),
+        ),
+    ]
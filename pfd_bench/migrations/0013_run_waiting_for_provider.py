@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0012_run_task_id_cancelled'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='run',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready_for_review', 'Ready for Review'), ('under_review', 'Under Review'), ('draft', 'Draft'), ('generating_description', 'Generating Description'), ('waiting_for_provider', 'Waiting for Provider'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=30),
+        ),
+    ]
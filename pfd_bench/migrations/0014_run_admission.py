@@ -0,0 +1,33 @@
+# Generated by Django 5.2.1 on 2026-10-19 13:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pfd_bench', '0013_run_waiting_for_provider'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='max_active_runs',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='admission',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='scheduled_for',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='run',
+            name='status',
+            field=models.CharField(choices=[('scheduled', 'Scheduled'), ('pending', 'Pending'), ('processing', 'Processing'), ('ready_for_review', 'Ready for Review'), ('under_review', 'Under Review'), ('draft', 'Draft'), ('generating_description', 'Generating Description'), ('waiting_for_provider', 'Waiting for Provider'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=30),
+        ),
+    ]
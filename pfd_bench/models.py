@@ -1,14 +1,19 @@
 
 # pfd_bench/models.py
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 import hashlib
+from datetime import datetime, timezone as dt_timezone
 from django.core.files.storage import default_storage
 
 import os
 
+from .core.PFD_table_serializer import serialize_table, table_format
+from .core.PFD_status import publish_status
+from .core.PFD_cancellation import cancel_run
+
 
 class Project(models.Model):
     name = models.CharField(max_length=200)
@@ -16,6 +21,7 @@ class Project(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='projects')
     updated_at = models.DateTimeField(auto_now=True)
+    max_active_runs = models.PositiveIntegerField(null=True, blank=True)  # Runs in step 1 at once (0: no limit), PFD_BENCH_ADMISSION['max_active_per_project'] if empty
     
     class Meta:
         ordering = ['-updated_at']
@@ -123,21 +129,79 @@ class ProjectFileLink(models.Model):
 
 
 
+class RunBatch(models.Model):
+    """A run of every DXF file of a project at once ("run all files"), dispatched as one Celery chord"""
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='batches')
+    name = models.CharField(max_length=200)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='run_batches')
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)  # set by the chord callback once step 1 ended for every run
+    lanes = models.PositiveSmallIntegerField(default=0)  # Runs of the batch in step 1 at once, set on dispatch
+    summary = models.JSONField(default=dict, blank=True)  # Status counts, tokens and duration of step 1, set on completion
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.name} ({self.project.name})"
+
+    @classmethod
+    def create_for_project(cls, project, user, name):
+        """
+        A batch with one pending run per DXF file of the project (created in one query).
+        Returns the batch, or None if the project has no DXF file
+        """
+        files = list(project.files.filter(file_type='dxf').order_by('name'))
+        if not files:
+            return None
+
+        batch = cls.objects.create(project=project, name=name, created_by=user)
+        Run.objects.bulk_create([
+            Run(project=project, batch=batch, name=f"{name} - {project_file.name}", file=project_file, created_by=user)
+            for project_file in files
+        ])
+        return batch
+
+    @property
+    def run_ids(self):
+        return list(self.runs.order_by('id').values_list('id', flat=True))
+
+    def lane_run_ids(self):
+        """The run ids of each lane: the runs are dealt round-robin over the lanes"""
+        run_ids = self.run_ids
+        return [run_ids[start::self.lanes] for start in range(self.lanes)]
+
+    def lanes_in_use(self):
+        """Lanes held by the other batches of the same user that still have runs in step 1"""
+        running = (RunBatch.objects.filter(created_by=self.created_by, completed_at__isnull=True,
+                                           runs__status__in=['pending', 'processing'])
+                   .exclude(pk=self.pk).distinct())
+        return sum(running.values_list('lanes', flat=True))
+
+
 class Run(models.Model):
     STATUS_CHOICES = [
+        ('scheduled', 'Scheduled'),
         ('pending', 'Pending'),
         ('processing', 'Processing'),
         ('ready_for_review', 'Ready for Review'),
         ('under_review', 'Under Review'),
         ('draft', 'Draft'),
         ('generating_description', 'Generating Description'),
+        ('waiting_for_provider', 'Waiting for Provider'),
         ('completed', 'Completed'),
         ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
     ]
+
+    # a run in one of these is (to be) processed by step 1 and can be cancelled (waiting_for_provider: unless in step 2)
+    CANCELLABLE_STATUSES = ['scheduled', 'pending', 'processing', 'waiting_for_provider']
     
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='runs')
     name = models.CharField(max_length=200)
     file = models.ForeignKey(ProjectFile, on_delete=models.CASCADE, related_name='runs')
+    batch = models.ForeignKey(RunBatch, null=True, blank=True, on_delete=models.SET_NULL, related_name='runs')
+    coalesced_from = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='coalesced_runs')  # Run whose step-1 table this one copied
     #shared_file = models.ForeignKey(SharedFile, on_delete=models.PROTECT, related_name='runs')
     status = models.CharField(max_length=30, choices=STATUS_CHOICES, default='pending')
     
@@ -145,6 +209,9 @@ class Run(models.Model):
     processing_started_at = models.DateTimeField(null=True, blank=True)
     processing_completed_at = models.DateTimeField(null=True, blank=True)
     processing_error = models.TextField(blank=True)
+    task_id = models.CharField(max_length=255, blank=True)  # Celery task processing the run (or queued to), revoked on cancel
+    admission = models.JSONField(default=dict, blank=True)  # Admission decision: accepted, with an ETA or deferred, the estimated wait and why
+    scheduled_for = models.DateTimeField(null=True, blank=True)  # A deferred run starts then (empty: as soon as admitted)
     
     # Review state (JSON field to store progress)
     review_state = models.JSONField(default=dict, blank=True)
@@ -163,7 +230,12 @@ class Run(models.Model):
     # Generated data
     generated_table = models.JSONField(default=dict, blank=True)  # The table generated by AI
     generated_text = models.TextField(blank=True)  # Final process description
+    generated_sections = models.JSONField(default=dict, blank=True)  # The same per equipment (introduction, sections) and the table it describes
     ai_confidence_scores = models.JSONField(default=dict, blank=True)  # Placeholder for confidence scores
+    model_route = models.JSONField(default=dict, blank=True)  # Per step: pre-flight features and the model route of each role
+    token_estimate = models.JSONField(default=dict, blank=True)  # Per step: pre-flight token estimate of each node
+    token_usage = models.JSONField(default=dict, blank=True)  # Per step: tokens actually used by each node
+    speculation = models.JSONField(default=dict, blank=True)  # Outcome of the speculative step 2 (hit or miss), set on finalize
     
     # Timestamps and users
     created_at = models.DateTimeField(auto_now_add=True)
@@ -177,6 +249,23 @@ class Run(models.Model):
     
     def __str__(self):
         return f"{self.name} ({self.get_status_display()})"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        run = super().from_db(db, field_names, values)
+        run._saved_status = run.__dict__.get('status')
+        return run
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # push the transitions to the pages waiting on the run (see PFD_status), once committed:
+        # a save rolled back announces nothing
+        status = self.__dict__.get('status')
+        if status is not None and status != getattr(self, '_saved_status', None):
+            self._saved_status = status
+            run_id, error = self.id, self.__dict__.get('processing_error', '')
+            transaction.on_commit(lambda: publish_status(run_id, status, error))
     
     @property
     def equipment_count(self):
@@ -224,6 +313,38 @@ class Run(models.Model):
         self.processing_error = error_message
         self.save()
 
+    @property
+    def expected_ready_at(self):
+        """When the step-1 table should be ready, as estimated on admission (None if not estimated)"""
+        admission = self.admission or {}
+        if admission.get('eta_s') is None:
+            return None
+        return datetime.fromtimestamp(admission['at'] + admission['eta_s'], tz=dt_timezone.utc)
+
+    @property
+    def in_step_2(self):
+        """Whether the run was finalized (a run waiting for its provider then waits in step 2)"""
+        return self.completed_at is not None
+
+    @property
+    def is_cancellable(self):
+        return self.status in self.CANCELLABLE_STATUSES and not self.in_step_2
+
+    def cancel_processing(self):
+        """
+        Mark run as cancelled and stop its task (see PFD_cancellation), if it is still cancellable
+        in the database: a run its task has just finished stays finished. Returns whether it was cancelled
+        """
+        now = timezone.now()
+        cancelled = Run.objects.filter(pk=self.pk, status__in=self.CANCELLABLE_STATUSES,
+                                       completed_at__isnull=True).update(status='cancelled', processing_completed_at=now)
+        if not cancelled:
+            self.refresh_from_db(fields=['status', 'processing_completed_at'])
+            return False
+        self.status, self.processing_completed_at = 'cancelled', now
+        cancel_run(self)
+        return True
+
     @property
     def final_equipment_table(self):
         """
@@ -251,13 +372,13 @@ class Run(models.Model):
         return final_table
     
 
-    def final_table_to_markdown(self, title="Modified Table after Human Review"):
+    def final_table_to_markdown(self, title="Modified Table after Human Review", only_tags=None):
         """
         Convert the final equipment table (with user modifications) to markdown format.
         
         Args:
             title: Optional title for the table
-            include_modifications: If True, adds a column showing which rows were modified
+            only_tags: If given, only the rows of these equipment tags
         
         Returns:
             Markdown formatted string
@@ -266,31 +387,37 @@ class Run(models.Model):
         if not final_table:
             return "No equipment data available."
         
-        lines = []
-        
-        # Add title if present
-        if title:
-            lines.append(f"### {title}\n")
-        
-        # Header
-        lines.append("| Tag | Equipment type | Inlet streams | Inlet count | Outlet streams | Outlet count | Remarks | Modified |")
-        lines.append("|---|---|---|---|---|---|---|---|")
-        
         # Get modification info
         state = self.review_state or {}
         equipment_data = state.get('equipment_data', {})
-        
-        # Rows
+
+        rows, modified = [], set()
         for idx, row in enumerate(final_table):
-            modified = "Yes" if str(idx) in equipment_data else "No"
-            lines.append(
-                f"| {row.get('tag', '')} | {row.get('equipment_type', '')} | "
-                f"{row.get('inlet_streams', '')} | {row.get('inlet_count', '')} | "
-                f"{row.get('outlet_streams', '')} | {row.get('outlet_count', '')} | "
-                f"{row.get('remarks', '')} | {modified} |"
-            )
+            if only_tags is not None and row.get('tag') not in only_tags:
+                continue
+            if str(idx) in equipment_data:
+                modified.add(len(rows))
+            rows.append(row)
+
+        return serialize_table(rows, 'markdown', title=title, modified=modified)
+
+
+    def final_table_for_node(self, node_name, title="Equipment and Stream Table", only_tags=None):
+        """
+        The final equipment table as the prompt of node_name gets it, in the table format of the node
+        (PFD_BENCH_TABLE_FORMATS); only_tags: if given, only the rows of these equipment tags
+        """
+        final_table = self.final_equipment_table
+        if not final_table:
+            return "No equipment data available."
+
+        rows = [row for row in final_table if only_tags is None or row.get('tag') in only_tags]
+        return serialize_table(rows, table_format(node_name), title=title)
+
 
-        return "\n".join(lines)
+    def latest_artifact(self, node):
+        """Most recent artifact of a node for this run (None if the node never ran)"""
+        return self.artifacts.filter(node=node).order_by('-version', '-created_at').first()
 
 
     def original_table_to_markdown(self, title="Original AI-Generated Table"):
@@ -298,25 +425,56 @@ class Run(models.Model):
         if not self.generated_table:
             return "No equipment data available."
         
-        lines = []
-        
-        if title:
-            lines.append(f"### {title}\n")
-        
-        # Header
-        lines.append("| Tag | Equipment type | Inlet streams | Inlet count | Outlet streams | Outlet count | Remarks |")
-        lines.append("|---|---|---|---|---|---|---|")
-        
-        # Rows
-        for row in self.generated_table:
-            lines.append(
-                f"| {row.get('tag', '')} | {row.get('equipment_type', '')} | "
-                f"{row.get('inlet_streams', '')} | {row.get('inlet_count', '')} | "
-                f"{row.get('outlet_streams', '')} | {row.get('outlet_count', '')} | "
-                f"{row.get('remarks', '')} |"
-            )
-        
-        return "\n".join(lines)
+        return serialize_table(self.generated_table, 'markdown', title=title)
+
+
+class RunArtifact(models.Model):
+    """
+    What a node of the pipeline produced for a run and what it cost (model, prompt version, tokens, wall time).
+    Kept out of Run so that list queries stay light.
+    """
+    STEP_CHOICES = [
+        (1, 'Step 1 - Equipment extraction'),
+        (2, 'Step 2 - Description generation'),
+    ]
+
+    run = models.ForeignKey(Run, on_delete=models.CASCADE, related_name='artifacts')
+    step = models.PositiveSmallIntegerField(choices=STEP_CHOICES)
+    version = models.PositiveIntegerField(default=1)  # one version per execution of the step for this run
+    node = models.CharField(max_length=50)  # e.g. worker_node, auditor_node, generator_node
+
+    # What produced it
+    model_id = models.CharField(max_length=100, blank=True)
+    prompt_version = models.CharField(max_length=20, blank=True)  # hash of the system prompt
+
+    # What it cost
+    input_tokens = models.PositiveIntegerField(null=True, blank=True)
+    output_tokens = models.PositiveIntegerField(null=True, blank=True)
+    wall_time_s = models.FloatField(null=True, blank=True)
+
+    # The node output (e.g. the worker table or the audit findings)
+    payload = models.JSONField(default=dict, blank=True)
+
+    # Speculative executions of step 2 run during the review, on the table hashed in input_hash
+    speculative = models.BooleanField(default=False)
+    input_hash = models.CharField(max_length=64, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['run', 'step', 'version', 'created_at']
+        indexes = [
+            models.Index(fields=['run', 'step', 'version']),
+        ]
+
+    def __str__(self):
+        return f"{self.node} v{self.version} of run {self.run_id}"
+
+    @classmethod
+    def next_version(cls, run, step):
+        """Version for a new execution of a step of the run"""
+        latest = cls.objects.filter(run=run, step=step).aggregate(models.Max('version'))['version__max']
+        return (latest or 0) + 1
 
 
 class EquipmentReview(models.Model):
@@ -4,46 +4,204 @@ Use this file to add celery wrappers for async function calls
 """
 
 
-from celery import shared_task
+from celery import shared_task, chain, chord, group
+import time
 import logging
+import redis
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
 from django.utils import timezone
 
-from .core.PFD_bench_runs import pfd_bench_run_step_1, pfd_bench_run_step_2
+from .core.PFD_bench_runs import (pfd_bench_extract_step_1, pfd_bench_llm_step_1,
+                                  pfd_bench_run_step_2, pfd_bench_speculate_step_2)
+from .core.PFD_cancellation import RunCancelled
+from .core.PFD_heartbeats import beat, stale_runs, count_requeue
+from .core.PFD_circuit_breaker import CircuitOpen, breaker_state, park_run, parked_runs, parked_extract, unpark_runs
+from .core.PFD_admission import admit
+from .core.PFD_coalescing import LeaderComputing
 
 ## logger instance for this module
 logger = logging.getLogger(__name__)
 
 
+def _record_error(task, run_id, e):
+    """Keep the error on the run; on the last attempt the run fails"""
+    from .models import Run  # Import here to avoid circular imports
+
+    try:
+        run = Run.objects.get(pk=run_id)
+        if run.status == 'cancelled':
+            return
+        run.processing_error = str(e)
+        if task.request.retries >= task.max_retries:
+            run.status = 'failed'
+            run.processing_completed_at = timezone.now()
+        else:
+            beat(run_id, state='queued')  # the retry waits for its countdown
+        run.save()
+    except:
+        pass
+
+
+def _park(run_id, e, step, dxf_extract=None):
+    """The provider of the run is down (CircuitOpen e): the run waits for it instead of retrying"""
+    from .models import Run  # Import here to avoid circular imports
+
+    run = Run.objects.filter(pk=run_id).first()
+    if run is None or run.status == 'cancelled':
+        return
+
+    park_run(run_id, e.model_id, step, dxf_extract)
+    run.status = 'waiting_for_provider'
+    run.processing_error = str(e)
+    run.save()
+    logger.warning(f"Run {run_id} waiting for {e.model_id} in step {step}")
+
+
+def _track_task(task, run_id):
+    """Keep the id of the task now processing the run, the one cancel_run revokes; its first heartbeat"""
+    from .models import Run  # Import here to avoid circular imports
+
+    Run.objects.filter(pk=run_id).update(task_id=task.request.id or '')
+    beat(run_id, task.name.rsplit('.', 1)[-1])
+
+
+def first_task_id(result):
+    """Id of the first task of a chain started as result (the one queued for now)"""
+    while result.parent is not None:
+        result = result.parent
+    return result.id
+
+
+def pfd_extraction_step_1(run_id):
+    """
+    Step 1 of a run as a chain: the DXF parsing on the CPU queue, then the LLM calls on the I/O queue
+    (see the task routes in PFD_agent/celery.py). Call .delay() on it to start the run
+    """
+    return chain(parse_pfd_extraction_step_1.s(run_id), llm_pfd_extraction_step_1.s(run_id))
+
+
+def start_step_1(run_id):
+    """Queue step 1 of a run; its parsing task, queued, is revoked if the run is cancelled before a worker takes it"""
+    from .models import Run  # Import here to avoid circular imports
+
+    result = pfd_extraction_step_1(run_id).delay()
+    Run.objects.filter(pk=run_id, task_id='').update(task_id=first_task_id(result))
+
+
+def pfd_extraction_batch(batch):
+    """
+    Step 1 of every run of a batch as a chord: the runs are dealt round-robin over lanes, each lane
+    a chain of the step-1 chains of its runs, and summarise_batch runs once every lane is done.
+    Call .delay() on it to start the batch
+
+    All of it goes at the batch priority, behind interactive runs. A batch gets at most
+    PFD_BENCH_BATCH['max_parallel'] lanes, and fewer if the other batches of its user already
+    hold most of their 'max_parallel_per_user' (at least one): the lanes of every user are served
+    in turn at the batch priority, so one large submission cannot take all the workers
+    """
+    run_ids = batch.run_ids
+    user_lanes = settings.PFD_BENCH_BATCH['max_parallel_per_user'] - batch.lanes_in_use()
+    batch.lanes = max(1, min(settings.PFD_BENCH_BATCH['max_parallel'], user_lanes, len(run_ids)))
+    batch.save(update_fields=['lanes'])
+
+    return chord(
+        group(batch_lane(lane) for lane in batch.lane_run_ids()),
+        summarise_batch.si(batch.id).set(priority=settings.PFD_BENCH_PRIORITIES['batch']),
+    )
+
+
+def batch_lane(run_ids):
+    """Step 1 of the runs of one lane of a batch, one after the other, at the batch priority"""
+    priority = settings.PFD_BENCH_PRIORITIES['batch']
+    return chain(*[signature.set(priority=priority) for run_id in run_ids
+                   for signature in (parse_pfd_extraction_step_1.si(run_id, in_batch=True),
+                                     llm_pfd_extraction_step_1.s(run_id, in_batch=True))])
+
+
+# the extract goes to the next task in the chain message: no need to keep it in the result backend
+@shared_task(bind=True, max_retries=3, ignore_result=True)
+def parse_pfd_extraction_step_1(self, run_id, in_batch=False):
+    """
+    CPU-bound part of step 1: DXF parsing, model routing and pre-flight.
+    Returns the encoded extract, the input of llm_pfd_extraction_step_1
+
+    in_batch: the run is part of a lane of a batch, which goes on after a failed or deleted run
+    """
+    from .models import Run  # Import here to avoid circular imports
+
+    _track_task(self, run_id)
+
+    try:
+        dxf_extract = pfd_bench_extract_step_1(run_id)
+        if dxf_extract is not None:
+            beat(run_id, state='queued')  # for llm_pfd_extraction_step_1, on the I/O queue
+        return dxf_extract
+
+    except Run.DoesNotExist:
+        logger.error(f"Run {run_id} not found")
+        if in_batch:
+            return None  # deleted while its lane was queued: the lane moves on to its next run
+        raise
+
+    except Exception as e:
+        logger.error(f"Error parsing the drawing of run {run_id}: {str(e)}")
+        _record_error(self, run_id, e)
+        if in_batch and self.request.retries >= self.max_retries:
+            return None  # the run failed: the LLM part is skipped, the lane moves on to its next run
+
+        # Retry with exponential backoff
+        raise self.retry(exc=e, countdown=60 * (self.request.retries + 1))
+
+
 @shared_task(bind=True, max_retries=3)
-def process_pfd_extraction_step_1(self, run_id):
+def llm_pfd_extraction_step_1(self, dxf_extract, run_id, in_batch=False):
     """
-    Process PFD extraction asynchronously
+    I/O-bound part of step 1: the worker and auditor calls on the extract of parse_pfd_extraction_step_1
+    (in_batch: as for parse_pfd_extraction_step_1)
+    A coalesced follower whose leader still computes is queued again instead of waiting in the
+    worker; replace keeps its task id (cancel still revokes it) and what is chained after it
     
     bind=True gives access to self for retries
     max_retries=3 for resilience
     """
     from .models import Run  # Import here to avoid circular imports
 
+    _track_task(self, run_id)
+
     try:
-        pfd_bench_run_step_1(run_id)
+        pfd_bench_llm_step_1(run_id, dxf_extract)
         logger.info(f"Successfully processed step 1 of run {run_id}")
+
+    except LeaderComputing as e:
+        beat(run_id, state='queued')  # back in the broker until its countdown
+        if self.request.is_eager:
+            time.sleep(e.retry_in_s)  # eager tasks run at once, countdown or not
+        priority = (self.request.delivery_info or {}).get('priority')
+        return self.replace(self.signature((dxf_extract, run_id), {'in_batch': in_batch},
+                                           countdown=e.retry_in_s, priority=priority))
+
+    except RunCancelled:
+        return  # no retry; in a batch, the lane moves on to its next run
+
+    except CircuitOpen as e:
+        _park(run_id, e, 1, dxf_extract)  # resumed from its checkpoints by resume_parked_runs
         
     except Run.DoesNotExist:
         logger.error(f"Run {run_id} not found")
+        if in_batch:
+            return None  # deleted while its lane was queued: the lane moves on to its next run
         raise
         
     except Exception as e:
         logger.error(f"Error processing run {run_id}: {str(e)}")
         
-        # Update run with error
-        try:
-            run = Run.objects.get(pk=run_id)
-            run.status = 'failed'
-            run.processing_error = str(e)
-            run.processing_completed_at = timezone.now()
-            run.save()
-        except:
-            pass
+        # Update run with error; until the last attempt the run stays in processing,
+        # the retry resumes the graph from its last checkpoint
+        _record_error(self, run_id, e)
+        if in_batch and self.request.retries >= self.max_retries:
+            return
             
         # Retry with exponential backoff
         raise self.retry(exc=e, countdown=60 * (self.request.retries + 1))
@@ -60,10 +218,17 @@ def process_pfd_extraction_step_2(self, run_id):
     from .models import Run  # Import here to avoid circular imports
 
     logger.info(f"Starting step 2 of run {run_id}")
+    _track_task(self, run_id)
 
     try:
         pfd_bench_run_step_2(run_id)
         logger.info(f"Successfully processed step 2 of run {run_id}")
+
+    except RunCancelled:
+        logger.info(f"Step 2 of run {run_id} stopped: the run was cancelled")
+
+    except CircuitOpen as e:
+        _park(run_id, e, 2)
         
     except Run.DoesNotExist:
         logger.error(f"Run {run_id} not found")
@@ -72,15 +237,216 @@ def process_pfd_extraction_step_2(self, run_id):
     except Exception as e:
         logger.error(f"Error processing run {run_id}: {str(e)}")
         
-        # Update run with error
-        try:
-            run = Run.objects.get(pk=run_id)
+        # Update run with error; until the last attempt the run keeps its status
+        _record_error(self, run_id, e)
+            
+        # Retry with exponential backoff
+        raise self.retry(exc=e, countdown=60 * (self.request.retries + 1))
+
+
+@shared_task
+def speculate_pfd_extraction_step_2(run_id, table_hash):
+    """
+    Speculative step 2 while the run is still under review (no retries: on failure the
+    finalize simply runs step 2 normally)
+    """
+    try:
+        pfd_bench_speculate_step_2(run_id, table_hash)
+    except RunCancelled:
+        logger.info(f"Speculative step 2 of run {run_id} stopped: the run was cancelled")
+    except Exception as e:
+        logger.warning(f"Speculative step 2 of run {run_id} failed: {str(e)}")
+
+
+@shared_task
+def summarise_batch(batch_id):
+    """Chord callback of a batch: status counts, tokens and duration of step 1 of its runs"""
+    from django.db.models import Count
+    from .models import RunBatch  # Import here to avoid circular imports
+
+    batch = RunBatch.objects.get(pk=batch_id)
+    runs = batch.runs.all()
+
+    statuses = dict(runs.values_list('status').annotate(n=Count('id')))
+    input_tokens = output_tokens = 0
+    for usage in runs.values_list('token_usage', flat=True):
+        step_1 = (usage or {}).get('step_1') or {}
+        input_tokens += step_1.get('total_input_tokens', 0)
+        output_tokens += step_1.get('total_output_tokens', 0)
+
+    batch.completed_at = timezone.now()
+    batch.summary = {
+        'runs': sum(statuses.values()),
+        'statuses': statuses,
+        'failed_run_ids': list(runs.filter(status='failed').order_by('id').values_list('id', flat=True)),
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'duration_s': round((batch.completed_at - batch.created_at).total_seconds(), 1),
+    }
+    batch.save(update_fields=['completed_at', 'summary'])
+
+    logger.info(f"Batch {batch_id} done: {statuses}")
+
+
+def _requeue(run):
+    """Start the processing of a run whose task was lost over again (step 1 resumes from its checkpoints)"""
+    from .models import Run  # Import here to avoid circular imports
+
+    if run.status == 'generating_description':
+        result = process_pfd_extraction_step_2.delay(run.id)
+
+    elif run.batch_id and run.batch.completed_at is None:
+        # the lane of the run died with it: requeue the rest of the lane (the batch is summarised by the reaper)
+        lane = next(lane for lane in run.batch.lane_run_ids() if run.id in lane)
+        pending = set(run.batch.runs.filter(status='pending').values_list('id', flat=True))
+        result = batch_lane([run.id] + [run_id for run_id in lane[lane.index(run.id) + 1:] if run_id in pending]).delay()
+
+    else:
+        result = pfd_extraction_step_1(run.id).delay()
+
+    Run.objects.filter(pk=run.id).update(task_id=first_task_id(result))
+
+
+@shared_task
+def reap_stuck_runs():
+    """
+    Celery beat (see PFD_heartbeats): the runs whose task stopped beating for PFD_BENCH_REAPER['stale_s'],
+    or queued for 'queued_stale_s', are requeued, or failed once requeued 'max_requeues' times. Batches
+    whose last lane was requeued get their summary here, their chord callback is gone
+    """
+    from django.db.models import Max, Q
+    from .models import Run, RunBatch  # Import here to avoid circular imports
+
+    config = settings.PFD_BENCH_REAPER
+    # the pending runs of a batch wait for their turn in their lane, the lane is requeued with its running run
+    runs = list(Run.objects.filter(Q(status__in=['processing', 'generating_description'])
+                                   | Q(status='pending', batch__isnull=True)).select_related('batch'))
+
+    try:
+        stale = stale_runs(runs, config['stale_s'], config['queued_stale_s'])
+    except redis.RedisError as e:
+        logger.warning(f"Stuck runs not checked: {str(e)}")
+        return
+
+    for run, heartbeat in stale:
+        if heartbeat is None:
+            last_seen = f"no heartbeat, last saved {time.time() - run.updated_at.timestamp():.0f}s ago"
+        elif heartbeat['state'] != 'running':
+            last_seen = f"queued {time.time() - heartbeat['at']:.0f}s ago"
+        else:
+            last_seen = f"last heartbeat {time.time() - heartbeat['at']:.0f}s ago, after {heartbeat['node'] or 'its start'}"
+        requeues = heartbeat['requeues'] if heartbeat else 0
+
+        if requeues >= config['max_requeues']:
+            logger.error(f"Run {run.id} stuck in {run.status} ({last_seen}), failed after {requeues} requeues")
             run.status = 'failed'
-            run.processing_error = str(e)
+            run.processing_error = (f"The worker processing the run stopped ({last_seen}) "
+                                    f"and the run was already requeued {requeues} time(s)")
             run.processing_completed_at = timezone.now()
             run.save()
-        except:
-            pass
-            
-        # Retry with exponential backoff
-        raise self.retry(exc=e, countdown=60 * (self.request.retries + 1))
\ No newline at end of file
+            continue
+
+        logger.warning(f"Run {run.id} stuck in {run.status} ({last_seen}), requeued")
+        count_requeue(run.id)
+        _requeue(run)
+
+    # batches with nothing left in step 1 and no summary: a lane was requeued, the chord will not fire
+    idle_since = timezone.now() - timedelta(seconds=config['stale_s'])
+    orphans = (RunBatch.objects.filter(completed_at__isnull=True)
+               .exclude(runs__status__in=['pending', 'processing'])
+               .annotate(last_update=Max('runs__updated_at')).filter(last_update__lt=idle_since))
+    for batch_id in orphans.values_list('id', flat=True):
+        summarise_batch(batch_id)
+
+
+def _resume(run, step):
+    """
+    Start a run parked by its circuit breaker again. Step 1 resumes at the LLM calls on its kept
+    extract (from its checkpoints), the runs of a batch at the batch priority
+    """
+    from .models import Run  # Import here to avoid circular imports
+
+    try:
+        dxf_extract = parked_extract(run.id) if step == 1 else None
+    except redis.RedisError:
+        dxf_extract = None
+
+    beat(run.id, state='queued')
+    run.status = 'generating_description' if step == 2 else 'processing'
+    run.processing_error = ''
+    run.save()
+
+    in_batch = run.batch_id is not None
+    if step == 2:
+        signature = process_pfd_extraction_step_2.si(run.id)
+    elif dxf_extract is not None:
+        # its lane went on without it: it goes on its own, as a run of the batch
+        signature = llm_pfd_extraction_step_1.si(dxf_extract, run.id, in_batch=in_batch).set(
+            priority=settings.PFD_BENCH_PRIORITIES['batch' if in_batch else 'interactive'])
+    else:
+        # the extract was lost with Redis: the drawing is parsed again
+        signature = batch_lane([run.id]) if in_batch else pfd_extraction_step_1(run.id)
+    result = signature.delay()
+    Run.objects.filter(pk=run.id).update(task_id=first_task_id(result))
+
+
+@shared_task
+def resume_parked_runs():
+    """
+    Celery beat (see PFD_circuit_breaker): the runs waiting for a provider are resumed once its breaker
+    is closed; while it is half-open, the longest waiting one is resumed as the probe (one per period)
+    """
+    from .models import Run  # Import here to avoid circular imports
+
+    waiting = {run.id: run for run in Run.objects.filter(status='waiting_for_provider')}
+
+    try:
+        parked = parked_runs()
+        unpark_runs([run_id for run_id in parked if run_id not in waiting])  # deleted or cancelled meanwhile
+
+        by_model = defaultdict(list)
+        for run_id, run in waiting.items():
+            # a run without a record (lost by Redis) waits for no model in particular: resumed
+            record = parked.get(run_id) or {"model_id": None, "step": 2 if run.in_step_2 else 1, "at": 0}
+            by_model[record["model_id"]].append((record["at"], run, record["step"]))
+        states = {model_id: breaker_state(model_id) for model_id in by_model if model_id}
+
+    except redis.RedisError as e:
+        logger.warning(f"Parked runs not checked: {str(e)}")
+        return
+
+    for model_id, runs in by_model.items():
+        state = states.get(model_id, 'closed')
+        if state in ('open', 'probing'):
+            continue
+
+        runs = sorted(runs, key=lambda parked_run: parked_run[0])
+        if state == 'half_open':
+            runs = runs[:1]
+        logger.info(f"Resuming {len(runs)} runs waiting for {model_id} (breaker {state})")
+
+        for _, run, step in runs:
+            _resume(run, step)  # reads the extract of the parking
+            unpark_runs([run.id])
+
+
+@shared_task
+def admit_scheduled_runs():
+    """
+    Celery beat (see PFD_admission): the deferred runs that are due (their window opened, or deferred
+    until the load or their limits allow) go through the admission again, oldest first
+    """
+    from django.db.models import Q
+    from .models import Run  # Import here to avoid circular imports
+
+    due = (Run.objects.filter(status='scheduled')
+           .filter(Q(scheduled_for__isnull=True) | Q(scheduled_for__lte=timezone.now()))
+           .select_related('project', 'created_by').order_by('created_at'))
+
+    for run in due:
+        if admit(run) == 'deferred':
+            run.save(update_fields=['admission', 'scheduled_for', 'updated_at'])
+            continue
+        run.save()
+        start_step_1(run.id)
+        logger.info(f"Scheduled run {run.id} admitted")
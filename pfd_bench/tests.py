@@ -1,3 +1,1441 @@
-from django.test import TestCase
+import io
+import json
+import time
+import asyncio
+import shutil
+import threading
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import ezdxf
+from asgiref.sync import async_to_sync
+from langgraph.checkpoint.memory import MemorySaver
+import redis
+import fakeredis
+from celery import Celery
+from celery.app.task import Task
+from kombu.transport.redis import PRIORITY_STEPS
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Project, ProjectFile, ProjectFileLink, Run, RunArtifact, RunBatch
+from .core import PFD_redis, PFD_streaming, PFD_bench_setup, PFD_bench_runs, PFD_heartbeats, PFD_checkpoints, PFD_http_clients
+from .core.PFD_bench_setup import (EquipmentRow, EquipmentTable, reconcile_worker_samples, merge_audited_rows,
+                                   route_models, DEFAULT_ROLE_MODELS, partition_table, stitch_description)
+from .core.PFD_offline_provider import OfflineStructuredModel
+from .core.PFD_cassettes import Cassette, cassette_path, provider_critical_path_s
+from .core.PFD_table_serializer import serialize_table, parse_table, TABLE_FORMATS, LLM_COLUMNS
+from .core.PFD_status import status_channel
+from .core.PFD_streaming import DescriptionStream, stream_text_key, sse_event
+from .core.PFD_heartbeats import heartbeat_key
+from .core.PFD_cancellation import RunCancelled, request_cancel, is_cancelled
+from .core.PFD_rate_limiter import (ProviderRateLimiter, call_with_capacity, ACQUIRE_TIMEOUT_S,
+                                   _TAKE_BUCKET, _TAKE_SLOT)
+from .core.PFD_http_clients import call_deadline_s
+from .core import PFD_admission
+from .core.PFD_warmup import KEY_PREFIX as WARMUP_KEY_PREFIX, record_task_latency, recent_task_latency, warm_up_process
+from .core.PFD_circuit_breaker import (CircuitOpen, breaker_state, call_with_breaker, parked_runs, parked_extract,
+                                       _keys)
+from .core.PFD_http_clients import run_coroutine, share_transport
+from .core.PFD_hedging import call_with_hedging, hedging_report, _reserve_hedge, _latency_key, _stats_key
+from .core.PFD_coalescing import LeaderComputing, lead_or_follow, following_key
+from .core.PFD_bench_runs import (pfd_bench_run_step_1, pfd_bench_run_step_2, pfd_bench_extract_step_1,
+                                  pfd_bench_llm_step_1, pfd_bench_speculate_step_2)
+from .core.PFD_speculation import table_hash
+from .tasks import (batch_lane, pfd_extraction_batch, start_step_1, llm_pfd_extraction_step_1, resume_parked_runs,
+                    admit_scheduled_runs, reap_stuck_runs, _park)
+from PFD_agent.celery import CPU_QUEUE, IO_QUEUE
+
+
+def drawing():
+    """A small PFD: a pump feeding a heat exchanger feeding a vessel"""
+    doc = ezdxf.new()
+    for name in ['PUMP', 'HX', 'VESSEL']:
+        block = doc.blocks.new(name=name)
+        block.add_circle((0, 0), 5)
+        block.add_attdef('TAG', (0, 0))
+    msp = doc.modelspace()
+    for (tag, block), x in zip([('P-101', 'PUMP'), ('E-101', 'HX'), ('V-101', 'VESSEL')], [0, 100, 200]):
+        msp.add_blockref(block, (x, 0)).add_attrib('TAG', tag, (x, 0))
+    msp.add_line((-50, 0), (-5, 0))
+    msp.add_line((5, 0), (95, 0))
+    msp.add_line((105, 0), (195, 0))
+
+    content = io.StringIO()
+    doc.write(content)
+    return content.getvalue().encode()
+
+
+def equipment_row(tag, equipment_type='Pump', inlet='Feed', outlet='To E-101', remarks=''):
+    return EquipmentRow(tag=tag, equipment_type=equipment_type, inlet_streams=inlet, inlet_count=1,
+                        outlet_streams=outlet, outlet_count=1, remarks=remarks)
+
+
+def equipment_table(*rows):
+    return EquipmentTable(title="Worker Table", rows=list(rows))
+
+
+
+class EnsembleReconciliationTests(TestCase):
+
+    def test_the_majority_wins_each_cell(self):
+        table, disputes = reconcile_worker_samples([
+            equipment_table(equipment_row('P-101', 'Centrifugal pump')),
+            equipment_table(equipment_row('P-101', 'centrifugal  PUMP')),
+            equipment_table(equipment_row('p-101', 'Pump', remarks='spare')),
+        ])
+
+        self.assertEqual(disputes, {})
+        self.assertEqual([(row.tag, row.equipment_type) for row in table.rows], [('P-101', 'Centrifugal pump')])
+
+    def test_a_tie_is_disputed(self):
+        table, disputes = reconcile_worker_samples([
+            equipment_table(equipment_row('E-101', 'Heat exchanger'), equipment_row('V-101', 'Vessel')),
+            equipment_table(equipment_row('E-101', 'Cooler'), equipment_row('V-101', 'Vessel')),
+        ])
+
+        self.assertEqual(disputes, {'E-101': {'equipment_type': ['Heat exchanger', 'Cooler']}})
+        self.assertEqual([row.tag for row in table.rows], ['E-101', 'V-101'])  # the first value stands meanwhile
+        self.assertEqual(table.rows[0].equipment_type, 'Heat exchanger')
+
+    def test_a_tag_missing_from_most_samples_is_disputed(self):
+        table, disputes = reconcile_worker_samples([
+            equipment_table(equipment_row('P-101'), equipment_row('P-102')),
+            equipment_table(equipment_row('P-101'), equipment_row('P-102')),
+            equipment_table(equipment_row('P-101'), equipment_row('P-103', 'Blower')),
+        ])
+
+        # P-102 is missing from one sample of three: still a majority
+        self.assertEqual(disputes, {'P-103': {'tag': ['found in 1 of 3 samples']}})
+        self.assertEqual([row.tag for row in table.rows], ['P-101', 'P-102', 'P-103'])
+
+    def test_a_tag_repeated_in_a_sample_is_voted_once(self):
+        _, disputes = reconcile_worker_samples([
+            equipment_table(equipment_row('P-101', 'Pump'), equipment_row('P-101', 'Compressor')),
+            equipment_table(equipment_row('P-101', 'Pump')),
+        ])
+
+        self.assertEqual(disputes, {})
+
+    def test_audited_rows_replace_drop_and_add(self):
+        consensus = equipment_table(equipment_row('P-101'), equipment_row('E-101', 'Cooler'),
+                                    equipment_row('V-101'), equipment_row('X-1'))
+        audited = equipment_table(equipment_row('e-101', 'Heat exchanger'), equipment_row('T-101', 'Tank'))
+
+        merged = merge_audited_rows(consensus, ['E-101', 'X-1'], audited)
+
+        # E-101 replaced in place, X-1 disputed and not returned, T-101 added by the auditor
+        self.assertEqual([(row.tag, row.equipment_type) for row in merged.rows],
+                         [('P-101', 'Pump'), ('e-101', 'Heat exchanger'), ('V-101', 'Pump'), ('T-101', 'Tank')])
+
+    def test_an_undisputed_row_returned_by_the_auditor_is_replaced(self):
+        merged = merge_audited_rows(equipment_table(equipment_row('P-101'), equipment_row('V-101')), [],
+                                    equipment_table(equipment_row('V-101', 'Drum')))
+
+        self.assertEqual([(row.tag, row.equipment_type) for row in merged.rows], [('P-101', 'Pump'), ('V-101', 'Drum')])
+
+
+
+class ModelRoutingTests(TestCase):
+
+    def features(self, entity_count=100, equipment_count=15, estimated_tokens=30000):
+        return {"entity_count": entity_count, "equipment_count": equipment_count, "estimated_tokens": estimated_tokens}
+
+    def models(self, features, step):
+        return {role: route["model"] for role, route in route_models(features, step).items()}
+
+    def test_every_role_gets_its_default_model_while_routing_is_off(self):
+        self.assertFalse(settings.PFD_BENCH_MODEL_ROUTING_ENABLED)  # opt-in
+        self.assertEqual(route_models(self.features(equipment_count=1, estimated_tokens=10), "step_1"),
+                         {"worker": {"route": "default", "model": DEFAULT_ROLE_MODELS["worker"]},
+                          "auditor": {"route": "default", "model": DEFAULT_ROLE_MODELS["auditor"]}})
+        self.assertEqual(self.models(self.features(equipment_count=1), "step_2"),
+                         {"generator": DEFAULT_ROLE_MODELS["generator"]})
+
+    @override_settings(PFD_BENCH_MODEL_ROUTING_ENABLED=True)
+    def test_a_small_drawing_goes_to_the_small_worker_up_to_each_limit(self):
+        small_worker = settings.PFD_BENCH_MODEL_ROUTES["worker"][0]["model"]
+
+        self.assertEqual(self.models(self.features(), "step_1"),
+                         {"worker": small_worker, "auditor": DEFAULT_ROLE_MODELS["auditor"]})
+        self.assertEqual(self.models(self.features(equipment_count=16), "step_1")["worker"],
+                         DEFAULT_ROLE_MODELS["worker"])
+        self.assertEqual(self.models(self.features(estimated_tokens=30001), "step_1")["worker"],
+                         DEFAULT_ROLE_MODELS["worker"])
+
+    @override_settings(PFD_BENCH_MODEL_ROUTING_ENABLED=True)
+    def test_the_generator_route_has_no_token_limit(self):
+        small_generator = settings.PFD_BENCH_MODEL_ROUTES["generator"][0]["model"]
+
+        self.assertEqual(self.models(self.features(estimated_tokens=10 ** 6), "step_2"), {"generator": small_generator})
+        self.assertEqual(self.models(self.features(equipment_count=16), "step_2"),
+                         {"generator": DEFAULT_ROLE_MODELS["generator"]})
+
+    @override_settings(PFD_BENCH_MODEL_ROUTING_ENABLED=True, PFD_BENCH_MODEL_ROUTES={'worker': [
+        {'name': 'tiny', 'model': 'openai:gpt-4o-mini', 'max_entities': 50},
+        {'name': 'small', 'model': 'google_genai:gemini-2.5-flash', 'max_equipment': 15},
+    ]})
+    def test_the_first_route_whose_limits_all_hold_wins(self):
+        routes = lambda **features: route_models(self.features(**features), "step_1")["worker"]["route"]
+
+        self.assertEqual(routes(entity_count=50, equipment_count=15), "tiny")
+        self.assertEqual(routes(entity_count=51, equipment_count=15), "small")
+        self.assertEqual(routes(entity_count=51, equipment_count=16), "default")
+
+
+
+class MapReduceTests(TestCase):
+
+    def line(self, count, prefix='P'):
+        """count rows in one line of flow, each feeding the next"""
+        tags = [f"{prefix}-{i}" for i in range(1, count + 1)]
+        return [{"tag": tag, "inlet_streams": f"From {tags[i - 1]}" if i else "Feed",
+                 "outlet_streams": f"To {tags[i + 1]}" if i + 1 < count else "Product"} for i, tag in enumerate(tags)]
+
+    def test_a_line_of_an_exact_multiple_of_max_rows_is_cut_in_full_parts(self):
+        rows = self.line(40)
+        self.assertEqual(partition_table(rows, 20), [[row["tag"] for row in rows[:20]], [row["tag"] for row in rows[20:]]])
+
+    def test_unconnected_rows_are_grouped_up_to_max_rows(self):
+        rows = [{"tag": f"T-{i}", "inlet_streams": "Feed", "outlet_streams": "Product"} for i in range(6)]
+        self.assertEqual(partition_table(rows, 3), [["T-0", "T-1", "T-2"], ["T-3", "T-4", "T-5"]])
+
+    def test_an_empty_table_has_no_part(self):
+        self.assertEqual(partition_table([], 20), [])
+
+    def test_a_small_table_is_a_single_part(self):
+        rows = self.line(5) + self.line(3, prefix='E')
+        self.assertEqual(partition_table(rows, 20), [[row["tag"] for row in rows]])
+
+    def test_stitching_gives_back_the_rows_in_order(self):
+        rows = self.line(25) + self.line(10, prefix='E')
+        parts = partition_table(rows, 10)
+        self.assertEqual([tag for part in parts for tag in part], [row["tag"] for row in rows])
+
+        part_sections = [{"index": index, "sections": [{"tag": tag, "heading": f"Part {index}", "text": f"About {tag}."}
+                                                       for tag in tags]}
+                         for index, tags in reversed(list(enumerate(parts)))]  # in any order of completion
+        transitions = [{"tag": part[0], "text": f"Then {part[0]}."} for part in parts]
+
+        sections = stitch_description(part_sections, transitions)
+
+        self.assertEqual([section["tag"] for section in sections], [row["tag"] for row in rows])
+        openings = {part[0] for part in parts[1:]}
+        self.assertEqual([section["text"] for section in sections],
+                         [f"Then {row['tag']}. About {row['tag']}." if row["tag"] in openings else f"About {row['tag']}."
+                          for row in rows])
+
+
+
+class TableSerializerTests(TestCase):
+    rows = [
+        {"tag": "P-101", "equipment_type": "Pump | centrifugal", "inlet_streams": "Feed, recycle", "inlet_count": 2,
+         "outlet_streams": "To E-101\nand E-102", "outlet_count": 2, "remarks": ""},
+        {"tag": "E-101", "equipment_type": "Heat exchanger", "inlet_streams": "From P-101", "inlet_count": 1,
+         "outlet_streams": "To V-101, vent", "outlet_count": 2, "remarks": "Shell|tube,\n 2 passes"},
+    ]
+
+    def expected(self, table_format):
+        """The rows as parse_table reads them back: the columns of the format, cells on one line"""
+        columns = list(self.rows[0]) if table_format == 'markdown' else list(LLM_COLUMNS)
+        expected = []
+        for row in self.rows:
+            cells = {column: " ".join(str(row[column]).split()) for column in columns}
+            if table_format == 'keyed':
+                cells = {column: cell for column, cell in cells.items() if cell}  # empty cells left out
+            expected.append(cells)
+        return expected
+
+    def test_every_format_round_trips(self):
+        for table_format in TABLE_FORMATS:
+            with self.subTest(table_format=table_format):
+                text = serialize_table(self.rows, table_format)
+                self.assertEqual(len(text.splitlines()), {'markdown': 4, 'compact': 3, 'keyed': 2}[table_format])
+                self.assertEqual(parse_table(text), self.expected(table_format))
+
+    def test_the_title_is_not_a_row(self):
+        for table_format in TABLE_FORMATS:
+            with self.subTest(table_format=table_format):
+                text = serialize_table(self.rows, table_format, title="Final | Table")
+                self.assertTrue(text.startswith("### Final | Table\n"))
+                self.assertEqual(parse_table(text), self.expected(table_format))
+
+    def test_the_modified_column_marks_the_rows_and_is_not_read_back(self):
+        text = serialize_table(self.rows, 'markdown', modified={1})
+
+        header, _, first, second = text.splitlines()
+        self.assertTrue(header.endswith("| Modified |"))
+        self.assertTrue(first.endswith("| No |"))
+        self.assertTrue(second.endswith("| Yes |"))
+        self.assertEqual(parse_table(text), self.expected('markdown'))
+
+    def test_an_unknown_format_is_refused(self):
+        with self.assertRaises(ValueError):
+            serialize_table(self.rows, 'csv')
+
+
+
+class RedisTestCase(TestCase):
+    """Every test gets an empty Redis of its own (fakeredis, with Lua)"""
+
+    def setUp(self):
+        super().setUp()
+        self.redis_server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.redis_server, decode_responses=True)
+        patcher = mock.patch.object(PFD_redis, '_redis_client', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class PipelineTestCase(RedisTestCase):
+    """Runs of a project on a small drawing, processed by the offline provider without latency"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.tmp,
+            PFD_BENCH_CASSETTE_DIR=f"{self.tmp}/cassettes",
+            PFD_BENCH_CHECKPOINTER='none',
+            PFD_BENCH_LLM_PROVIDER='offline',
+            PFD_BENCH_OFFLINE_PROVIDER={'latency_median_s': 0.0, 'latency_sigma': 0.5, 'error_rate': 0.0},
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(username='engineer')
+        self.project = Project.objects.create(name='Plant', created_by=self.user)
+        self.file = ProjectFile(name='plant.dxf', file_type='dxf', uploaded_by=self.user)
+        self.file.file.save('plant.dxf', ContentFile(drawing()), save=True)
+        ProjectFileLink.objects.create(project=self.project, file=self.file, added_by=self.user)
+
+    def new_run(self, name='run', **fields):
+        return Run.objects.create(project=self.project, name=name, file=self.file, created_by=self.user, **fields)
+
+
+
+class ReplayRunTests(PipelineTestCase):
+
+    def recorded_run(self):
+        """A run through both steps with its cassette recorded"""
+        run = self.new_run()
+        pfd_bench_run_step_1(run.id, cassette_mode='record')
+        run.refresh_from_db()
+        run.status = 'generating_description'
+        run.completed_at = timezone.now()
+        run.save()
+        pfd_bench_run_step_2(run.id, cassette_mode='record')
+        run.refresh_from_db()
+        return run
+
+    def test_replay_of_a_completed_run_plays_its_cassette(self):
+        run = self.recorded_run()
+        self.assertEqual(run.status, 'completed')
+
+        played = []
+        replay = Cassette._replay
+
+        def play(cassette, node_name, messages):
+            played.append((cassette.step, node_name))
+            return replay(cassette, node_name, messages)
+
+        with mock.patch.object(Cassette, '_replay', autospec=True, side_effect=play):
+            call_command('replay_run', run.id, stdout=io.StringIO())
+
+        with open(cassette_path(run.id)) as f:
+            recorded = json.load(f)
+        self.assertTrue(recorded['step_2'])
+        self.assertEqual(sorted(played), sorted((step, interaction['node']) for step, interactions in recorded.items()
+                                                for interaction in interactions))
+
+    def test_replay_leaves_the_run_as_it_was(self):
+        run = self.recorded_run()
+        run.generated_text = 'Reviewed description'
+        run.review_state = {'reviewed_indices': [0]}
+        run.save()
+        fields = {field.attname: getattr(run, field.attname) for field in Run._meta.concrete_fields}
+        artifacts = list(RunArtifact.objects.values_list('id', flat=True))
+
+        call_command('replay_run', run.id, stdout=io.StringIO())
+
+        run.refresh_from_db()
+        self.assertEqual({field.attname: getattr(run, field.attname) for field in Run._meta.concrete_fields}, fields)
+        self.assertEqual(list(RunArtifact.objects.values_list('id', flat=True)), artifacts)
+
+    def test_concurrent_calls_count_once_in_the_provider_latency(self):
+        interactions = [{"started_at": 100.0, "latency_s": 2.0},   # worker samples, concurrent
+                        {"started_at": 100.5, "latency_s": 3.0},
+                        {"started_at": 104.0, "latency_s": 1.0},   # auditor, after them
+                        {"latency_s": 0.5}]                         # recorded without its start
+
+        self.assertAlmostEqual(provider_critical_path_s(interactions), 3.5 + 1.0 + 0.5)
+
+        with open(cassette_path(self.recorded_run().id)) as f:
+            recorded = json.load(f)
+        self.assertTrue(all("started_at" in interaction for interactions in recorded.values()
+                            for interaction in interactions))
+
+
+
+@override_settings(PFD_BENCH_SPECULATIVE={'enabled': True, 'fraction': 0.8, 'timeout_s': 600, 'wait_s': 0})
+class SpeculationTests(PipelineTestCase):
+
+    def reviewed_run(self):
+        """A run through step 1, under review, and a speculation on its table"""
+        run = self.new_run()
+        pfd_bench_run_step_1(run.id)
+        run.refresh_from_db()
+        run.status = 'under_review'
+        run.save()
+        pfd_bench_speculate_step_2(run.id, table_hash(run.final_table_for_node("generator_node")))
+        return run
+
+    def finalize(self, run):
+        run.refresh_from_db()
+        run.status = 'generating_description'
+        run.save()
+        pfd_bench_run_step_2(run.id)
+        run.refresh_from_db()
+        return run
+
+    def test_the_speculation_on_the_final_table_is_used(self):
+        run = self.reviewed_run()
+        speculated = run.artifacts.get(step=2, speculative=True)
+
+        run = self.finalize(run)
+
+        self.assertEqual((run.status, run.speculation["outcome"]), ('completed', 'hit'))
+        self.assertEqual(run.generated_sections["mode"], "speculative")
+        self.assertEqual(run.generated_sections["introduction"], speculated.payload["introduction"])
+        self.assertFalse(run.artifacts.filter(step=2, speculative=False).exists())
+
+    def test_the_speculation_on_an_edited_table_is_discarded(self):
+        run = self.reviewed_run()
+        run.review_state = {'equipment_data': {'0': {'remarks': 'Edited after the speculation'}}}
+        run.save()
+
+        run = self.finalize(run)
+
+        self.assertEqual((run.status, run.speculation["outcome"]), ('completed', 'miss'))
+        self.assertEqual(run.generated_sections["mode"], "full")
+        generated = run.artifacts.get(step=2, speculative=False)
+        self.assertEqual(generated.input_hash, table_hash(run.final_table_for_node("generator_node")))
+        self.assertNotEqual(generated.input_hash, run.artifacts.get(step=2, speculative=True).input_hash)
+
+    def test_a_speculation_stops_when_its_run_is_cancelled(self):
+        run = self.new_run()
+        pfd_bench_run_step_1(run.id)
+        run.refresh_from_db()
+        run.status = 'under_review'
+        run.save()
+        request_cancel(run.id)
+
+        with self.assertRaises(RunCancelled):
+            pfd_bench_speculate_step_2(run.id, table_hash(run.final_table_for_node("generator_node")))
+
+        self.assertFalse(run.artifacts.filter(step=2).exists())
+        self.assertEqual(self.redis.hget(heartbeat_key(run.id), "node"), "generator_node")
+
+
+
+class RunArtifactTests(PipelineTestCase):
+
+    def test_a_step_keeps_what_each_model_call_cost(self):
+        run = self.new_run()
+        respond = OfflineStructuredModel._respond
+        usages = []
+
+        def respond_with_usage(model, messages):
+            response = respond(model, messages)
+            usages.append(response["raw"].usage_metadata)
+            return response
+
+        with mock.patch.object(OfflineStructuredModel, '_respond', autospec=True, side_effect=respond_with_usage):
+            pfd_bench_run_step_1(run.id)
+
+        artifacts = list(run.artifacts.filter(step=1).order_by('id'))
+        self.assertEqual([artifact.node for artifact in artifacts], ["worker_node", "auditor_node"])
+        self.assertEqual([(artifact.input_tokens, artifact.output_tokens) for artifact in artifacts],
+                         [(usage["input_tokens"], usage["output_tokens"]) for usage in usages])
+        for artifact in artifacts:
+            self.assertEqual(artifact.version, 1)
+            self.assertTrue(artifact.model_id)
+            self.assertTrue(artifact.prompt_version)
+            self.assertTrue(artifact.payload)
+
+        run.refresh_from_db()
+        usage = run.token_usage["step_1"]
+        self.assertEqual({node: (n["calls"], n["input_tokens"], n["output_tokens"]) for node, n in usage["nodes"].items()},
+                         {artifact.node: (1, artifact.input_tokens, artifact.output_tokens) for artifact in artifacts})
+        self.assertEqual(usage["total_input_tokens"], sum(u["input_tokens"] for u in usages))
+        self.assertEqual(usage["total_output_tokens"], sum(u["output_tokens"] for u in usages))
+
+        pfd_bench_run_step_1(run.id)  # a new execution of the step is a new version
+        self.assertEqual(sorted(run.artifacts.filter(step=1).values_list('version', flat=True)), [1, 1, 2, 2])
+
+
+
+class PreflightTests(PipelineTestCase):
+
+    def tiny_context_windows(self, *model_ids):
+        limits = {**settings.PFD_BENCH_MODEL_LIMITS,
+                  **{model_id: {'context_window': 100, 'max_output': 65536} for model_id in model_ids}}
+        return override_settings(PFD_BENCH_MODEL_LIMITS=limits)
+
+    def test_a_drawing_too_large_for_step_1_fails_its_run_before_any_call(self):
+        run = self.new_run()
+
+        with self.tiny_context_windows(*settings.PFD_BENCH_MODEL_LIMITS), \
+                mock.patch.object(PFD_bench_setup, 'get_structured_agent') as get_structured_agent:
+            dxf_extract = pfd_bench_extract_step_1(run.id)
+            pfd_bench_llm_step_1(run.id, dxf_extract)  # what the chain runs next
+
+        self.assertIsNone(dxf_extract)
+        get_structured_agent.assert_not_called()
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'failed')
+        self.assertTrue(run.processing_error.startswith("The drawing is too large for step 1"))
+        self.assertIsNotNone(run.processing_completed_at)
+        self.assertFalse(run.artifacts.exists())
+
+    def test_a_table_too_large_for_step_2_fails_its_run_before_any_call(self):
+        run = self.new_run()
+        pfd_bench_run_step_1(run.id)
+        run.refresh_from_db()
+        run.status = 'generating_description'
+        run.save()
+
+        with self.tiny_context_windows("openai:gpt-4o", "openai:gpt-4o-mini"), \
+                mock.patch.object(PFD_bench_setup, 'get_structured_agent') as get_structured_agent:
+            pfd_bench_run_step_2(run.id)
+
+        get_structured_agent.assert_not_called()
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'failed')
+        self.assertTrue(run.processing_error.startswith("The table is too large for step 2"))
+        self.assertEqual(run.generated_text, "")
+        self.assertFalse(run.artifacts.filter(step=2).exists())
+
+
+
+class CassetteResumeTests(PipelineTestCase):
+
+    def test_a_resumed_step_keeps_the_calls_recorded_before(self):
+        run = self.new_run()
+        dxf_extract = pfd_bench_extract_step_1(run.id)
+        record = Cassette._record
+        failed = []
+
+        def record_once(cassette, node_name, messages, invoke):
+            if node_name == "auditor_node" and not failed:
+                failed.append(node_name)
+                raise RuntimeError("provider down")
+            return record(cassette, node_name, messages, invoke)
+
+        with mock.patch.object(PFD_checkpoints, '_checkpointer', MemorySaver()), \
+                mock.patch.object(Cassette, '_record', autospec=True, side_effect=record_once):
+            with self.assertRaises(RuntimeError):
+                pfd_bench_llm_step_1(run.id, dxf_extract, cassette_mode='record')
+            pfd_bench_llm_step_1(run.id, dxf_extract, cassette_mode='record')  # the retry resumes at the auditor
+
+        with open(cassette_path(run.id)) as f:
+            recorded = json.load(f)["step_1"]
+        self.assertEqual([interaction["node"] for interaction in recorded], ["worker_node", "auditor_node"])
+
+        run.refresh_from_db()
+        table = run.generated_table
+        Run.objects.filter(pk=run.id).update(status='processing')  # as pfd_bench_extract_step_1 leaves it
+        pfd_bench_llm_step_1(run.id, dxf_extract, cassette_mode='replay')
+        run.refresh_from_db()
+        self.assertEqual(run.generated_table, table)
+
+    def test_a_failed_step_2_keeps_the_calls_it_recorded(self):
+        run = self.new_run()
+        pfd_bench_run_step_1(run.id)
+        record = Cassette._record
+
+        def record_then_fail(cassette, node_name, messages, invoke):
+            record(cassette, node_name, messages, invoke)
+            raise RuntimeError("connection reset")  # after the provider answered
+
+        with mock.patch.object(Cassette, '_record', autospec=True, side_effect=record_then_fail), \
+                self.assertRaises(RuntimeError):
+            pfd_bench_run_step_2(run.id, cassette_mode='record')
+
+        with open(cassette_path(run.id)) as f:
+            recorded = json.load(f)["step_2"]
+        self.assertEqual([interaction["node"] for interaction in recorded], ["generator_node"])
+
+
+
+class GoogleTransportTests(TestCase):
+    model_id = "google_genai:gemini-2.5-pro"
+
+    def setUp(self):
+        super().setUp()
+        for name in ('_google_client', '_google_async_client'):
+            patcher = mock.patch.object(PFD_http_clients, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def chat_model(self):
+        from langchain.chat_models import init_chat_model
+        return init_chat_model(self.model_id, google_api_key="test-key")
+
+    def test_the_chat_models_share_one_client(self):
+        first, second = share_transport(self.chat_model(), self.model_id), share_transport(self.chat_model(), self.model_id)
+
+        self.assertIs(second.client, first.client)
+        self.assertIsNotNone(first.async_client_running)
+        self.assertIs(second.async_client_running, first.async_client_running)
+
+    def test_a_model_keeps_its_own_transport_without_the_internals(self):
+        from langchain_google_genai import _genai_extension as genaix
+        build = genaix.build_generative_async_service
+        del genaix.build_generative_async_service  # as in a version that renamed it
+        self.addCleanup(setattr, genaix, 'build_generative_async_service', build)
+
+        llm = self.chat_model()
+        own_client = llm.client
+        self.assertIs(share_transport(llm, self.model_id), llm)
+
+        self.assertIs(llm.client, own_client)
+        self.assertIsNone(llm.async_client_running)
+        self.assertIsNone(PFD_http_clients._google_client)
+
+
+
+class RunCoroutineTests(TestCase):
+
+    def test_a_call_past_its_deadline_is_cancelled(self):
+        cancelled = []
+
+        async def hung_call():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            run_coroutine(hung_call(), timeout_s=0.2)
+        self.assertLess(time.monotonic() - started, 5)
+        time.sleep(0.1)
+        self.assertEqual(cancelled, [True])
+
+    def test_a_timeout_of_the_call_itself_propagates(self):
+        async def timing_out():
+            raise TimeoutError("read timeout")
+
+        with self.assertRaisesMessage(TimeoutError, "read timeout"):
+            run_coroutine(timing_out(), check=lambda: None, timeout_s=5)
+
+
+
+class BatchLaneTests(PipelineTestCase):
+
+    def test_a_run_deleted_from_its_lane_is_skipped(self):
+        runs = [self.new_run(name) for name in 'abc']
+        run_ids = [run.id for run in runs]
+        runs[1].delete()
+
+        batch_lane(run_ids).apply()
+
+        self.assertEqual(dict(Run.objects.values_list('name', 'status')),
+                         {'a': 'ready_for_review', 'c': 'ready_for_review'})
+
+    def sent(self, send):
+        """(task, priority) of the messages send() gives the broker"""
+        sent = []
+
+        def send_task(app, name, args=None, kwargs=None, **options):
+            # without a priority, the Redis transport files the message at its default_priority, 0
+            priority = options.get('priority')
+            sent.append((name.rsplit('.', 1)[-1], 0 if priority is None else priority))
+            result = mock.Mock(id=f'task-{len(sent)}')
+            result.parent = None  # parent=None to Mock() is its own parent, not an attribute
+            return result
+
+        with mock.patch.object(Celery, 'send_task', autospec=True, side_effect=send_task):
+            send()
+        return sent
+
+    def test_the_priorities_are_steps_of_the_broker(self):
+        priorities = settings.PFD_BENCH_PRIORITIES
+        self.assertLessEqual(set(priorities.values()), set(PRIORITY_STEPS))  # else two lanes share a step
+        self.assertLess(priorities['interactive'], priorities['speculative'])
+        self.assertLess(priorities['speculative'], priorities['batch'])
+
+    @override_settings(PFD_BENCH_SPECULATIVE={'enabled': True, 'fraction': 0.1, 'timeout_s': 600, 'wait_s': 0},
+                       PFD_BENCH_BATCH={'max_parallel': 2, 'max_parallel_per_user': 8})
+    def test_each_kind_of_task_is_sent_at_its_priority(self):
+        run = self.new_run('reviewed')
+        pfd_bench_run_step_1(run.id)
+        batch = RunBatch.objects.create(project=self.project, name='all', created_by=self.user)
+        for name in 'ab':
+            self.new_run(name, batch=batch)
+        self.client.force_login(self.user)
+        review_url = reverse('pfd_bench:submit_review', kwargs={'pk': run.pk})
+
+        self.assertEqual(self.sent(lambda: start_step_1(self.new_run('interactive').id)),
+                         [('parse_pfd_extraction_step_1', 0)])
+        self.assertEqual(self.sent(lambda: self.client.post(review_url, {'action': 'approve', 'equipment_index': 0})),
+                         [('speculate_pfd_extraction_step_2', 3)])
+        self.assertEqual(self.sent(lambda: self.client.post(review_url, {'action': 'finalize_run'})),
+                         [('process_pfd_extraction_step_2', 0)])
+
+        batch_chord = pfd_extraction_batch(batch)  # its chord is counted in the result backend, so not sent here
+        self.assertEqual({signature.options.get('priority') for lane in batch_chord.tasks for signature in lane.tasks}
+                         | {batch_chord.body.options.get('priority')}, {6})
+
+    @override_settings(PFD_BENCH_BATCH={'max_parallel': 4, 'max_parallel_per_user': 6})
+    def test_a_batch_gets_the_lanes_its_user_has_left(self):
+        running = RunBatch.objects.create(project=self.project, name='running', created_by=self.user, lanes=4)
+        self.new_run('in step 1', batch=running, status='processing')
+        batch = RunBatch.objects.create(project=self.project, name='all', created_by=self.user)
+        for name in 'abcde':
+            self.new_run(name, batch=batch)
+
+        pfd_extraction_batch(batch)
+        self.assertEqual(batch.lanes, 2)  # 6 per user, 4 held by the running batch
+        self.assertEqual(sorted(len(lane) for lane in batch.lane_run_ids()), [2, 3])
+
+        running.lanes = 6
+        running.save()
+        pfd_extraction_batch(batch)
+        self.assertEqual(batch.lanes, 1)  # none left: one lane still
+
+        Run.objects.filter(batch=running).update(status='ready_for_review')  # out of step 1
+        pfd_extraction_batch(batch)
+        self.assertEqual(batch.lanes, 4)  # max_parallel
+
+
+
+@override_settings(PFD_BENCH_COALESCING={'enabled': True, 'lease_s': 60, 'heartbeat_s': 15, 'wait_s': 1200, 'poll_s': 5})
+class CoalescingTests(PipelineTestCase):
+    key = "pfd_bench:coalesce:lease:drawing:pipeline"
+
+    def test_a_follower_is_queued_again_until_its_leader_has_the_table(self):
+        leader, follower = self.new_run('leader', status='processing'), self.new_run('follower')
+        dxf_extract = pfd_bench_extract_step_1(follower.id)
+        lease, _ = lead_or_follow(self.key, leader.id)
+
+        def leader_done(seconds):
+            leader.generated_table = [{"from": "P-101", "to": "E-101"}]
+            leader.status = 'ready_for_review'
+            leader.save()
+            lease.__exit__(None, None, None)
+
+        with mock.patch('pfd_bench.core.PFD_coalescing.coalesce_key', return_value=self.key), \
+                mock.patch('pfd_bench.tasks.time') as task_time:
+            task_time.sleep.side_effect = leader_done
+            llm_pfd_extraction_step_1.apply(args=(dxf_extract, follower.id))
+
+        task_time.sleep.assert_called_once_with(5)  # one look while the leader computed, one after
+        follower.refresh_from_db()
+        self.assertEqual((follower.status, follower.coalesced_from_id), ('ready_for_review', leader.id))
+        self.assertEqual(follower.generated_table, leader.generated_table)
+        self.assertFalse(self.redis.exists(following_key(follower.id)))
+
+    def test_an_expired_lease_is_taken_over(self):
+        leader, follower = self.new_run('leader', status='processing'), self.new_run('follower')
+        with self.settings(PFD_BENCH_COALESCING={**settings.PFD_BENCH_COALESCING, 'lease_s': 1}):
+            lease, _ = lead_or_follow(self.key, leader.id)  # never entered: no heartbeat, as after a crash
+            self.assertIsNotNone(lease)
+            with self.assertRaises(LeaderComputing):
+                lead_or_follow(self.key, follower.id)
+
+            time.sleep(1.2)
+            lease, leader_run = lead_or_follow(self.key, follower.id)
+
+        self.assertIsNone(leader_run)
+        self.assertEqual((lease.run_id, self.redis.get(self.key)), (str(follower.id), str(follower.id)))
+        self.assertFalse(self.redis.exists(following_key(follower.id)))
+
+    def test_a_follower_computes_its_own_table_after_wait_s(self):
+        leader, follower = self.new_run('leader', status='processing'), self.new_run('follower')
+        with self.settings(PFD_BENCH_COALESCING={**settings.PFD_BENCH_COALESCING, 'wait_s': 0.1}):
+            lead_or_follow(self.key, leader.id)
+            with self.assertRaises(LeaderComputing):
+                lead_or_follow(self.key, follower.id)
+
+            time.sleep(0.2)
+            self.assertEqual(lead_or_follow(self.key, follower.id), (None, None))
+        self.assertEqual(self.redis.get(self.key), str(leader.id))
+
+
+
+class StatusPublishTests(PipelineTestCase):
+
+    def subscribe(self, run):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(status_channel(run.id))
+        self.assertEqual(pubsub.get_message(timeout=1)["type"], "subscribe")
+        return pubsub
+
+    def published(self, pubsub):
+        messages = iter(lambda: pubsub.get_message(timeout=0.1), None)
+        return [json.loads(message["data"])["status"] for message in messages]
+
+    def test_a_status_is_published_once_committed(self):
+        run = self.new_run()
+        pubsub = self.subscribe(run)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            run.status = 'processing'
+            run.save()
+            self.assertEqual(self.published(pubsub), [])
+        self.assertEqual(self.published(pubsub), ['processing'])
+
+    def test_a_rolled_back_save_publishes_nothing(self):
+        run = self.new_run()
+        pubsub = self.subscribe(run)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    run.status = 'failed'
+                    run.save()
+                    raise RuntimeError("rolled back")
+            except RuntimeError:
+                pass
+        self.assertEqual(self.published(pubsub), [])
+
+
+
+class DescriptionStreamTests(PipelineTestCase):
+
+    def events(self, run, while_connected=lambda: None):
+        """The events of the description stream of run, while_connected() called once the snapshot is sent"""
+        async def receive():
+            await self.async_client.aforce_login(self.user)
+            response = await self.async_client.get(reverse('pfd_bench:run_description_stream', kwargs={'pk': run.pk}))
+            if not response.streaming:
+                return [response.content.decode()]
+            content = aiter(response.streaming_content)
+            received = [(await anext(content)).decode()]
+            await asyncio.to_thread(while_connected)
+            received += [event.decode() async for event in content]
+            return [event for event in received if not event.startswith(":")]  # without the heartbeats
+
+        # the stream reads Redis with a client of its own, on the fake server of the test
+        with mock.patch.object(PFD_streaming.aioredis.Redis, 'from_url',
+                               side_effect=lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=self.redis_server,
+                                                                                            decode_responses=True)):
+            return async_to_sync(receive)()
+
+    def test_a_browser_gets_the_text_so_far_then_what_follows(self):
+        run = self.new_run(status='generating_description')
+        stream = DescriptionStream(run.id)
+        stream.start()
+        stream.publish("The feed")  # before the browser connects
+
+        def generate():
+            stream.publish("The feed is heated")
+            stream.finish("The feed is heated in E-101.")
+
+        self.assertEqual(self.events(run, generate), [
+            sse_event("snapshot", {"text": "The feed"}),
+            sse_event("delta", {"text": " is heated"}),
+            sse_event("delta", {"text": " in E-101."}),
+            sse_event("done", {}),
+        ])
+
+    def test_a_run_no_longer_generating_ends_the_stream_at_once(self):
+        run = self.new_run(status='completed')
+        self.assertEqual(self.events(run), [sse_event("done", {})])
+
+
+
+class RateLimiterTests(RedisTestCase):
+    model_id = "openai:gpt-4o"
+
+    def take(self, limiter, cost=0):
+        """Seconds to wait for one request of cost tokens, 0 when it was taken"""
+        return float(self.redis.eval(_TAKE_BUCKET, 1, limiter.keys["bucket"], limiter.rpm, limiter.tpm, cost))
+
+    def limit(self, limiter):
+        return float(self.redis.get(limiter.keys["limit"]))
+
+    def test_the_request_bucket_refills_over_time(self):
+        limiter = ProviderRateLimiter(self.model_id, rpm=60)
+        self.assertEqual([self.take(limiter) for _ in range(60)], [0.0] * 60)
+
+        wait = self.take(limiter)
+        self.assertGreater(wait, 0.9)
+        self.assertLessEqual(wait, 1.0)
+
+        time.sleep(wait + 0.1)  # one request per second comes back
+        self.assertEqual(self.take(limiter), 0.0)
+        self.assertGreater(self.take(limiter), 0.0)
+
+    def test_a_call_waits_for_its_tokens(self):
+        limiter = ProviderRateLimiter(self.model_id, tpm=6000)
+        self.assertEqual(self.take(limiter, cost=5000), 0.0)
+        self.assertAlmostEqual(self.take(limiter, cost=2000), 10.0, delta=0.1)  # 1000 tokens missing at 100/s
+
+        limiter.release(None, estimated_tokens=5000, used_tokens=2000)  # the real usage is settled
+        self.assertEqual(self.take(limiter, cost=2000), 0.0)
+
+    def test_the_concurrency_limit_caps_the_slots(self):
+        limiter = ProviderRateLimiter(self.model_id, max_concurrency=2)
+        leases = [limiter.acquire(0), limiter.acquire(0)]
+        self.assertFalse(self.redis.eval(_TAKE_SLOT, 2, limiter.keys["leases"], limiter.keys["limit"], "third", 2, 60))
+
+        limiter.release(leases[0])
+        self.assertTrue(self.redis.eval(_TAKE_SLOT, 2, limiter.keys["leases"], limiter.keys["limit"], "third", 2, 60))
+
+    def test_a_slot_outlives_the_longest_call(self):
+        limiter = ProviderRateLimiter(self.model_id, max_concurrency=1)
+        lease_id = limiter.acquire(0)
+        expires_in = self.redis.zscore(limiter.keys["leases"], lease_id) - time.time()
+        self.assertGreater(expires_in, ACQUIRE_TIMEOUT_S + call_deadline_s())
+
+    def test_a_slot_is_given_back_when_the_bucket_is_unavailable(self):
+        limiter = ProviderRateLimiter(self.model_id, rpm=60, max_concurrency=2)
+        evaluate = self.redis.eval
+
+        def bucket_down(script, *args):
+            if script == _TAKE_BUCKET:
+                raise redis.ConnectionError("Redis went away")
+            return evaluate(script, *args)
+
+        with mock.patch.object(self.redis, 'eval', side_effect=bucket_down), \
+                self.assertRaises(redis.ConnectionError):
+            limiter.acquire(0)
+        self.assertEqual(self.redis.zcard(limiter.keys["leases"]), 0)
+
+    def test_throttling_halves_the_limit_and_successes_add_back(self):
+        limiter = ProviderRateLimiter(self.model_id, max_concurrency=8)
+        limiter.release(limiter.acquire(0), outcome='throttle')
+        self.assertEqual(self.limit(limiter), 4)
+        limiter.release(limiter.acquire(0), outcome='throttle')  # within the cooldown: one halving only
+        self.assertEqual(self.limit(limiter), 4)
+
+        limiter.release(limiter.acquire(0), outcome='success')
+        self.assertEqual(self.limit(limiter), 4.25)  # + 1/limit
+
+        self.redis.set(limiter.keys["limit"], 7.9)
+        limiter.release(limiter.acquire(0), outcome='success')
+        self.assertEqual(self.limit(limiter), 8)  # never over max_concurrency
+
+    @override_settings(PFD_BENCH_RATE_LIMIT_ENABLED=True,
+                       PFD_BENCH_RATE_LIMITS={'default': {'rpm': 0, 'tpm': 0, 'max_concurrency': 8}})
+    def test_a_throttled_call_backs_off_and_is_retried(self):
+        class Throttled(Exception):
+            status_code = 429
+
+        responses = iter([Throttled(), ("table", {"input_tokens": 10, "output_tokens": 5})])
+
+        def invoke():
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual(call_with_capacity(self.model_id, 15, invoke), ("table", {"input_tokens": 10, "output_tokens": 5}))
+        self.assertEqual(self.limit(ProviderRateLimiter(self.model_id)), 4.25)  # halved, then one success
+        self.assertEqual(self.redis.zcard(ProviderRateLimiter(self.model_id).keys["leases"]), 0)
+
+
+
+@override_settings(PFD_BENCH_RATE_LIMIT_ENABLED=False,
+                   PFD_BENCH_HEDGING={'enabled': True, 'nodes': ['worker_node'], 'quantile': 0.9,
+                                      'min_samples': 20, 'max_hedge_fraction': 0.1},
+                   PFD_BENCH_HEDGE_MODELS={'openai:gpt-4o': 'google_genai:gemini-2.5-pro'})
+class HedgingTests(RedisTestCase):
+    node_name, model_id, hedge_model_id = 'worker_node', 'openai:gpt-4o', 'google_genai:gemini-2.5-pro'
+
+    def setUp(self):
+        super().setUp()
+        # a p90 of 0.05s, and 100000 tokens sent today: a budget of 10000 hedge tokens
+        self.redis.lpush(_latency_key(self.node_name, 'first'), *[0.05] * 20)
+        self.redis.hset(_stats_key(self.node_name), 'tokens', 100000)
+        self.called = []
+
+    def call(self, latencies, estimated_tokens=1000):
+        """A hedged call on models answering after latencies[model_id] seconds"""
+        def ainvoke_for(model_id):
+            async def ainvoke():
+                self.called.append(model_id)
+                await asyncio.sleep(latencies[model_id])
+                return f"answer of {model_id}", {"input_tokens": 10, "output_tokens": 5}
+            return ainvoke
+
+        return call_with_hedging(self.node_name, self.model_id, estimated_tokens, None, ainvoke_for)
+
+    def stats(self):
+        return self.redis.hgetall(_stats_key(self.node_name))
+
+    def test_a_slow_call_is_won_by_its_hedge(self):
+        response, usage = self.call({self.model_id: 2.0, self.hedge_model_id: 0.0})
+
+        self.assertEqual(response, f"answer of {self.hedge_model_id}")
+        self.assertEqual(usage["model_id"], self.hedge_model_id)
+        self.assertEqual(self.called, [self.model_id, self.hedge_model_id])
+        stats = self.stats()
+        self.assertEqual((stats['hedges'], stats['hedge_wins'], stats['hedge_tokens']), ('1', '1', '1000'))
+        # the cancelled first request has no latency
+        self.assertEqual(self.redis.llen(_latency_key(self.node_name, 'first')), 20)
+
+    def test_a_hedge_can_lose_to_the_first_request(self):
+        response, usage = self.call({self.model_id: 0.2, self.hedge_model_id: 2.0})
+
+        self.assertEqual(response, f"answer of {self.model_id}")
+        self.assertEqual(usage["model_id"], self.model_id)
+        stats = self.stats()
+        self.assertEqual((stats['hedges'], stats.get('hedge_wins', '0')), ('1', '0'))
+        self.assertGreaterEqual(float(self.redis.lindex(_latency_key(self.node_name, 'first'), 0)), 0.2)
+
+    def test_no_hedge_once_the_budget_of_the_day_is_spent(self):
+        self.redis.hset(_stats_key(self.node_name), 'hedge_tokens', 9500)
+
+        response, _ = self.call({self.model_id: 0.2, self.hedge_model_id: 0.0})
+
+        self.assertEqual(response, f"answer of {self.model_id}")
+        self.assertEqual(self.called, [self.model_id])
+        self.assertNotIn('hedges', self.stats())
+
+    def test_concurrent_reservations_never_overspend_the_budget(self):
+        reserved = []
+        threads = [threading.Thread(target=lambda: reserved.append(_reserve_hedge(self.redis, self.node_name, 3000)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(reserved.count(True), 3)  # 3 x 3000 of a 10000 budget
+        self.assertEqual(self.stats()['hedge_tokens'], '9000')
+        self.assertEqual(self.stats()['hedges'], '3')
+
+    def test_the_report_sums_the_calls_and_hedges(self):
+        self.call({self.model_id: 2.0, self.hedge_model_id: 0.0})
+        self.call({self.model_id: 0.0, self.hedge_model_id: 0.0})
+
+        report = hedging_report([self.node_name])[self.node_name]
+        self.assertEqual((report['calls'], report['hedges'], report['hedge_wins']), (2, 1, 1))
+        self.assertEqual(report['hedge_rate'], 0.5)
+        self.assertEqual(report['hedge_win_rate'], 1.0)
+        self.assertEqual(report['hedge_tokens'], 1000)
+        self.assertEqual(set(report['latency_node']), {'p50', 'p90', 'p99'})
+
+
+
+@override_settings(PFD_BENCH_CIRCUIT_BREAKER={'enabled': True, 'window_s': 60, 'min_calls': 5, 'error_rate': 0.5,
+                                              'open_s': 30, 'resume_every_s': 30})
+class CircuitBreakerTests(PipelineTestCase):
+    model_id = "google_genai:gemini-2.5-pro"
+
+    def call(self, outcome=None):
+        """One call through the breaker, raising outcome if it is an exception"""
+        def invoke():
+            if outcome is not None:
+                raise outcome
+            return "answer"
+        return call_with_breaker(self.model_id, invoke)
+
+    def fail_call(self, exc=None):
+        with self.assertRaises(type(exc or TimeoutError())):
+            self.call(exc or TimeoutError("read timeout"))
+
+    def open_breaker(self):
+        for _ in range(2):
+            self.call()
+        for _ in range(3):
+            self.fail_call()
+
+    def cool_down(self):
+        """As if 'open_s' had passed since the breaker opened"""
+        self.redis.hset(_keys(self.model_id)["state"], "opened_at", time.time() - 31)
+
+    def test_provider_failures_open_the_breaker(self):
+        for _ in range(2):
+            self.call()
+        self.fail_call()
+        self.fail_call()
+        self.assertEqual(breaker_state(self.model_id), 'closed')  # 4 calls, under min_calls
+        self.fail_call()
+        self.assertEqual(breaker_state(self.model_id), 'open')
+
+        invoke = mock.Mock()
+        with self.assertRaises(CircuitOpen):
+            call_with_breaker(self.model_id, invoke)
+        invoke.assert_not_called()
+
+    def test_throttling_and_bad_requests_do_not_count(self):
+        class Throttled(Exception):
+            status_code = 429
+
+        class BadRequest(Exception):
+            status_code = 400
+
+        for exc in [Throttled(), BadRequest()] * 3:
+            self.fail_call(exc)
+        self.assertEqual(breaker_state(self.model_id), 'closed')
+
+    def test_a_successful_probe_closes_the_breaker(self):
+        self.open_breaker()
+        self.cool_down()
+        self.assertEqual(breaker_state(self.model_id), 'half_open')
+
+        def probe():
+            self.assertEqual(breaker_state(self.model_id), 'probing')
+            with self.assertRaises(CircuitOpen):
+                self.call()  # one probe at a time
+            return "answer"
+
+        self.assertEqual(call_with_breaker(self.model_id, probe), "answer")
+        self.assertEqual(breaker_state(self.model_id), 'closed')
+        self.fail_call()
+        self.assertEqual(breaker_state(self.model_id), 'closed')  # the window was cleared
+
+    def test_a_failed_probe_opens_the_breaker_again(self):
+        self.open_breaker()
+        self.cool_down()
+        self.fail_call()
+        self.assertEqual(breaker_state(self.model_id), 'open')
+
+    def test_a_probe_outlives_its_call(self):
+        self.open_breaker()
+        self.cool_down()
+
+        def probe():
+            expires_in = self.redis.ttl(_keys(self.model_id)["probe"])
+            self.assertGreater(expires_in, ACQUIRE_TIMEOUT_S + call_deadline_s())
+            return "answer"
+
+        self.assertEqual(call_with_breaker(self.model_id, probe), "answer")
+
+    def test_an_expired_probe_leaves_the_next_one_in_place(self):
+        self.open_breaker()
+        self.cool_down()
+        probe_key = _keys(self.model_id)["probe"]
+
+        def slow_probe():
+            self.redis.set(probe_key, "next-probe")  # expired meanwhile, another call took over
+            raise RunCancelled("cancelled")
+
+        with self.assertRaises(RunCancelled):
+            call_with_breaker(self.model_id, slow_probe)
+        self.assertEqual(self.redis.get(probe_key), "next-probe")
+
+        def late_probe():
+            self.redis.set(probe_key, "next-probe")
+            return "answer"
+
+        self.redis.delete(probe_key)  # that one expired too
+        self.assertEqual(call_with_breaker(self.model_id, late_probe), "answer")
+        self.assertEqual(self.redis.get(probe_key), "next-probe")
+
+    def test_parked_runs_resume_with_their_breaker(self):
+        runs = [self.new_run(name) for name in 'abc']
+        self.open_breaker()
+        for run in runs:
+            _park(run.id, CircuitOpen(self.model_id), 1)
+        self.assertEqual(set(Run.objects.values_list('status', flat=True)), {'waiting_for_provider'})
+        self.assertEqual(sorted(parked_runs()), [run.id for run in runs])
+
+        runs[2].status = 'cancelled'
+        runs[2].save()
+        with mock.patch('pfd_bench.tasks._resume') as resume:
+            resume_parked_runs()  # open: nothing resumed, the cancelled run forgotten
+            self.assertEqual(resume.call_count, 0)
+            self.assertEqual(sorted(parked_runs()), [runs[0].id, runs[1].id])
+
+            self.cool_down()
+            resume_parked_runs()  # half-open: the longest waiting run goes as the probe
+            self.assertEqual([(run.id, step) for (run, step), _ in resume.call_args_list], [(runs[0].id, 1)])
+            self.assertEqual(sorted(parked_runs()), [runs[1].id])
+
+            Run.objects.filter(pk=runs[0].id).update(status='processing')  # as _resume does
+            self.call()  # the probe succeeded
+            resume_parked_runs()
+            self.assertEqual([run.id for (run, step), _ in resume.call_args_list], [runs[0].id, runs[1].id])
+            self.assertEqual(parked_runs(), {})
+
+    def test_a_run_parked_in_step_1_resumes_at_its_llm_calls(self):
+        batch = RunBatch.objects.create(project=self.project, name='all', created_by=self.user)
+        batch_run, interactive_run = self.new_run('in batch', batch=batch), self.new_run('interactive')
+        for run in (batch_run, interactive_run):
+            _park(run.id, CircuitOpen(self.model_id), 1, f"extract of {run.name}")
+
+        queued = []
+
+        def apply_async(task, args=None, kwargs=None, **options):
+            queued.append((task.name.rsplit('.', 1)[-1], tuple(args), kwargs, options.get('priority')))
+            result = mock.Mock(id='task')
+            result.parent = None  # parent=None to Mock() is its own parent, not an attribute
+            return result
+
+        with mock.patch.object(Task, 'apply_async', autospec=True, side_effect=apply_async):
+            resume_parked_runs()
+
+        self.assertEqual(sorted(queued), sorted([
+            ('llm_pfd_extraction_step_1', ("extract of in batch", batch_run.id), {'in_batch': True}, 6),
+            ('llm_pfd_extraction_step_1', ("extract of interactive", interactive_run.id), {'in_batch': False}, 0),
+        ]))
+        self.assertEqual(parked_runs(), {})
+        self.assertIsNone(parked_extract(batch_run.id))
+
+
+
+class WarmupTests(RedisTestCase):
+    task_name = 'pfd_bench.tasks.llm_pfd_extraction_step_1'
+
+    def test_the_reset_clears_the_recent_latencies_of_the_etas(self):
+        record_task_latency(self.task_name, 'cold', 30)
+        record_task_latency(self.task_name, 'warm', 10)
+        self.assertEqual(recent_task_latency(self.task_name), 20)
+
+        call_command('task_latency_report', reset=True, stdout=io.StringIO())
+
+        self.assertIsNone(recent_task_latency(self.task_name))
+        self.assertEqual(self.redis.keys(f"{WARMUP_KEY_PREFIX}*"), [])
+
+    @override_settings(PFD_BENCH_WARMUP={'enabled': True, 'offline_call': True}, PFD_BENCH_CHECKPOINTER='none')
+    def test_a_worker_without_llm_calls_builds_no_agent_nor_graph(self):
+        with mock.patch.object(PFD_bench_setup, 'get_structured_agent') as get_structured_agent, \
+                mock.patch.object(PFD_bench_setup, 'get_st1_graph') as get_st1_graph:
+            warm_up_process(llm_calls=False)
+            get_structured_agent.assert_not_called()
+            get_st1_graph.assert_not_called()
+
+            warm_up_process(llm_calls=True)
+            self.assertEqual(get_structured_agent.call_count, 3)
+            get_st1_graph.assert_called_once()
+
+
+
+@override_settings(CELERY_BROKER_URL="redis://broker/0", PFD_BENCH_REDIS_URL="redis://broker/0",
+                   PFD_BENCH_ADMISSION={'enabled': True, 'eta_notice_s': 300, 'max_wait_s': 1800, 'window': '',
+                                        'cpu_slots': 2, 'io_slots': 32, 'max_active_per_user': 2,
+                                        'max_active_per_project': 3, 'user_limits': {}, 'every_s': 60})
+class AdmissionTests(PipelineTestCase):
+    """Parse tasks take 10s on 2 slots, LLM tasks 120s on 32 slots"""
+
+    def setUp(self):
+        super().setUp()
+        self.redis.rpush(f"{WARMUP_KEY_PREFIX}:recent:pfd_bench.tasks.parse_pfd_extraction_step_1", 10)
+        self.redis.rpush(f"{WARMUP_KEY_PREFIX}:recent:pfd_bench.tasks.llm_pfd_extraction_step_1", 120)
+
+    def queue(self, queue, depth):
+        self.redis.rpush(queue, *["message"] * depth)
+
+    def admit(self, run, now=None):
+        decision = PFD_admission.admit(run, now)
+        return decision, run.status, run.admission["eta_s"]
+
+    def test_a_run_is_accepted_on_idle_workers(self):
+        self.assertEqual(self.admit(self.new_run()), ('accepted', 'pending', 130))
+
+    def test_a_run_is_accepted_with_an_eta_behind_a_queue(self):
+        self.queue(IO_QUEUE, 64)  # two rounds of the 32 slots ahead
+        self.queue(CPU_QUEUE, 3)
+        run = self.new_run()
+        self.assertEqual(self.admit(run), ('accepted_eta', 'pending', 2 * 10 + 3 * 120))
+        self.assertEqual(run.admission["queues"], {CPU_QUEUE: 3, IO_QUEUE: 64})
+
+    def test_a_run_is_deferred_over_max_wait(self):
+        self.queue(IO_QUEUE, 32 * 15)
+        run = self.new_run()
+        self.assertEqual(self.admit(run), ('deferred', 'scheduled', 10 + 16 * 120))
+        self.assertIsNone(run.scheduled_for)  # no window: as soon as the load allows
+
+    def test_a_run_is_deferred_to_the_window_outside_of_it(self):
+        self.queue(IO_QUEUE, 32 * 15)
+        noon = timezone.make_aware(datetime(2026, 10, 19, 12, 0))
+        with self.settings(PFD_BENCH_ADMISSION={**settings.PFD_BENCH_ADMISSION, 'window': '22:00-06:00'}):
+            run = self.new_run()
+            self.assertEqual(self.admit(run, noon)[0], 'deferred')
+            self.assertEqual(run.scheduled_for, noon.replace(hour=22))
+
+            late = self.new_run()
+            self.assertEqual(self.admit(late, noon.replace(hour=23))[0], 'accepted_eta')  # within the window
+
+    def test_the_limits_of_users_and_projects(self):
+        for name in 'ab':
+            self.new_run(name, status='processing')
+        run = self.new_run()
+        self.assertEqual(self.admit(run), ('deferred', 'scheduled', 130))
+        self.assertEqual(run.admission["reason"], "You have reached your limit of 2 runs in progress")
+
+        with self.settings(PFD_BENCH_ADMISSION={**settings.PFD_BENCH_ADMISSION, 'user_limits': {'engineer': 3}}):
+            self.assertEqual(self.admit(run)[0], 'accepted')
+
+            self.project.max_active_runs = 2
+            self.project.save()
+            self.assertEqual(self.admit(run)[0], 'deferred')
+            self.assertEqual(run.admission["reason"], "This project has reached its limit of 2 runs in progress")
+
+    def test_without_redis_only_the_limits_apply(self):
+        self.queue(IO_QUEUE, 32 * 15)
+        with mock.patch.object(PFD_admission, 'queue_depths', side_effect=redis.ConnectionError("down")):
+            self.assertEqual(self.admit(self.new_run()), ('accepted', 'pending', None))
+
+    def test_scheduled_runs_start_once_admitted(self):
+        active = [self.new_run(name, status='processing') for name in 'ab']
+        run = self.new_run()
+        PFD_admission.admit(run)
+        run.save()
+
+        with mock.patch('pfd_bench.tasks.start_step_1') as start_step_1:
+            admit_scheduled_runs()
+            start_step_1.assert_not_called()  # still over the limit
+
+            Run.objects.filter(pk=active[0].pk).update(status='ready_for_review')
+            admit_scheduled_runs()
+            start_step_1.assert_called_once_with(run.id)
+
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.admission["decision"]), ('pending', 'accepted'))
+
+
+
+class StreamedCallTests(PipelineTestCase):
+    """The streamed generator call of step 2, on an offline provider taking latency_s to answer"""
+
+    def streamed_call(self, run, latency_s):
+        provider = {'latency_median_s': latency_s, 'latency_sigma': 0.01, 'error_rate': 0.0}
+        with self.settings(PFD_BENCH_OFFLINE_PROVIDER=provider), \
+                mock.patch.dict(PFD_bench_setup._structured_agents, clear=True), \
+                mock.patch.dict(PFD_heartbeats._last_beat, clear=True):
+            messages = [{"role": "system", "content": "Describe the process"},
+                        {"role": "user", "content": "| Tag |\n|---|\n| P-101 |"}]
+            config = {"configurable": {"run_id": run.id, "stream": DescriptionStream(run.id)}}
+            return PFD_bench_setup._invoke_llm("generator_node", PFD_bench_setup.GeneratorOutput, "openai:gpt-4o-mini",
+                                               messages, config, stream_text=lambda partial: partial.get("introduction", ""))
+
+    def test_a_streamed_call_beats_for_its_run(self):
+        run = self.new_run()
+        result, artifact = self.streamed_call(run, 1.5)  # beats every second while in flight
+
+        self.assertTrue(result.introduction)
+        self.assertEqual(self.redis.get(stream_text_key(run.id)), result.introduction)
+        self.assertEqual(self.redis.hget(heartbeat_key(run.id), "state"), "running")
+
+    def test_a_run_cancelled_mid_stream_stops_its_call(self):
+        run = self.new_run()
+        started = time.monotonic()
+        cancel = threading.Timer(1.0, request_cancel, [run.id])
+        cancel.start()
+        self.addCleanup(cancel.cancel)
+
+        with self.assertRaises(RunCancelled):
+            self.streamed_call(run, 6.0)
+        self.assertLess(time.monotonic() - started, 4.0)  # the whole answer takes 6s
+
+    def test_a_run_waiting_for_its_first_token_beats_and_can_be_cancelled(self):
+        run = self.new_run()
+        started, started_at = time.monotonic(), time.time()
+        cancel = threading.Timer(2.5, request_cancel, [run.id])
+        cancel.start()
+        self.addCleanup(cancel.cancel)
+
+        with mock.patch('pfd_bench.core.PFD_offline_provider.STREAM_FIRST_TOKEN_FRACTION', 1.0), \
+                mock.patch.object(PFD_heartbeats, 'BEAT_EVERY_S', 0.5), \
+                self.assertRaises(RunCancelled):
+            self.streamed_call(run, 6.0)
+        self.assertLess(time.monotonic() - started, 4.0)
+        # alive for the reaper although no token arrived
+        self.assertGreater(float(self.redis.hget(heartbeat_key(run.id), "at")), started_at + 1.5)
+
+    def test_a_stream_without_a_first_token_stops_at_its_deadline(self):
+        run = self.new_run()
+        started = time.monotonic()
+
+        with mock.patch('pfd_bench.core.PFD_offline_provider.STREAM_FIRST_TOKEN_FRACTION', 1.0), \
+                mock.patch.object(PFD_bench_setup, 'call_deadline_s', return_value=1.0), \
+                self.assertRaises(TimeoutError):
+            self.streamed_call(run, 6.0)
+        self.assertLess(time.monotonic() - started, 4.0)
+
+
+
+class CancellationTests(PipelineTestCase):
+
+    def test_a_run_cancelled_after_its_graph_is_not_saved_as_ready(self):
+        run = self.new_run()
+        dxf_extract = pfd_bench_extract_step_1(run.id)
+        save_node_artifacts = PFD_bench_runs.save_node_artifacts
+
+        def cancel_before_the_save(*args, **kwargs):
+            save_node_artifacts(*args, **kwargs)
+            self.assertTrue(Run.objects.get(pk=run.id).cancel_processing())  # the graph has ended
+
+        with mock.patch.object(PFD_bench_runs, 'save_node_artifacts', cancel_before_the_save), \
+                self.assertRaises(RunCancelled):
+            pfd_bench_llm_step_1(run.id, dxf_extract)
+
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'cancelled')
+        self.assertEqual(run.generated_table, {})
+
+    def test_a_run_finished_meanwhile_is_not_cancelled(self):
+        run = self.new_run(status='processing')
+        Run.objects.filter(pk=run.id).update(status='ready_for_review')  # saved by its task
+
+        self.assertFalse(run.cancel_processing())
+        self.assertEqual(run.status, 'ready_for_review')
+        self.assertFalse(is_cancelled(run.id))
+
+
+
+@override_settings(PFD_BENCH_REAPER={'enabled': True, 'every_s': 60, 'stale_s': 1200, 'queued_stale_s': 14400,
+                                     'max_requeues': 1})
+class ReaperTests(PipelineTestCase):
+
+    def heartbeat(self, run, age_s, state='running', requeues=0):
+        self.redis.hset(heartbeat_key(run.id), mapping={"at": time.time() - age_s, "state": state,
+                                                        "node": "worker_node", "requeues": requeues})
+
+    def reap(self):
+        """Run ids requeued by one pass of the reaper"""
+        with mock.patch('pfd_bench.tasks._requeue') as requeue:
+            reap_stuck_runs()
+        return [run.id for (run,), _ in requeue.call_args_list]
+
+    def test_a_stale_run_is_requeued(self):
+        run = self.new_run(status='processing')
+        self.heartbeat(run, 1300)
+
+        self.assertEqual(self.reap(), [run.id])
+        self.assertEqual(self.redis.hgetall(heartbeat_key(run.id))["requeues"], "1")
+        self.assertEqual(self.redis.hget(heartbeat_key(run.id), "state"), "queued")
+
+    def test_a_run_beating_is_left_alone(self):
+        run = self.new_run(status='generating_description')
+        self.heartbeat(run, 60)
+        self.assertEqual(self.reap(), [])
+
+    def test_a_run_requeued_max_requeues_times_fails(self):
+        run = self.new_run(status='processing')
+        self.heartbeat(run, 1300, requeues=1)
+
+        self.assertEqual(self.reap(), [])
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'failed')
+        self.assertIn("already requeued 1 time(s)", run.processing_error)
+
+    def test_a_queued_run_is_requeued_once_its_message_is_lost(self):
+        waiting, lost = self.new_run('waiting', status='processing'), self.new_run('lost', status='processing')
+        self.heartbeat(waiting, 1300, state='queued')  # a deep queue, or a retry countdown
+        self.heartbeat(lost, 15000, state='queued')
+        self.assertEqual(self.reap(), [lost.id])
+
+    def test_a_run_never_started_is_requeued_outside_of_a_batch(self):
+        batch = RunBatch.objects.create(project=self.project, name='all', created_by=self.user)
+        run, in_batch = self.new_run('interactive'), self.new_run('in batch', batch=batch)
+        self.new_run('recent')
+        Run.objects.filter(pk__in=[run.pk, in_batch.pk]).update(updated_at=timezone.now() - timedelta(seconds=15000))
+
+        self.assertEqual(self.reap(), [run.id])
@@ -17,12 +17,16 @@ urlpatterns = [
     # HTMX partials for project view
     path('project/<int:project_id>/runs/', views.runs_list, name='runs_list'),
     path('project/<int:project_id>/files/', views.files_list, name='files_list'),
+    path('project/<int:project_id>/batches/', views.batch_progress, name='batch_progress'),
     
     # Run management
     path('project/<int:project_id>/new-run-modal/', views.new_run_modal, name='new_run_modal'),
     path('project/<int:project_id>/create-run/', views.create_run, name='create_run'),
+    path('project/<int:project_id>/create-batch/', views.create_batch, name='create_batch'),
     path('run/<int:pk>/processing/', views.run_processing, name='run_processing'),
     path('run/<int:pk>/check-status/', views.check_run_status, name='check_run_status'),
+    path('run/<int:pk>/status-stream/', views.run_status_stream, name='run_status_stream'),
+    path('run/<int:pk>/cancel/', views.cancel_run, name='cancel_run'),
     path('run/<int:pk>/delete/', views.delete_run, name='delete_run'),
     
     # File management
@@ -39,6 +43,8 @@ urlpatterns = [
     
     # Completed run view
     path('run/<int:pk>/completed/', views.run_completed, name='run_completed'),
+    path('run/<int:pk>/description-stream/', views.run_description_stream, name='run_description_stream'),
+    path('run/<int:pk>/reopen/', views.reopen_run, name='reopen_run'),
     
     # Export endpoints
     path('run/<int:pk>/export/csv/', views.export_equipment_csv, name='export_equipment_csv'),
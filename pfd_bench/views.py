@@ -3,20 +3,29 @@
 
 import logging
 
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
+from django.http import HttpResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.conf import settings
 from django.utils import timezone
 from django.http import HttpResponse
-from django.db.models import Q
+from django.db.models import Q, Count
 from django.urls import reverse
 
 import csv
+from datetime import timedelta
 
-from .models import Project, Run, ProjectFile, ProjectFileLink
+from .models import Project, Run, RunBatch, ProjectFile, ProjectFileLink
 #from .mock_data import SAMPLE_TABLE, generate_mock_equipment_row  # for dev and debug
-from .tasks import process_pfd_extraction_step_1, process_pfd_extraction_step_2
+from .tasks import (start_step_1, pfd_extraction_batch, process_pfd_extraction_step_2,
+                    speculate_pfd_extraction_step_2)
+from .core.PFD_streaming import description_events, sse_event
+from .core.PFD_status import run_status_events
+from .core.PFD_speculation import claim_speculation
+from .core.PFD_cancellation import cancel_run as cancel_run_processing
+from .core.PFD_heartbeats import beat
+from .core.PFD_admission import admit
 
 logger = logging.getLogger(__name__)
 
@@ -148,7 +157,7 @@ def export_description(request, pk):
 
 @login_required
 def check_run_status(request, pk):
-    """Check run status for auto-refresh (HTMX)"""
+    """Check run status: redirects once processing ended (polled by HTMX only if the status stream is unavailable)"""
     run = get_object_or_404(Run, pk=pk)
     
     # If processing is complete, redirect to review
@@ -163,6 +172,13 @@ def check_run_status(request, pk):
         response = HttpResponse(status=303)
         response['Location'] = reverse('pfd_bench:project_detail', args=[run.project.id])
         return response
+
+    # If cancelled, back to the project
+    if run.status == 'cancelled':
+        messages.info(request, f"Run '{run.name}' was cancelled")
+        response = HttpResponse(status=303)
+        response['Location'] = reverse('pfd_bench:project_detail', args=[run.project.id])
+        return response
     
     # Still processing
     return HttpResponse(status=200)
@@ -228,7 +244,11 @@ def create_run(request, project_id):
     # Start processing - mock up only
     #run.start_processing()
 
-    process_pfd_extraction_step_1.delay(run.id)
+    # queued now, or scheduled for later if the workers are saturated or the limits reached (see PFD_admission)
+    admit(run)
+    run.save()
+    if run.status == 'pending':
+        start_step_1(run.id)
     
     # Redirect to processing status page
     response = HttpResponse(status=204)
@@ -238,6 +258,48 @@ def create_run(request, project_id):
 
 
 
+@login_required
+def create_batch(request, project_id):
+    """Run every DXF file of the project at once (HTMX), then show the progress of the batch"""
+    if request.method != 'POST':
+        return HttpResponse("Method not allowed", status=405)
+
+    project = get_object_or_404(Project, pk=project_id, created_by=request.user)
+
+    # name from the hx-prompt of the button
+    name = request.headers.get('HX-Prompt', '').strip() or f"Batch {timezone.now().strftime('%Y-%m-%d %H:%M')}"
+    batch = RunBatch.create_for_project(project, request.user, name)
+    if batch is None:
+        return HttpResponse('<div id="batch-progress" class="p-4 text-sm text-red-600">'
+                            'No DXF file in this project yet</div>')
+
+    pfd_extraction_batch(batch).delay()
+
+    response = batch_progress(request, project_id)
+    response['HX-Trigger'] = 'refresh-runs'
+    return response
+
+
+@login_required
+def cancel_run(request, pk):
+    """Cancel a run still processed by step 1 (HTMX, from the processing page)"""
+    if request.method != 'POST':
+        return HttpResponse("Method not allowed", status=405)
+
+    run = get_object_or_404(Run, pk=pk)
+
+    # Check permissions
+    if request.user != run.created_by and request.user != run.project.created_by:
+        return HttpResponse("Unauthorized", status=403)
+
+    if run.is_cancellable and run.cancel_processing():
+        messages.info(request, f"Run '{run.name}' was cancelled")
+
+    response = HttpResponse(status=204)
+    response['HX-Redirect'] = reverse('pfd_bench:project_detail', kwargs={'pk': run.project.pk})
+    return response
+
+
 @login_required
 def delete_run(request, pk):
     """Delete a run (HTMX)"""
@@ -250,6 +312,10 @@ def delete_run(request, pk):
     # Check permissions
     if request.user != run.created_by and request.user != project.created_by:
         return HttpResponse("Unauthorized", status=403)
+
+    # stop its task first, it would keep calling the models for a run that is gone
+    if run.is_cancellable or run.status == 'generating_description':
+        cancel_run_processing(run)
     
     run.delete()
     
@@ -458,10 +524,11 @@ def project_list(request):
 
 @login_required
 def run_completed(request, pk):
-    """Show completed run view"""
+    """Show completed run view (with the live process description while it is generated)"""
     run = get_object_or_404(Run, pk=pk)
     
-    if run.status != 'completed':
+    if run.status not in ['completed', 'generating_description'] and not (run.status == 'waiting_for_provider'
+                                                                          and run.in_step_2):
         return redirect('pfd_bench:run_review', pk=pk)
     
     # Calculate basic stats
@@ -472,10 +539,61 @@ def run_completed(request, pk):
     
     return render(request, 'pfd_bench/run_completed.html', {
         'run': run,
-        'stats': stats
+        'stats': stats,
+        'generating': run.status in ['generating_description', 'waiting_for_provider'],
     })
 
 
+@login_required
+def reopen_run(request, pk):
+    """Reopen a completed run for edits; finalizing it again only rewrites the sections of the edited rows"""
+    if request.method != 'POST':
+        return HttpResponse("Method not allowed", status=405)
+
+    run = get_object_or_404(Run, pk=pk)
+
+    if run.status != 'completed':
+        return redirect('pfd_bench:run_review', pk=pk)
+
+    run.status = 'under_review'
+    run.save()
+    messages.info(request, "Run reopened: edit the equipment and finalize again to update the description.")
+
+    return redirect('pfd_bench:run_review', pk=pk)
+
+
+@login_required
+async def run_description_stream(request, pk):
+    """Server-Sent Events with the process description as it is generated (served by the ASGI app)"""
+    run = await aget_object_or_404(Run, pk=pk)
+
+    # a run waiting for its provider (see PFD_circuit_breaker) generates its description once resumed
+    if run.status not in ['generating_description', 'waiting_for_provider']:
+        return HttpResponse(sse_event("done", {}), content_type='text/event-stream')
+
+    async def is_generating():
+        return await Run.objects.filter(pk=pk, status__in=['generating_description', 'waiting_for_provider']).aexists()
+
+    response = StreamingHttpResponse(description_events(run.id, is_generating), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # no proxy buffering of the events
+    return response
+
+
+
+@login_required
+async def run_status_stream(request, pk):
+    """Server-Sent Events with the status of a run until its processing ends (served by the ASGI app)"""
+    run = await aget_object_or_404(Run.objects.only('id', 'status'), pk=pk)
+
+    async def current_status():
+        return await Run.objects.filter(pk=run.id).values_list('status', flat=True).afirst()
+
+    response = StreamingHttpResponse(run_status_events(run.id, current_status), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # no proxy buffering of the events
+    return response
+
 
 @login_required
 def run_processing(request, pk):
@@ -496,12 +614,11 @@ def run_review(request, pk):
     
     # Check if run is completed or frozen during text generation
     if run.status in ['completed', 'generating_description']:
-        if run.status == 'generating_description':
-            # Redirect to a processing page or back to project
-            messages.info(request, "This run is generating the process description...")
-            return redirect('pfd_bench:project_detail', pk=run.project.pk)
-        else:
-            return redirect('pfd_bench:run_completed', pk=pk)
+        # the description shows up live on the completed page while it is generated
+        return redirect('pfd_bench:run_completed', pk=pk)
+
+    if run.status == 'waiting_for_provider':
+        return redirect('pfd_bench:run_completed' if run.in_step_2 else 'pfd_bench:run_processing', pk=pk)
     
     # Clear state on page load if requested (for testing)
     if request.GET.get('reset') == '1':
@@ -555,6 +672,45 @@ def runs_list(request, project_id):
     })
 
 
+# a finished batch stays on the project page this long, with its summary
+BATCH_SHOWN_AFTER_S = 600
+
+
+@login_required
+def batch_progress(request, project_id):
+    """
+    HTMX partial: one progress bar per batch of the project still running (or just finished).
+    One aggregate query over the runs of those batches, polled while any of them runs
+    """
+    project = get_object_or_404(Project, pk=project_id, created_by=request.user)
+    shown_since = timezone.now() - timedelta(seconds=BATCH_SHOWN_AFTER_S)
+
+    counts = (Run.objects
+              .filter(project=project, batch__isnull=False)
+              .filter(Q(batch__completed_at__isnull=True) | Q(batch__completed_at__gte=shown_since))
+              .values('batch_id', 'batch__name', 'batch__completed_at', 'status')
+              .annotate(n=Count('id'))
+              .order_by('-batch_id'))
+
+    batches = {}
+    for row in counts:
+        batch = batches.setdefault(row['batch_id'], {'name': row['batch__name'], 'done': row['batch__completed_at'] is not None,
+                                                     'total': 0, 'finished': 0, 'failed': 0})
+        batch['total'] += row['n']
+        if row['status'] not in ('pending', 'processing'):
+            batch['finished'] += row['n']
+        if row['status'] == 'failed':
+            batch['failed'] += row['n']
+    for batch in batches.values():
+        batch['percent'] = round(100 * batch['finished'] / batch['total'])
+
+    return render(request, 'pfd_bench/partials/batch_progress.html', {
+        'project': project,
+        'batches': list(batches.values()),
+        'running': any(not batch['done'] for batch in batches.values()),
+    })
+
+
 @login_required
 def submit_review(request, pk):
     if request.method != 'POST':
@@ -620,16 +776,25 @@ def submit_review(request, pk):
 
         logger.info(f"Finalizing run: Generating the process description text for run {run.id}")
         
-        # Trigger text generation workflow
+        # Trigger text generation workflow; queued, not stuck, until a worker takes it (see PFD_heartbeats)
+        beat(run.id, state='queued')
         process_pfd_extraction_step_2.delay(run.id)
         
         save_review_state(run, state)
-        # HTMX redirect
+        # HTMX redirect to the completed page, where the description streams in
         response = HttpResponse(status=204)
-        response['HX-Redirect'] = reverse('pfd_bench:project_detail', kwargs={'pk': run.project.pk})
+        response['HX-Redirect'] = reverse('pfd_bench:run_completed', kwargs={'pk': run.pk})
         return response
     
     save_review_state(run, state)
+
+    # far enough into the review: generate the description of the table as it stands, in the background
+    if action in ['approve', 'submit_changes']:
+        speculated_hash = claim_speculation(run, len(state['reviewed_indices']))
+        if speculated_hash:
+            logger.info(f"Speculative generation of the process description for run {run.id}")
+            speculate_pfd_extraction_step_2.apply_async(
+                (run.id, speculated_hash), priority=settings.PFD_BENCH_PRIORITIES['speculative'])
     
     # Determine next index
     if action in ['approve', 'submit_changes']: